@@ -1,19 +1,463 @@
-from fastapi import FastAPI, File, UploadFile, Form
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, UploadFile, Form, Request
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 import uvicorn
-import tempfile
 import os
-from inference import MedicalDetector
+import io
+import time
+import asyncio
+import zipfile
+import hashlib
+import hmac
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from inference import (MedicalDetector, DEFAULT_MODEL_PATH, DEFAULT_INFERENCE_PARAMS, DEFAULT_CASCADE_PARAMS, IMAGE_SUFFIXES,
+                       build_output, add_clinical_explanation, file_sha256, load_image, load_raw_pixels,
+                       resolve_backend_path, warm_up)
+from tiling import DEFAULT_TILING_PARAMS, detect_tiled
+from batching import BatchScheduler, QueueFullError, DeadlineExceededError, DEFAULT_PRIORITY, DEFAULT_PRIORITY_WEIGHTS
+from replica_pool import ReplicaPool
+from model_registry import (ModelRegistry, ResidentModel, UnknownModelError, load_registry_file, model_bytes,
+                            estimate_replica_bytes, rss_bytes, BACKEND_MEMORY_ESTIMATES)
+from result_cache import ResultCache, cache_key
+from audit_log import AuditLog
+from result_store import ResultStore
+from metrics import REGISTRY, counter, gauge, histogram, current_trace, extend_trace, server_timing, stage
 import json
 
+# Reference point for time-to-ready; importing this module is the start of serving
+PROCESS_START = time.perf_counter()
+
 app = FastAPI(title="HealVision Medical Imaging API", 
               description="YOLOv8-based lung opacity detection for chest X-rays",
               version="1.0.0")
 
-# Global model instance
-detector = MedicalDetector()
+# Micro-batching configuration
+MAX_BATCH_SIZE = int(os.environ.get("HEALVISION_MAX_BATCH_SIZE", "8"))
+MAX_BATCH_DELAY_MS = float(os.environ.get("HEALVISION_MAX_BATCH_DELAY_MS", "10"))
+
+# Inference worker pool configuration
+MODEL_PATH = os.environ.get("HEALVISION_MODEL_PATH", DEFAULT_MODEL_PATH)
+INFERENCE_WORKERS = int(os.environ.get("HEALVISION_INFERENCE_WORKERS", "1"))
+MAX_QUEUE_DEPTH = int(os.environ.get("HEALVISION_MAX_QUEUE_DEPTH", "64"))
+RETRY_AFTER_SECONDS = 1
+
+def parse_priority_weights(value):
+    """
+    "stat=16,urgent=4,routine=1" -> {"stat": 16.0, "urgent": 4.0, "routine": 1.0}
+    """
+    weights = {}
+    for entry in value.split(","):
+        name, _, weight = entry.partition("=")
+        weights[name.strip().lower()] = float(weight)
+    return weights
+
+# Priority classes and their weighted fair queuing weights; each class has its own
+# MAX_QUEUE_DEPTH, so a routine backlog never blocks urgent studies at admission
+PRIORITY_WEIGHTS = DEFAULT_PRIORITY_WEIGHTS
+if os.environ.get("HEALVISION_PRIORITY_WEIGHTS"):
+    PRIORITY_WEIGHTS = parse_priority_weights(os.environ["HEALVISION_PRIORITY_WEIGHTS"])
+# Requests set their class and an optional deadline (milliseconds from arrival) with these
+# headers or the priority / deadline_ms form fields
+PRIORITY_HEADER = "X-Priority"
+DEADLINE_HEADER = "X-Deadline-Ms"
+
+# /analyze/raw pixel format fields and the headers that can carry them instead
+RAW_PIXEL_HEADERS = {
+    "dtype": "X-Pixel-Dtype",
+    "width": "X-Image-Width",
+    "height": "X-Image-Height",
+    "window_center": "X-Window-Center",
+    "window_width": "X-Window-Width",
+    "photometric": "X-Photometric-Interpretation"
+}
+
+# Largest number of views accepted in one /analyze/batch study
+MAX_STUDY_IMAGES = int(os.environ.get("HEALVISION_MAX_STUDY_IMAGES", "64"))
+
+# "thread": model replicas share this process; "process": one pinned process per replica
+SERVING_MODE = os.environ.get("HEALVISION_SERVING_MODE", "thread")
+
+# "torch", or "onnx"/"openvino" to run the graph exported by export.py
+BACKEND = os.environ.get("HEALVISION_BACKEND", "torch")
+
+# Two-stage cascade: a low-resolution triage pass screens out clear normals before the full pass
+# (measure its recall first with `python test.py --cascade`)
+CASCADE = None
+if os.environ.get("HEALVISION_CASCADE", "0") == "1":
+    CASCADE = {
+        "imgsz": int(os.environ.get("HEALVISION_CASCADE_IMGSZ", str(DEFAULT_CASCADE_PARAMS["imgsz"]))),
+        "conf": float(os.environ.get("HEALVISION_CASCADE_CONF", str(DEFAULT_CASCADE_PARAMS["conf"])))
+    }
+
+# Tiled inference for full-resolution films: overlapping native-resolution tiles, spread over the replicas
+TILING = None
+if os.environ.get("HEALVISION_TILING", "0") == "1":
+    TILING = {
+        **DEFAULT_TILING_PARAMS,
+        "tile_size": int(os.environ.get("HEALVISION_TILE_SIZE", str(DEFAULT_TILING_PARAMS["tile_size"]))),
+        "overlap": float(os.environ.get("HEALVISION_TILE_OVERLAP", str(DEFAULT_TILING_PARAMS["overlap"])))
+    }
+
+# Parameters that determine a result, for result cache keys
+INFERENCE_PARAMS = dict(DEFAULT_INFERENCE_PARAMS)
+if CASCADE:
+    INFERENCE_PARAMS["cascade"] = CASCADE
+if TILING:
+    INFERENCE_PARAMS["tiling"] = TILING
+
+# Model versions: a JSON registry file (see model_registry.py), or MODEL_PATH as the only version
+MODEL_REGISTRY_FILE = os.environ.get("HEALVISION_MODEL_REGISTRY") or None
+DEFAULT_MODEL_VERSION = os.environ.get("HEALVISION_MODEL_VERSION", "default")
+# Memory budget for resident model versions in MiB, least recently used evicted first (0: unbounded)
+MODEL_MEMORY_BUDGET_MB = float(os.environ.get("HEALVISION_MODEL_MEMORY_BUDGET_MB", "0"))
+# Requests pick a version with this header or the model_version form field
+MODEL_VERSION_HEADER = "X-Model-Version"
+# PUT/POST/DELETE /models need "Authorization: Bearer <token>"; without a token they are disabled
+ADMIN_TOKEN = os.environ.get("HEALVISION_ADMIN_TOKEN", "")
+# Versions registered through the API may only load weights from inside this directory
+WEIGHTS_DIR = Path(os.environ.get("HEALVISION_WEIGHTS_DIR", "runs")).resolve()
+
+# Result cache configuration (HEALVISION_CACHE_MAX_BYTES=0 disables caching)
+CACHE_MAX_BYTES = int(os.environ.get("HEALVISION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_TTL_SECONDS = float(os.environ.get("HEALVISION_CACHE_TTL_SECONDS", "3600"))
+CACHE_DIR = os.environ.get("HEALVISION_CACHE_DIR") or None
+
+# Hash-chained audit log of every analysis with patient metadata (empty disables it)
+AUDIT_LOG_PATH = os.environ.get("HEALVISION_AUDIT_LOG", "logs/audit.sqlite3")
+AUDIT_MAX_BATCH_SIZE = int(os.environ.get("HEALVISION_AUDIT_MAX_BATCH_SIZE", "512"))
+AUDIT_MAX_DELAY_MS = float(os.environ.get("HEALVISION_AUDIT_MAX_DELAY_MS", "50"))
+AUDIT_MAX_BACKLOG = int(os.environ.get("HEALVISION_AUDIT_MAX_BACKLOG", "100000"))
+
+# Indexed store of analysis results behind /history (empty disables it)
+RESULT_STORE_PATH = os.environ.get("HEALVISION_RESULT_STORE", "store/results.sqlite3")
+
+# Dummy inferences per replica before the server reports ready
+WARMUP_RUNS = int(os.environ.get("HEALVISION_WARMUP_RUNS", "2"))
+
+# Send this header (e.g. "X-HealVision-Trace: 1") to get per-stage timings back in Server-Timing
+TRACE_HEADER = "X-HealVision-Trace"
+
+REQUESTS = counter("healvision_requests_total", "HTTP requests handled", ("endpoint", "status"))
+ERRORS = counter("healvision_request_errors_total", "HTTP requests answered with a 5xx status", ("endpoint",))
+IN_FLIGHT = gauge("healvision_requests_in_flight", "HTTP requests currently being handled")
+REQUEST_SECONDS = histogram("healvision_request_seconds", "End-to-end request latency", ("endpoint",))
+QUEUE_DEPTH = gauge("healvision_queue_depth", "Requests waiting for or running in a forward pass")
+QUEUE_DEPTH.set_function(lambda: registry.queue_depth() if registry is not None else 0)
+READY = gauge("healvision_ready", "1 once the model is loaded and warmed up")
+TIME_TO_READY = gauge("healvision_time_to_ready_seconds", "Seconds from API import until ready for traffic")
+
+# Threads that split tiled requests, wait for their tiles and merge the boxes
+tiling_pool = ThreadPoolExecutor(max_workers=MAX_QUEUE_DEPTH, thread_name_prefix="tiling") if TILING else None
+
+# Global model registry, result cache, audit log and result store, created on startup
+registry = None
+result_cache = None
+audit_log = None
+result_store = None
+model_loader = None
+
+# Startup progress: "starting" -> "loading" -> "warming_up" -> "ready", or "failed"
+serving_state = {"status": "starting", "error": None, "load_seconds": None, "warmup_seconds": None,
+                 "time_to_ready_seconds": None}
+
+class ModelNotReadyError(Exception):
+    pass
+
+def create_detectors(model_path, backend):
+    """
+    Build the model replicas for the configured serving mode
+    
+    Returns the replicas and, in process mode, the pool that owns them.
+    """
+    num_replicas = max(1, INFERENCE_WORKERS)
+    
+    if SERVING_MODE == "process":
+        replica_pool = ReplicaPool(num_replicas, model_path, detector_kwargs={"backend": backend, "cascade": CASCADE})
+        return replica_pool.replicas, replica_pool
+    if SERVING_MODE == "thread":
+        return [MedicalDetector(model_path, backend=backend, cascade=CASCADE) for _ in range(num_replicas)], None
+    raise ValueError(f"Unknown HEALVISION_SERVING_MODE: {SERVING_MODE}")
+
+def resident_memory(model_path, backend, detectors, replica_pool, rss_before):
+    """
+    Memory a loaded and warmed-up version holds, measured where possible
+    
+    Process replicas are measured whole (RSS of each replica process); thread
+    replicas by this process's RSS growth over load and warm-up, at least the
+    weights size (a concurrent load can skew it; the shared Ultralytics and torch
+    import is excluded). Without /proc it falls back
+    to the per-backend estimate.
+    """
+    if replica_pool is not None:
+        sizes = [rss_bytes(replica.process.pid) for replica in replica_pool.replicas]
+        if None not in sizes:
+            return sum(sizes)
+    elif rss_before is not None:
+        rss_after = rss_bytes()
+        if rss_after is not None:
+            return max(rss_after - rss_before, model_bytes(model_path, backend) * len(detectors))
+    
+    replica_bytes = estimate_replica_bytes(model_path, backend)
+    if CASCADE:
+        # Every replica also holds the torch weights for the triage pass
+        replica_bytes += int(BACKEND_MEMORY_ESTIMATES["torch"][1] * model_bytes(model_path))
+    return replica_bytes * len(detectors)
+
+def load_model(version, spec):
+    """
+    Load and warm up one model version and open its scheduler (called by the registry)
+    """
+    model_path, backend = spec["model_path"], spec["backend"]
+    if SERVING_MODE == "thread":
+        # Loaded once and shared by every version; keep it out of this version's measured growth
+        import ultralytics
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    detectors, replica_pool = create_detectors(model_path, backend)
+    load_seconds = time.perf_counter() - start
+    
+    if serving_state["status"] == "loading":
+        serving_state["status"] = "warming_up"
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=len(detectors)) as pool:
+            list(pool.map(lambda replica: warm_up(replica, WARMUP_RUNS), detectors))
+    except Exception:
+        if replica_pool is not None:
+            replica_pool.close()
+        raise
+    warmup_seconds = time.perf_counter() - start
+    print(f"Model {version} loaded in {load_seconds:.2f}s, warmed up in {warmup_seconds:.2f}s")
+    
+    memory_bytes = resident_memory(model_path, backend, detectors, replica_pool, rss_before)
+    
+    # Requests arriving within the batching window share one forward pass, off the event loop
+    batcher = BatchScheduler(detectors, max_batch_size=MAX_BATCH_SIZE, max_delay_ms=MAX_BATCH_DELAY_MS,
+                             max_queue_size=MAX_QUEUE_DEPTH, priority_weights=PRIORITY_WEIGHTS)
+    resident = ResidentModel(
+        version, spec, batcher,
+        memory_bytes=memory_bytes,
+        model_hash=file_sha256(resolve_backend_path(model_path, backend)) if CACHE_MAX_BYTES > 0 else None,
+        replica_pool=replica_pool
+    )
+    resident.load_seconds, resident.warmup_seconds = load_seconds, warmup_seconds
+    return resident
+
+def load_models():
+    """
+    Register the model versions and load the default one (runs off the event loop)
+    
+    The registry is published last, so registry being set means the server is ready.
+    """
+    global registry, result_cache
+    try:
+        serving_state["status"] = "loading"
+        budget = MODEL_MEMORY_BUDGET_MB * 1024 * 1024 if MODEL_MEMORY_BUDGET_MB > 0 else None
+        models = ModelRegistry(load_model, memory_budget_bytes=budget)
+        if MODEL_REGISTRY_FILE:
+            config = load_registry_file(MODEL_REGISTRY_FILE)
+            for version, spec in config["models"].items():
+                models.register(version, spec["model_path"], spec.get("backend", BACKEND),
+                                default=version == config.get("default"))
+        else:
+            models.register(DEFAULT_MODEL_VERSION, MODEL_PATH, BACKEND)
+        
+        default = models.acquire()
+        default.release()
+        serving_state.update(load_seconds=default.load_seconds, warmup_seconds=default.warmup_seconds)
+        
+        if CACHE_MAX_BYTES > 0:
+            result_cache = ResultCache(max_bytes=CACHE_MAX_BYTES, ttl_seconds=CACHE_TTL_SECONDS, disk_dir=CACHE_DIR)
+        registry = models
+    except Exception as e:
+        serving_state.update(status="failed", error=str(e))
+        print(f"Model startup failed: {e}")
+        raise
+    
+    time_to_ready = time.perf_counter() - PROCESS_START
+    serving_state.update(status="ready", time_to_ready_seconds=time_to_ready)
+    READY.set(1)
+    TIME_TO_READY.set(time_to_ready)
+    print(f"Ready in {time_to_ready:.2f}s (load {serving_state['load_seconds']:.2f}s, "
+          f"warm-up {serving_state['warmup_seconds']:.2f}s)")
+
+async def acquire_model(request, model_version=None):
+    """
+    Lease the model version a request asks for (form field, then header, then default)
+    
+    A version that is not resident is loaded off the event loop. The caller must
+    release() the returned model once its inference is done.
+    """
+    if registry is None:
+        raise ModelNotReadyError(f"Model is {serving_state['status']}")
+    version = model_version or request.headers.get(MODEL_VERSION_HEADER) or None
+    if registry.is_resident(version):
+        return registry.acquire(version)
+    return await asyncio.get_running_loop().run_in_executor(None, registry.acquire, version)
+
+def request_scheduling(request, priority=None, deadline_ms=None):
+    """
+    Priority class and absolute deadline (time.monotonic()) of a request, from form fields or headers
+    
+    Raises:
+        ValueError: For an unknown priority class or a non-positive deadline
+    """
+    priority = (priority or request.headers.get(PRIORITY_HEADER) or DEFAULT_PRIORITY).lower()
+    if priority not in PRIORITY_WEIGHTS:
+        raise ValueError(f"Unknown priority '{priority}', expected one of {tuple(PRIORITY_WEIGHTS)}")
+    
+    if deadline_ms is None and request.headers.get(DEADLINE_HEADER):
+        try:
+            deadline_ms = float(request.headers[DEADLINE_HEADER])
+        except ValueError:
+            raise ValueError(f"{DEADLINE_HEADER} must be a number of milliseconds")
+    if deadline_ms is None:
+        return priority, None
+    if deadline_ms <= 0:
+        raise ValueError("deadline_ms must be positive")
+    return priority, getattr(request.state, "arrived_at", time.monotonic()) + deadline_ms / 1000.0
+
+def run_tiled(content, batcher, priority, deadline, timings):
+    """
+    Tiled detection payload for one upload, with its tiles queued on the scheduler as separate images
+    
+    Tiles are queued a wave at a time, enough to give every replica a full batch,
+    so one large film cannot fill the whole queue. Stage timings of the decode and
+    of every batch the tiles ran in are appended to timings.
+    """
+    token = current_trace.set(timings)
+    try:
+        with stage("decode"):
+            image = load_image(content, batcher.detectors[0].channels)
+        
+        def run_tiles(tiles):
+            futures = [batcher.submit(tile, priority, deadline) for tile in tiles]
+            payloads = [future.result() for future in futures]
+            # The wave waited as long as its slowest tile; tiles sharing a batch share its timings
+            extend_trace([max((future.stage_timings[0] for future in futures), key=lambda timing: timing[1])])
+            for future in {id(future.batch_timings): future for future in futures}.values():
+                extend_trace(future.batch_timings)
+            return payloads
+        
+        return detect_tiled(image, run_tiles, chunk_size=MAX_BATCH_SIZE * len(batcher.detectors), **TILING)
+    finally:
+        current_trace.reset(token)
+
+def submit_image(content, model, priority, deadline):
+    if TILING is None:
+        return model.batcher.submit(content, priority, deadline)
+    # Fail fast like an untiled request would, instead of queueing behind the tiling threads
+    if model.batcher.queue_depth(priority) >= model.batcher.max_queue_size:
+        raise QueueFullError(f"Inference queue is full ({model.batcher.max_queue_size} pending {priority} requests)")
+    timings = []
+    future = tiling_pool.submit(run_tiled, content, model.batcher, priority, deadline, timings)
+    future.stage_timings = timings
+    return future
+
+def submit_inference(content, model, priority=DEFAULT_PRIORITY, deadline=None, pixels=None, pixel_format=None):
+    """
+    Queue an upload on a model's scheduler, reusing cached or in-flight results for identical images
+    
+    For raw pixel uploads, pixels is the array to run and content (the raw buffer)
+    together with pixel_format only keys the cache.
+    """
+    image = content if pixels is None else pixels
+    if result_cache is None:
+        return submit_image(image, model, priority, deadline)
+    
+    params = INFERENCE_PARAMS if pixel_format is None else {**INFERENCE_PARAMS, "pixels": pixel_format}
+    key = cache_key(content, model.model_hash, params)
+    return result_cache.get_or_submit(key, lambda: submit_image(image, model, priority, deadline),
+                                      group=(priority, deadline))
+
+async def wait_for_inference(future, deadline=None):
+    """
+    Await an inference Future, giving up (and cancelling it if still queued) once the deadline passes
+    
+    The stages the batch worker (or replica) ran for it are merged into the request's trace.
+    """
+    try:
+        if deadline is None:
+            return await asyncio.wrap_future(future)
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=max(0.0, deadline - time.monotonic()))
+    except asyncio.TimeoutError:
+        raise DeadlineExceededError("Deadline passed before the analysis finished")
+    finally:
+        if future.done():
+            extend_trace(getattr(future, "stage_timings", ()))
+
+def record_analysis(results, endpoint, model, image_sha256):
+    """
+    Queue an analysis with patient metadata for the audit log and result store (never blocks on disk)
+    """
+    if "audit_hash" not in results:
+        return
+    if result_store is not None:
+        result_store.add(results, model.version)
+    if audit_log is None:
+        return
+    
+    patient_metadata = results["patient_metadata"]
+    audit_log.append({
+        "event": "analysis",
+        "endpoint": endpoint,
+        "audit_hash": results["audit_hash"],
+        "timestamp": results["timestamp"],
+        "patient_id": patient_metadata.get("patient_id"),
+        "study_id": patient_metadata.get("study_id"),
+        "filename": results["image_metadata"]["filename"],
+        "image_sha256": image_sha256,
+        "model_version": model.version,
+        "model_path": model.spec["model_path"],
+        "detections": results["detections"]
+    })
+
+def overloaded_response(error):
+    """
+    Fast rejection when the inference queue is full
+    """
+    return JSONResponse(
+        status_code=503,
+        content={"error": f"Server overloaded: {error}"},
+        headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+    )
+
+def not_ready_response(error):
+    """
+    Rejection while the model is still loading (or failed to load)
+    """
+    return JSONResponse(
+        status_code=503,
+        content={"error": f"Service not ready: {error}"},
+        headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+    )
+
+def unknown_model_response(error):
+    return JSONResponse(status_code=404, content={"error": f"Unknown model version: {error}"})
+
+def admin_error_response(request):
+    """
+    Rejection of a model management request, or None if it carries the admin token
+    """
+    if not ADMIN_TOKEN:
+        return JSONResponse(status_code=403,
+                            content={"error": "Model management is disabled (set HEALVISION_ADMIN_TOKEN)"})
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return JSONResponse(status_code=401, content={"error": "Invalid or missing admin token"},
+                            headers={"WWW-Authenticate": "Bearer"})
+    return None
+
+def weights_path_allowed(model_path):
+    """
+    Whether model_path resolves to a file inside WEIGHTS_DIR
+    """
+    return Path(model_path).resolve().is_relative_to(WEIGHTS_DIR)
+
+def deadline_response(error):
+    return JSONResponse(status_code=504, content={"error": f"Deadline exceeded: {error}"})
 
 class PatientMetadata(BaseModel):
     patient_id: str
@@ -26,6 +470,39 @@ class AnalysisRequest(BaseModel):
     patient_metadata: PatientMetadata
     include_explanation: bool = True
 
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    """
+    Count and time every request; trace its stages when the trace header is set
+    """
+    # Request deadlines count from here, before the upload is read
+    request.state.arrived_at = time.monotonic()
+    trace = [] if request.headers.get(TRACE_HEADER, "").lower() in ("1", "true", "yes") else None
+    token = current_trace.set(trace)
+    IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        elapsed = time.perf_counter() - start
+        IN_FLIGHT.dec()
+        current_trace.reset(token)
+        
+        # Label by route template, not raw path, to keep cardinality bounded
+        route = request.scope.get("route")
+        endpoint = route.path if route is not None else "unmatched"
+        REQUESTS.inc(endpoint=endpoint, status=status)
+        if status >= 500:
+            ERRORS.inc(endpoint=endpoint)
+        REQUEST_SECONDS.observe(elapsed, endpoint=endpoint)
+    
+    if trace is not None:
+        trace.append(("total", elapsed))
+        response.headers["Server-Timing"] = server_timing(trace)
+    return response
+
 @app.get("/")
 async def root():
     return {"message": "HealVision Medical Imaging API", 
@@ -34,17 +511,237 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "model_loaded": True}
+    ready = registry is not None
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "healthy" if ready else serving_state["status"],
+                 "model_loaded": ready,
+                 **serving_state}
+    )
+
+@app.get("/live")
+async def liveness():
+    """
+    Liveness probe: the process and event loop are responsive (the model may still be loading)
+    """
+    return {"status": "alive"}
+
+@app.get("/ready")
+async def readiness():
+    """
+    Readiness probe: 200 once the model is loaded and warmed up, 503 until then
+    """
+    if registry is None:
+        return JSONResponse(status_code=503, content=serving_state)
+    return serving_state
+
+@app.get("/stats/batching")
+async def batching_stats():
+    """
+    Batch sizes, queue depth and rejections of the inference schedulers
+    
+    The top level reports the default model; "models" has every resident version.
+    """
+    if registry is None:
+        return not_ready_response(f"Model is {serving_state['status']}")
+    models = {resident.version: resident.batcher.stats() for resident in registry.residents()}
+    return {**models.get(registry.default_version, {}), "models": models}
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Prometheus text exposition of request, stage, queue, batch and cache metrics
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats/cache")
+async def cache_stats():
+    """
+    Hit, miss and eviction counters of the result cache
+    """
+    if result_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **result_cache.stats()}
+
+@app.get("/stats/audit")
+async def audit_stats():
+    """
+    Committed records, group sizes, backlog and current head of the audit log
+    """
+    if audit_log is None:
+        return {"enabled": False}
+    return {"enabled": True, **audit_log.stats()}
+
+@app.get("/history")
+async def list_history(
+    patient_id: Optional[str] = None,
+    study_id: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    status: Optional[str] = None,
+    min_confidence: Optional[float] = None,
+    sort: str = "time",
+    limit: int = 50,
+    cursor: Optional[str] = None
+):
+    """
+    Page through stored analyses, newest (or with sort=confidence, most confident) first
+    
+    Args:
+        patient_id, study_id: Exact-match filters
+        since, until: ISO-8601 bounds on the analysis time, UTC unless they carry an offset
+        status: "normal" (no detections) or "abnormal"
+        min_confidence: Lower bound on the highest detection confidence
+        sort: "time" or "confidence"
+        limit: Page size (1-500)
+        cursor: next_cursor from the previous page
+    
+    Returns:
+        JSON with "items" (summaries, fetch /history/{id} for the full result) and "next_cursor"
+    """
+    if result_store is None:
+        return JSONResponse(status_code=404, content={"error": "Result history is disabled"})
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, lambda: result_store.query(patient_id=patient_id, study_id=study_id, since=since, until=until,
+                                             status=status, min_confidence=min_confidence, sort=sort,
+                                             limit=limit, cursor=cursor))
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+@app.get("/history/{result_id}")
+async def get_history_item(result_id: int):
+    """
+    A stored analysis with its full standardized output
+    """
+    if result_store is None:
+        return JSONResponse(status_code=404, content={"error": "Result history is disabled"})
+    item = await asyncio.get_running_loop().run_in_executor(None, result_store.get, result_id)
+    if item is None:
+        return JSONResponse(status_code=404, content={"error": f"No result with id {result_id}"})
+    return item
+
+@app.on_event("startup")
+async def start_inference():
+    global model_loader, audit_log, result_store
+    if AUDIT_LOG_PATH:
+        audit_log = AuditLog(AUDIT_LOG_PATH, max_batch_size=AUDIT_MAX_BATCH_SIZE, max_delay_ms=AUDIT_MAX_DELAY_MS,
+                             max_backlog=AUDIT_MAX_BACKLOG)
+    if RESULT_STORE_PATH:
+        result_store = ResultStore(RESULT_STORE_PATH)
+    # Load in the background so uvicorn binds immediately and /live answers during loading
+    model_loader = asyncio.get_running_loop().run_in_executor(None, load_models)
+
+@app.on_event("shutdown")
+async def shutdown_inference():
+    if model_loader is not None:
+        # Never leave replicas half-started behind
+        await asyncio.gather(model_loader, return_exceptions=True)
+    if registry is not None:
+        registry.close()
+    # Both commit whatever is still queued
+    if audit_log is not None:
+        audit_log.close()
+    if result_store is not None:
+        result_store.close()
+    if tiling_pool is not None:
+        tiling_pool.shutdown(wait=False)
+
+@app.get("/models")
+async def list_models():
+    """
+    Registered model versions, which are resident, and the memory budget
+    """
+    if registry is None:
+        return not_ready_response(f"Model is {serving_state['status']}")
+    return registry.stats()
+
+@app.put("/models/{version}")
+async def register_model(
+    request: Request,
+    version: str,
+    model_path: str = Form(...),
+    backend: str = Form(BACKEND),
+    default: bool = Form(False),
+    preload: bool = Form(False)
+):
+    """
+    Register a model version, or hot-swap the weights behind an existing one
+    
+    Args:
+        version: Version name requests use in X-Model-Version / model_version
+        model_path: Weights on this server (.pt; exported backends are resolved next to it)
+        backend: Inference backend for this version
+        default: Route requests without an explicit version to this one
+        preload: Load and warm up now instead of on the first request
+    
+    A swapped version that is resident is loaded and warmed up before the switch;
+    requests already running finish on the previous weights. Requires the admin
+    token, and model_path must be inside HEALVISION_WEIGHTS_DIR.
+    """
+    rejection = admin_error_response(request)
+    if rejection is not None:
+        return rejection
+    if not weights_path_allowed(model_path):
+        return JSONResponse(status_code=400,
+                            content={"error": f"model_path must be inside the weights directory {WEIGHTS_DIR}"})
+    if registry is None:
+        return not_ready_response(f"Model is {serving_state['status']}")
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            None, lambda: registry.register(version, model_path, backend, default=default, preload=preload)
+        )
+    except (OSError, ValueError) as e:
+        return JSONResponse(status_code=400, content={"error": f"Could not register model: {str(e)}"})
+    return registry.stats()["models"][version]
+
+@app.post("/models/{version}/default")
+async def set_default_model(request: Request, version: str):
+    """
+    Atomically route unversioned requests to this version (requires the admin token)
+    """
+    rejection = admin_error_response(request)
+    if rejection is not None:
+        return rejection
+    if registry is None:
+        return not_ready_response(f"Model is {serving_state['status']}")
+    try:
+        registry.set_default(version)
+    except UnknownModelError as e:
+        return unknown_model_response(e)
+    return {"default": version}
+
+@app.delete("/models/{version}")
+async def unregister_model(request: Request, version: str):
+    """
+    Remove a version; it is unloaded once its in-flight requests finish (requires the admin token)
+    """
+    rejection = admin_error_response(request)
+    if rejection is not None:
+        return rejection
+    if registry is None:
+        return not_ready_response(f"Model is {serving_state['status']}")
+    try:
+        registry.unregister(version)
+    except UnknownModelError as e:
+        return unknown_model_response(e)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    return {"removed": version}
 
 @app.post("/analyze")
 async def analyze_xray(
+    request: Request,
     image: UploadFile = File(...),
     patient_id: str = Form(...),
     age: Optional[int] = Form(None),
     gender: Optional[str] = Form(None),
     study_id: Optional[str] = Form(None),
     clinical_indication: Optional[str] = Form(None),
-    include_explanation: bool = Form(True)
+    include_explanation: bool = Form(True),
+    model_version: Optional[str] = Form(None),
+    priority: Optional[str] = Form(None),
+    deadline_ms: Optional[float] = Form(None)
 ):
     """
     Analyze a chest X-ray image for lung opacities
@@ -57,10 +754,14 @@ async def analyze_xray(
         study_id: Study/Radiology order ID (optional)
         clinical_indication: Reason for exam (optional)
         include_explanation: Whether to include LLM-generated clinical explanation
+        model_version: Registered model version to use (or the X-Model-Version header)
+        priority: "stat", "urgent" or "routine" (default), or the X-Priority header
+        deadline_ms: Optional time budget; past it the request fails with 504 (or the X-Deadline-Ms header)
     
     Returns:
         JSON with detections, metadata, and optional clinical explanation
     """
+    model = None
     try:
         # Validate image file
         if not image.content_type.startswith('image/'):
@@ -68,52 +769,72 @@ async def analyze_xray(
                 status_code=400,
                 content={"error": "Invalid file type. Please upload an image file."}
             )
+        try:
+            priority, deadline = request_scheduling(request, priority, deadline_ms)
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"error": str(e)})
         
-        # Create temporary file for processing
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmp_file:
+        # Read the upload into memory; it is decoded straight from this buffer
+        with stage("upload_read"):
             content = await image.read()
-            tmp_file.write(content)
-            tmp_file_path = tmp_file.name
         
-        try:
-            # Prepare patient metadata
-            patient_metadata = {
-                "patient_id": patient_id,
-                "age": age,
-                "gender": gender,
-                "study_id": study_id,
-                "clinical_indication": clinical_indication
-            }
-            
-            # Run analysis
+        # Prepare patient metadata
+        patient_metadata = {
+            "patient_id": patient_id,
+            "age": age,
+            "gender": gender,
+            "study_id": study_id,
+            "clinical_indication": clinical_indication
+        }
+        
+        # Run analysis on the requested model version (batched with concurrent requests)
+        with stage("submit"):
+            model = await acquire_model(request, model_version)
+            future = submit_inference(content, model, priority, deadline)
+        with stage("inference_wait"):
+            payload = await wait_for_inference(future, deadline)
+        with stage("build_output"):
+            results = build_output(payload, image.filename, patient_metadata)
             if include_explanation:
-                results = detector.analyze_with_explanation(tmp_file_path, patient_metadata)
-            else:
-                results = detector.predict(tmp_file_path, patient_metadata)
-            
-            return JSONResponse(content=results)
-            
-        finally:
-            # Clean up temporary file
-            os.unlink(tmp_file_path)
+                results = add_clinical_explanation(results)
+        with stage("record"):
+            record_analysis(results, "/analyze", model, hashlib.sha256(content).hexdigest())
+        
+        with stage("serialize"):
+            return JSONResponse(content=results, headers={MODEL_VERSION_HEADER: model.version})
             
+    except QueueFullError as e:
+        return overloaded_response(e)
+    except DeadlineExceededError as e:
+        return deadline_response(e)
+    except ModelNotReadyError as e:
+        return not_ready_response(e)
+    except UnknownModelError as e:
+        return unknown_model_response(e)
     except Exception as e:
         return JSONResponse(
             status_code=500,
             content={"error": f"Analysis failed: {str(e)}"}
         )
+    finally:
+        if model is not None:
+            model.release()
 
 @app.post("/predict")
-async def predict_xray(image: UploadFile = File(...)):
+async def predict_xray(request: Request, image: UploadFile = File(...), model_version: Optional[str] = Form(None),
+                       priority: Optional[str] = Form(None), deadline_ms: Optional[float] = Form(None)):
     """
     Simple prediction endpoint without patient metadata
     
     Args:
         image: Uploaded chest X-ray image file
+        model_version: Registered model version to use (or the X-Model-Version header)
+        priority, deadline_ms: Scheduling class and time budget, as for /analyze
     
     Returns:
         JSON with detections only
     """
+    model = None
     try:
         # Validate image file
         if not image.content_type.startswith('image/'):
@@ -121,27 +842,346 @@ async def predict_xray(image: UploadFile = File(...)):
                 status_code=400,
                 content={"error": "Invalid file type. Please upload an image file."}
             )
+        try:
+            priority, deadline = request_scheduling(request, priority, deadline_ms)
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"error": str(e)})
         
-        # Create temporary file for processing
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmp_file:
+        # Read the upload into memory; it is decoded straight from this buffer
+        with stage("upload_read"):
             content = await image.read()
-            tmp_file.write(content)
-            tmp_file_path = tmp_file.name
         
-        try:
-            # Run prediction
-            results = detector.predict(tmp_file_path)
-            return JSONResponse(content=results)
-            
-        finally:
-            # Clean up temporary file
-            os.unlink(tmp_file_path)
+        # Run prediction on the requested model version (batched with concurrent requests)
+        with stage("submit"):
+            model = await acquire_model(request, model_version)
+            future = submit_inference(content, model, priority, deadline)
+        with stage("inference_wait"):
+            payload = await wait_for_inference(future, deadline)
+        with stage("build_output"):
+            results = build_output(payload, image.filename)
+        with stage("serialize"):
+            return JSONResponse(content=results, headers={MODEL_VERSION_HEADER: model.version})
             
+    except QueueFullError as e:
+        return overloaded_response(e)
+    except DeadlineExceededError as e:
+        return deadline_response(e)
+    except ModelNotReadyError as e:
+        return not_ready_response(e)
+    except UnknownModelError as e:
+        return unknown_model_response(e)
     except Exception as e:
         return JSONResponse(
             status_code=500,
             content={"error": f"Prediction failed: {str(e)}"}
         )
+    finally:
+        if model is not None:
+            model.release()
+
+async def read_raw_upload(request):
+    """
+    Pixel buffer and fields of an /analyze/raw request
+    
+    The body is either the bare buffer (application/octet-stream), with fields in the
+    query string, or multipart with the buffer in a "pixels" part next to form fields.
+    Pixel format fields may also come as headers (RAW_PIXEL_HEADERS).
+    """
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("pixels")
+        if upload is None or isinstance(upload, str):
+            raise ValueError("Multipart uploads need the pixel buffer in a 'pixels' file part")
+        buffer = await upload.read()
+        fields = dict(form)
+    else:
+        buffer = await request.body()
+        fields = dict(request.query_params)
+    
+    for name, header in RAW_PIXEL_HEADERS.items():
+        if fields.get(name) in (None, "") and request.headers.get(header):
+            fields[name] = request.headers[header]
+    return buffer, fields
+
+def parse_pixel_format(fields):
+    """
+    Validated pixel format of a raw upload (raises ValueError)
+    """
+    try:
+        pixel_format = {
+            "dtype": fields.get("dtype") or "uint8",
+            "width": int(fields["width"]),
+            "height": int(fields["height"]),
+            "window_center": float(fields["window_center"]) if fields.get("window_center") else None,
+            "window_width": float(fields["window_width"]) if fields.get("window_width") else None,
+            "invert": (fields.get("photometric") or "MONOCHROME2").upper() == "MONOCHROME1"
+        }
+    except KeyError as e:
+        raise ValueError(f"Missing {e.args[0]} (field or {RAW_PIXEL_HEADERS[e.args[0]]} header)")
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid pixel format: {e}")
+    if (pixel_format["window_center"] is None) != (pixel_format["window_width"] is None):
+        raise ValueError("window_center and window_width must be given together")
+    return pixel_format
+
+@app.post("/analyze/raw")
+async def analyze_raw(request: Request):
+    """
+    Analyze an already decoded grayscale image sent as a raw pixel buffer
+    
+    Skips JPEG encoding on the client and decoding here: the buffer is wrapped as a
+    NumPy array (8-bit pixels without a copy; 16-bit pixels windowed to 8 bits
+    through a lookup table) and queued for inference directly.
+    
+    Fields (query string or form fields; pixel format also as headers):
+        dtype: uint8 (default), uint16 or int16, optionally with byte order ('>u2')
+        width, height: Image size in pixels; the buffer must hold exactly width * height pixels
+        window_center, window_width: VOI window for 16-bit data (default: the image's min..max)
+        photometric: MONOCHROME2 (default) or MONOCHROME1 (inverted)
+        filename: Name reported in image_metadata (default "raw")
+        patient_id, age, gender, study_id, clinical_indication: With patient_id, the result is
+            audited and stored like /analyze; without it, detections only like /predict
+        include_explanation, model_version, priority, deadline_ms: As for /analyze
+    
+    Returns:
+        The /analyze (or /predict) JSON output
+    """
+    model = None
+    try:
+        try:
+            with stage("upload_read"):
+                buffer, fields = await read_raw_upload(request)
+            pixel_format = parse_pixel_format(fields)
+            priority, deadline = request_scheduling(
+                request, fields.get("priority"),
+                float(fields["deadline_ms"]) if fields.get("deadline_ms") else None)
+            age = int(fields["age"]) if fields.get("age") else None
+            # Windowing 16-bit pixels is real work, so it runs off the event loop
+            with stage("raw_pixels"):
+                pixels = await asyncio.get_running_loop().run_in_executor(
+                    None, lambda: load_raw_pixels(buffer, **pixel_format))
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"error": str(e)})
+        
+        patient_metadata = None
+        if fields.get("patient_id"):
+            patient_metadata = {
+                "patient_id": fields["patient_id"],
+                "age": age,
+                "gender": fields.get("gender"),
+                "study_id": fields.get("study_id"),
+                "clinical_indication": fields.get("clinical_indication")
+            }
+        include_explanation = str(fields.get("include_explanation", "true")).lower() in ("1", "true", "yes")
+        filename = fields.get("filename") or "raw"
+        
+        with stage("submit"):
+            model = await acquire_model(request, fields.get("model_version"))
+            future = submit_inference(buffer, model, priority, deadline, pixels=pixels, pixel_format=pixel_format)
+        with stage("inference_wait"):
+            payload = await wait_for_inference(future, deadline)
+        with stage("build_output"):
+            results = build_output(payload, filename, patient_metadata)
+            if patient_metadata is not None and include_explanation:
+                results = add_clinical_explanation(results)
+        if patient_metadata is not None:
+            with stage("record"):
+                record_analysis(results, "/analyze/raw", model, hashlib.sha256(buffer).hexdigest())
+        
+        with stage("serialize"):
+            return JSONResponse(content=results, headers={MODEL_VERSION_HEADER: model.version})
+    
+    except QueueFullError as e:
+        return overloaded_response(e)
+    except DeadlineExceededError as e:
+        return deadline_response(e)
+    except ModelNotReadyError as e:
+        return not_ready_response(e)
+    except UnknownModelError as e:
+        return unknown_model_response(e)
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"error": f"Analysis failed: {str(e)}"}
+        )
+    finally:
+        if model is not None:
+            model.release()
+
+def read_zip_images(content):
+    """
+    Extract (filename, bytes) for every image in a zip archive, in name order
+    """
+    with zipfile.ZipFile(io.BytesIO(content)) as archive:
+        members = sorted(
+            (info for info in archive.infolist()
+             if not info.is_dir() and Path(info.filename).suffix.lower() in IMAGE_SUFFIXES),
+            key=lambda info: info.filename
+        )
+        if len(members) > MAX_STUDY_IMAGES:
+            raise ValueError(f"Archive contains more than {MAX_STUDY_IMAGES} images")
+        return [(Path(info.filename).name, archive.read(info)) for info in members]
+
+async def stream_study(images, first_future, model, patient_metadata, include_explanation, priority, deadline):
+    """
+    Yield one NDJSON line per image as soon as its inference finishes
+    
+    At most MAX_BATCH_SIZE images of the study are in flight at once, so a large
+    study cannot monopolize the inference queue. The model lease is released when
+    the stream ends.
+    """
+    try:
+        async for line in _stream_study(images, first_future, model, patient_metadata, include_explanation,
+                                        priority, deadline):
+            yield line
+    finally:
+        model.release()
+
+async def _stream_study(images, first_future, model, patient_metadata, include_explanation, priority, deadline):
+    pending = {}
+    next_index = 0
+    
+    def start(index, future):
+        filename, content = images[index]
+        pending[asyncio.wrap_future(future)] = (index, filename, hashlib.sha256(content).hexdigest())
+        # Drop the upload bytes once queued; only in-flight images stay in memory
+        images[index] = (filename, None)
+    
+    start(0, first_future)
+    next_index = 1
+    
+    while pending or next_index < len(images):
+        while next_index < len(images) and len(pending) < MAX_BATCH_SIZE:
+            try:
+                future = submit_inference(images[next_index][1], model, priority, deadline)
+            except QueueFullError as e:
+                if pending:
+                    # Let this study's own work drain before retrying
+                    break
+                filename = images[next_index][0]
+                yield json.dumps({"index": next_index, "filename": filename,
+                                  "error": f"Server overloaded: {e}"}) + "\n"
+                next_index += 1
+                continue
+            start(next_index, future)
+            next_index += 1
+        
+        if not pending:
+            continue
+        
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            index, filename, image_sha256 = pending.pop(task)
+            try:
+                results = build_output(task.result(), filename, patient_metadata)
+                if include_explanation:
+                    results = add_clinical_explanation(results)
+                record_analysis(results, "/analyze/batch", model, image_sha256)
+                line = {"index": index, **results}
+            except DeadlineExceededError as e:
+                line = {"index": index, "filename": filename, "error": f"Deadline exceeded: {str(e)}"}
+            except Exception as e:
+                line = {"index": index, "filename": filename, "error": f"Analysis failed: {str(e)}"}
+            yield json.dumps(line) + "\n"
+
+@app.post("/analyze/batch")
+async def analyze_study(
+    request: Request,
+    images: List[UploadFile] = File(None),
+    archive: Optional[UploadFile] = File(None),
+    patient_id: str = Form(...),
+    age: Optional[int] = Form(None),
+    gender: Optional[str] = Form(None),
+    study_id: Optional[str] = Form(None),
+    clinical_indication: Optional[str] = Form(None),
+    include_explanation: bool = Form(True),
+    model_version: Optional[str] = Form(None),
+    priority: Optional[str] = Form(None),
+    deadline_ms: Optional[float] = Form(None)
+):
+    """
+    Analyze all views of a study in one request, streaming results as NDJSON
+    
+    Args:
+        images: One or more uploaded chest X-ray image files
+        archive: Alternatively (or additionally), a zip file of images
+        patient_id, age, gender, study_id, clinical_indication: Shared patient metadata
+        include_explanation: Whether to include LLM-generated clinical explanation
+        model_version: Registered model version for every view (or the X-Model-Version header)
+        priority, deadline_ms: Scheduling class and time budget for the whole study, as for /analyze
+    
+    Returns:
+        application/x-ndjson stream, one line per image in completion order. Each line
+        carries the image's "index" in the request plus the standard /analyze output,
+        or "filename" and "error" if that image failed.
+    """
+    model = None
+    try:
+        try:
+            priority, deadline = request_scheduling(request, priority, deadline_ms)
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"error": str(e)})
+        
+        study_images = []
+        for upload in images or []:
+            if not upload.content_type.startswith('image/'):
+                return JSONResponse(
+                    status_code=400,
+                    content={"error": f"Invalid file type for {upload.filename}. Please upload image files."}
+                )
+            study_images.append((upload.filename, await upload.read()))
+        
+        if archive is not None:
+            try:
+                study_images.extend(read_zip_images(await archive.read()))
+            except (zipfile.BadZipFile, ValueError) as e:
+                return JSONResponse(status_code=400, content={"error": f"Invalid archive: {str(e)}"})
+        
+        if not study_images:
+            return JSONResponse(status_code=400, content={"error": "No images provided."})
+        if len(study_images) > MAX_STUDY_IMAGES:
+            return JSONResponse(
+                status_code=413,
+                content={"error": f"Too many images ({len(study_images)}), maximum is {MAX_STUDY_IMAGES}."}
+            )
+        
+        patient_metadata = {
+            "patient_id": patient_id,
+            "age": age,
+            "gender": gender,
+            "study_id": study_id,
+            "clinical_indication": clinical_indication
+        }
+        
+        # Queue the first view before streaming starts so overload is a clean 503
+        model = await acquire_model(request, model_version)
+        first_future = submit_inference(study_images[0][1], model, priority, deadline)
+        
+        # The stream owns the model lease from here on
+        response = StreamingResponse(
+            stream_study(study_images, first_future, model, patient_metadata, include_explanation, priority, deadline),
+            media_type="application/x-ndjson",
+            headers={MODEL_VERSION_HEADER: model.version}
+        )
+        model = None
+        return response
+    
+    except QueueFullError as e:
+        return overloaded_response(e)
+    except DeadlineExceededError as e:
+        return deadline_response(e)
+    except ModelNotReadyError as e:
+        return not_ready_response(e)
+    except UnknownModelError as e:
+        return unknown_model_response(e)
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"error": f"Analysis failed: {str(e)}"}
+        )
+    finally:
+        if model is not None:
+            model.release()
 
 if __name__ == "__main__":
     print("Starting HealVision API server...")
@@ -0,0 +1,366 @@
+"""
+Append-only, hash-chained audit log of analyses.
+
+Records are stored in SQLite (WAL mode). Every record carries the hash of the
+record before it, so editing, deleting or reordering any record breaks the
+chain from that point on. UPDATE and DELETE are additionally refused by
+triggers. A truncated tail cannot be detected from the log alone; keep the
+head hash reported by the verifier somewhere else to detect that too.
+
+append() only queues the record, so requests never wait on the disk. A
+writer thread commits queued records in groups: one transaction (and one
+fsync) per group, with a group closing after max_batch_size records or
+max_delay_ms after its first record. The queue is bounded: once max_backlog
+records are waiting, or if the writer thread has died, append() raises
+AuditLogUnavailableError instead of queueing records that will never be written.
+
+Verify a log with:
+    python audit_log.py logs/audit.sqlite3 [--workers N] [--expect-head HASH]
+"""
+import argparse
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+from metrics import counter, gauge, histogram
+
+GENESIS_HASH = "0" * 64
+
+AUDIT_RECORDS = counter("healvision_audit_records_total", "Audit records committed or lost to write errors",
+                        ("outcome",))
+AUDIT_BACKLOG = gauge("healvision_audit_backlog", "Audit records queued but not yet committed")
+AUDIT_COMMIT_SECONDS = histogram("healvision_audit_commit_seconds", "Time to write and fsync one group of audit records")
+AUDIT_GROUP_SIZE = histogram("healvision_audit_group_size", "Audit records per committed group",
+                             buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS audit_log (
+    seq INTEGER PRIMARY KEY,
+    record TEXT NOT NULL,
+    prev_hash TEXT NOT NULL,
+    record_hash TEXT NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS audit_log_no_update BEFORE UPDATE ON audit_log
+BEGIN SELECT RAISE(ABORT, 'audit log is append-only'); END;
+CREATE TRIGGER IF NOT EXISTS audit_log_no_delete BEFORE DELETE ON audit_log
+BEGIN SELECT RAISE(ABORT, 'audit log is append-only'); END;
+"""
+
+
+class AuditLogUnavailableError(RuntimeError):
+    """Raised when a record cannot be queued: the backlog is full or the writer has stopped"""
+
+
+def chain_hash(seq, prev_hash, record):
+    """
+    Hash of a record (its canonical JSON text) linked to its position and predecessor
+    """
+    return hashlib.sha256(f"{seq}:{prev_hash}:{record}".encode()).hexdigest()
+
+
+def canonical_json(record):
+    return json.dumps(record, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+class AuditLog:
+    def __init__(self, path, max_batch_size=512, max_delay_ms=50.0, max_backlog=100000):
+        """
+        Open (or create) the log and start its writer thread
+
+        Args:
+            path: SQLite database file
+            max_batch_size: Most records committed in one transaction
+            max_delay_ms: How long the first record of a group may wait for others
+            max_backlog: Most records queued but not yet committed before append() refuses more
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        if max_backlog < 1:
+            raise ValueError("max_backlog must be at least 1")
+
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_batch_size = max_batch_size
+        self.max_delay_ms = max_delay_ms
+        self.max_backlog = max_backlog
+
+        self._queue = queue.Queue(max_backlog)
+        self._closed = False
+        self._stats_lock = threading.Lock()
+        self.committed = 0
+        self.failed = 0
+        self.groups = 0
+
+        # Open here so a bad path fails at startup; the connection is then only used by the writer
+        self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # FULL: every group commit is fsynced before its records are reported durable
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.executescript(SCHEMA)
+        row = self._conn.execute("SELECT seq, record_hash FROM audit_log ORDER BY seq DESC LIMIT 1").fetchone()
+        self._last_seq, self._last_hash = row if row else (0, GENESIS_HASH)
+
+        self._writer = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self._writer.start()
+
+    def append(self, record):
+        """
+        Queue a record (JSON-serializable dict) and return a Future of its (seq, record_hash)
+
+        The Future resolves once the record's group is committed and fsynced.
+
+        Raises:
+            AuditLogUnavailableError: If max_backlog records are already queued or the writer has stopped
+        """
+        if self._closed:
+            raise RuntimeError("AuditLog is closed")
+        if not self._writer.is_alive():
+            raise AuditLogUnavailableError("Audit log writer has stopped")
+
+        record = {**record, "recorded_at": datetime.utcnow().isoformat()}
+        future = Future()
+        # Serialize now: the caller may go on to mutate the dicts it passed in
+        try:
+            self._queue.put_nowait((canonical_json(record), future))
+        except queue.Full:
+            raise AuditLogUnavailableError(f"Audit log backlog is full ({self.max_backlog} records)")
+        AUDIT_BACKLOG.inc()
+        return future
+
+    def close(self, timeout=None):
+        """
+        Stop accepting records, commit everything already queued and close the database
+        """
+        if not self._closed:
+            self._closed = True
+            # A dead writer would never drain a full queue
+            if self._writer.is_alive():
+                self._queue.put(None)
+        self._writer.join(timeout)
+        if not self._writer.is_alive():
+            self._conn.close()
+
+    def head(self):
+        """
+        Sequence number and hash of the last committed record
+        """
+        with self._stats_lock:
+            return {"seq": self._last_seq, "record_hash": self._last_hash}
+
+    def stats(self):
+        with self._stats_lock:
+            groups = self.groups
+            committed = self.committed
+            return {
+                "path": str(self.path),
+                "committed": committed,
+                "failed": self.failed,
+                "groups": groups,
+                "mean_group_size": round(committed / groups, 3) if groups else 0.0,
+                "backlog": self._queue.qsize(),
+                "head": {"seq": self._last_seq, "record_hash": self._last_hash}
+            }
+
+    def _collect(self):
+        """
+        Block for the first record, then gather more until the window closes or the group is full
+
+        Returns the group and whether the shutdown marker was received.
+        """
+        first = self._queue.get()
+        if first is None:
+            return [], True
+
+        group = [first]
+        deadline = time.monotonic() + self.max_delay_ms / 1000.0
+        while len(group) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                # Past the deadline, still take whatever is already queued
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return group, True
+            group.append(item)
+
+        return group, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            group = []
+            try:
+                group, stop = self._collect()
+                if group:
+                    self._commit(group)
+            except Exception as e:
+                # Never let one group take the writer down: fail its records and carry on
+                self._fail([item for item in group if not item[1].done()], e)
+
+    def _fail(self, group, error):
+        """
+        Count a group's records as lost and fail their Futures; the chain head is left unchanged
+        """
+        print(f"Audit log write failed, {len(group)} records lost: {type(error).__name__}: {error}")
+        with self._stats_lock:
+            self.failed += len(group)
+        AUDIT_RECORDS.inc(len(group), outcome="failed")
+        AUDIT_BACKLOG.dec(len(group))
+        for _, future in group:
+            future.set_exception(error)
+
+    def _commit(self, group):
+        seq, prev_hash = self._last_seq, self._last_hash
+        rows = []
+        for record, _ in group:
+            seq += 1
+            record_hash = chain_hash(seq, prev_hash, record)
+            rows.append((seq, record, prev_hash, record_hash))
+            prev_hash = record_hash
+
+        start = time.perf_counter()
+        try:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany(
+                "INSERT INTO audit_log (seq, record, prev_hash, record_hash) VALUES (?, ?, ?, ?)", rows)
+            self._conn.execute("COMMIT")
+        except Exception as e:
+            try:
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            # The chain head is unchanged, so the next group links to the last committed record
+            self._fail(group, e)
+            return
+
+        AUDIT_COMMIT_SECONDS.observe(time.perf_counter() - start)
+        AUDIT_GROUP_SIZE.observe(len(group))
+        AUDIT_RECORDS.inc(len(group), outcome="committed")
+        AUDIT_BACKLOG.dec(len(group))
+        with self._stats_lock:
+            self._last_seq, self._last_hash = seq, prev_hash
+            self.committed += len(group)
+            self.groups += 1
+        for (_, future), (seq, _, _, record_hash) in zip(group, rows):
+            future.set_result((seq, record_hash))
+
+
+def _connect_readonly(path):
+    return sqlite3.connect(f"{Path(path).resolve().as_uri()}?mode=ro", uri=True)
+
+
+def _verify_range(path, first, last, max_errors=100):
+    """
+    Check records first..last; the link into `first` is checked against the stored record before it
+    """
+    conn = _connect_readonly(path)
+    try:
+        row = conn.execute("SELECT record_hash FROM audit_log WHERE seq = ?", (first - 1,)).fetchone()
+        expected_prev = row[0] if row else GENESIS_HASH
+        expected_seq = first
+        errors = []
+        count = 0
+
+        cursor = conn.execute(
+            "SELECT seq, record, prev_hash, record_hash FROM audit_log WHERE seq BETWEEN ? AND ? ORDER BY seq",
+            (first, last))
+        sha256 = hashlib.sha256
+        while True:
+            rows = cursor.fetchmany(10000)
+            if not rows:
+                break
+            for seq, record, prev_hash, record_hash in rows:
+                count += 1
+                if len(errors) < max_errors:
+                    if seq != expected_seq:
+                        errors.append({"seq": seq, "error": f"records {expected_seq}..{seq - 1} missing"})
+                    if prev_hash != expected_prev:
+                        errors.append({"seq": seq, "error": "prev_hash does not match the previous record"})
+                # chain_hash() inlined: this loop runs once per record
+                if sha256(f"{seq}:{prev_hash}:{record}".encode()).hexdigest() != record_hash:
+                    if len(errors) < max_errors:
+                        errors.append({"seq": seq, "error": "record_hash does not match the record"})
+                expected_prev = record_hash
+                expected_seq = seq + 1
+        if expected_seq <= last and len(errors) < max_errors:
+            errors.append({"seq": expected_seq, "error": f"records {expected_seq}..{last} missing"})
+        return count, errors
+    finally:
+        conn.close()
+
+
+def verify_audit_log(path, workers=None, chunk_size=250000, expect_head=None, max_errors=100):
+    """
+    Validate the whole hash chain of an audit log, in parallel chunks of sequence numbers
+
+    Args:
+        path: SQLite database written by AuditLog
+        workers: Verifier processes (default: CPU count; 1 verifies in this process)
+        chunk_size: Records per verification task
+        expect_head: Optional record_hash the last record must have (detects a truncated tail)
+        max_errors: Most errors reported per chunk
+
+    Returns:
+        Dict with "valid", "records", "head" and a list of "errors"
+    """
+    if not Path(path).exists():
+        raise FileNotFoundError(f"Audit log not found at {path}")
+
+    conn = _connect_readonly(path)
+    try:
+        first, last = conn.execute("SELECT MIN(seq), MAX(seq) FROM audit_log").fetchone()
+        head = conn.execute("SELECT seq, record_hash FROM audit_log ORDER BY seq DESC LIMIT 1").fetchone()
+    finally:
+        conn.close()
+
+    start = time.perf_counter()
+    errors = []
+    records = 0
+    if first is not None:
+        if first != 1:
+            errors.append({"seq": 1, "error": f"records 1..{first - 1} missing"})
+        ranges = [(lo, min(lo + chunk_size - 1, last)) for lo in range(first, last + 1, chunk_size)]
+        workers = min(workers or os.cpu_count() or 1, len(ranges))
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                outcomes = list(pool.map(_verify_range, [path] * len(ranges), *zip(*ranges),
+                                         [max_errors] * len(ranges)))
+        else:
+            outcomes = [_verify_range(path, lo, hi, max_errors) for lo, hi in ranges]
+        for count, chunk_errors in outcomes:
+            records += count
+            errors.extend(chunk_errors)
+
+    head = {"seq": head[0], "record_hash": head[1]} if head else {"seq": 0, "record_hash": GENESIS_HASH}
+    if expect_head is not None and head["record_hash"] != expect_head:
+        errors.append({"seq": head["seq"], "error": "last record does not match the expected head hash"})
+
+    return {
+        "valid": not errors,
+        "records": records,
+        "head": head,
+        "seconds": round(time.perf_counter() - start, 3),
+        "errors": errors
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verify the hash chain of a HealVision audit log")
+    parser.add_argument('path', help="Audit log database (HEALVISION_AUDIT_LOG)")
+    parser.add_argument('--workers', type=int, default=None, help="Verifier processes (default: CPU count)")
+    parser.add_argument('--expect-head', default=None, help="record_hash the last record must have")
+    args = parser.parse_args()
+
+    report = verify_audit_log(args.path, workers=args.workers, expect_head=args.expect_head)
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report["valid"] else 1)
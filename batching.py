@@ -0,0 +1,361 @@
+"""
+Dynamic micro-batching for the MedicalDetector.
+
+Requests that arrive within a short window are collected (up to a maximum
+batch size) and run through a single batched YOLO forward pass. Each caller
+gets its own detection payload back through a Future.
+
+Inference runs on dedicated worker threads, one per detector replica, so it
+never blocks the asyncio event loop. The pending queue is bounded: once it is
+full, submit() fails fast with QueueFullError instead of letting latency grow.
+
+Requests belong to a priority class (stat, urgent or routine). Each class has
+its own queue and queue bound, so a routine backfill can never fill the queue
+in front of a STAT study. Workers take requests across the classes by weighted
+fair queuing: while several classes are backlogged, each gets forward pass
+slots in proportion to its weight, and no class starves. A request may carry
+a deadline; one that has passed when the request reaches the front is failed
+with DeadlineExceededError instead of being run.
+"""
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+
+import numpy as np
+
+from metrics import counter, current_trace, histogram, record_stage
+
+BATCH_SIZE = histogram("healvision_batch_size", "Images per batched forward pass",
+                       buckets=(1, 2, 4, 8, 16, 32, 64))
+QUEUE_WAIT = histogram("healvision_queue_wait_seconds", "Time from submit until the forward pass starts",
+                       ("priority",))
+SCHEDULED_REQUESTS = counter("healvision_scheduled_requests_total",
+                             "Requests run, rejected (queue full) or dropped past their deadline",
+                             ("priority", "outcome"))
+
+# Share of forward pass slots each class gets while several are backlogged
+DEFAULT_PRIORITY_WEIGHTS = {"stat": 16, "urgent": 4, "routine": 1}
+DEFAULT_PRIORITY = "routine"
+
+# Recent queue waits kept per class for the percentiles in stats()
+WAIT_SAMPLES = 1000
+
+
+class QueueFullError(Exception):
+    """Raised when the inference queue is at capacity and the request is rejected"""
+
+
+class DeadlineExceededError(Exception):
+    """Raised when a request's deadline passes before its inference starts"""
+
+
+class FairQueue:
+    """
+    Per-class FIFO queues served by weighted fair queuing
+
+    Each request gets a virtual finish time: its class's previous finish time (or
+    the current virtual time, if the class was idle) plus 1 / weight. get() always
+    returns the queued request with the smallest finish time, so a class with
+    weight 16 is served 16 times as often as one with weight 1 while both are
+    backlogged, and an idle class cannot bank credit for later.
+    """
+
+    def __init__(self, weights):
+        self.weights = dict(weights)
+        self._queues = {name: deque() for name in self.weights}
+        self._last_finish = dict.fromkeys(self.weights, 0.0)
+        self._virtual_time = 0.0
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def put(self, priority, item):
+        with self._cond:
+            finish = max(self._virtual_time, self._last_finish[priority]) + 1.0 / self.weights[priority]
+            self._last_finish[priority] = finish
+            self._queues[priority].append((finish, item))
+            self._size += 1
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """
+        Next request by finish time; None once closed and drained
+
+        Raises queue.Empty if nothing arrives within timeout seconds.
+        """
+        with self._cond:
+            if timeout is None:
+                while not self._size and not self._closed:
+                    self._cond.wait()
+            elif timeout > 0:
+                end = time.monotonic() + timeout
+                while not self._size and not self._closed:
+                    remaining = end - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            if not self._size:
+                if self._closed:
+                    return None
+                raise queue.Empty
+
+            heads = [(queue[0][0], name) for name, queue in self._queues.items() if queue]
+            finish, name = min(heads)
+            self._virtual_time = finish
+            self._size -= 1
+            return self._queues[name].popleft()[1]
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class BatchScheduler:
+    def __init__(self, detectors, max_batch_size=8, max_delay_ms=10.0, max_queue_size=64, priority_weights=None):
+        """
+        Start one scheduler worker thread per detector replica
+
+        Args:
+            detectors: A detector or list of detector replicas exposing detect_batch(images)
+            max_batch_size: Largest number of images run in one forward pass
+            max_delay_ms: How long the first request of a batch may wait for others
+            max_queue_size: Pending requests allowed per priority class before new ones are rejected
+            priority_weights: Priority class -> weighted fair queuing weight (default DEFAULT_PRIORITY_WEIGHTS)
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        if max_queue_size < 1:
+            raise ValueError("max_queue_size must be at least 1")
+        if not isinstance(detectors, (list, tuple)):
+            detectors = [detectors]
+        if not detectors:
+            raise ValueError("At least one detector replica is required")
+        priority_weights = dict(priority_weights or DEFAULT_PRIORITY_WEIGHTS)
+        if DEFAULT_PRIORITY not in priority_weights:
+            raise ValueError(f"priority_weights must include the default class '{DEFAULT_PRIORITY}'")
+        if any(weight <= 0 for weight in priority_weights.values()):
+            raise ValueError("Priority weights must be positive")
+
+        self.detectors = list(detectors)
+        self.max_batch_size = max_batch_size
+        self.max_delay_ms = max_delay_ms
+        self.max_queue_size = max_queue_size
+        self.priority_weights = priority_weights
+
+        self._queue = FairQueue(priority_weights)
+        self._pending = dict.fromkeys(priority_weights, 0)
+        self._closed = False
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._rejected = Counter()
+        self._expired = Counter()
+        self._served = Counter()
+        self._waits = {priority: deque(maxlen=WAIT_SAMPLES) for priority in priority_weights}
+
+        # Each worker owns one replica; YOLO predictors are not safe to share across threads
+        self._workers = [
+            threading.Thread(target=self._run, args=(detector,), name=f"batch-worker-{i}", daemon=True)
+            for i, detector in enumerate(self.detectors)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def detector(self):
+        return self.detectors[0]
+
+    def submit(self, image, priority=DEFAULT_PRIORITY, deadline=None):
+        """
+        Queue an image for inference and return a Future resolving to its detection payload
+
+        The image may be a file path, encoded image bytes or a decoded array. Once it
+        has run, the Future carries stage_timings: the request's queue wait followed by
+        the (stage, seconds) samples of its batch, for the caller's request trace.
+
+        Args:
+            priority: Priority class, one of priority_weights
+            deadline: Optional time.monotonic() value; if it passes before the
+                      forward pass starts, the Future fails with DeadlineExceededError
+
+        Raises:
+            ValueError: For an unknown priority class
+            QueueFullError: If max_queue_size requests of this class are already pending
+        """
+        if self._closed:
+            raise RuntimeError("BatchScheduler is closed")
+        if priority not in self.priority_weights:
+            raise ValueError(f"Unknown priority '{priority}', expected one of {tuple(self.priority_weights)}")
+
+        with self._stats_lock:
+            if self._pending[priority] >= self.max_queue_size:
+                self._rejected[priority] += 1
+                SCHEDULED_REQUESTS.inc(priority=priority, outcome="rejected")
+                raise QueueFullError(
+                    f"Inference queue is full ({self.max_queue_size} pending {priority} requests)")
+            self._pending[priority] += 1
+
+        future = Future()
+        self._queue.put(priority, (image, future, time.perf_counter(), priority, deadline))
+        return future
+
+    def queue_depth(self, priority=None):
+        """
+        Number of requests waiting for or running in a forward pass (of one class, or all)
+        """
+        with self._stats_lock:
+            if priority is None:
+                return sum(self._pending.values())
+            return self._pending[priority]
+
+    def close(self, timeout=None):
+        """
+        Stop accepting work, finish what is already queued and stop the workers
+        """
+        if not self._closed:
+            self._closed = True
+            self._queue.close()
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def stats(self):
+        """
+        Report the batch sizes actually used so far
+        """
+        with self._stats_lock:
+            batch_sizes = dict(sorted(self._batch_sizes.items()))
+            priorities = {}
+            for priority, weight in self.priority_weights.items():
+                waits = np.array(self._waits[priority]) * 1000
+                priorities[priority] = {
+                    "weight": weight,
+                    "queue_depth": self._pending[priority],
+                    "served": self._served[priority],
+                    "rejected": self._rejected[priority],
+                    "expired": self._expired[priority],
+                    "queue_wait_ms": {
+                        "p50": round(float(np.percentile(waits, 50)), 3),
+                        "p99": round(float(np.percentile(waits, 99)), 3)
+                    } if len(waits) else None
+                }
+
+        batches = sum(batch_sizes.values())
+        requests = sum(size * count for size, count in batch_sizes.items())
+        return {
+            "workers": len(self.detectors),
+            "max_batch_size": self.max_batch_size,
+            "max_delay_ms": self.max_delay_ms,
+            "max_queue_size": self.max_queue_size,
+            "queue_depth": self.queue_depth(),
+            "rejected": sum(stats["rejected"] for stats in priorities.values()),
+            "expired": sum(stats["expired"] for stats in priorities.values()),
+            "batches": batches,
+            "requests": requests,
+            "mean_batch_size": round(requests / batches, 3) if batches else 0.0,
+            "batch_sizes": batch_sizes,
+            "priorities": priorities
+        }
+
+    def _take(self, timeout=None):
+        """
+        Next request to run, failing any whose deadline has already passed on the way
+
+        Returns None once the scheduler is closed and drained; raises queue.Empty on timeout.
+        """
+        while True:
+            item = self._queue.get(timeout)
+            if item is None:
+                return None
+            _, future, _, priority, deadline = item
+            if deadline is None or time.monotonic() < deadline:
+                return item
+            # Expired: never spend compute on a result nobody can use
+            with self._stats_lock:
+                self._pending[priority] -= 1
+                self._expired[priority] += 1
+            SCHEDULED_REQUESTS.inc(priority=priority, outcome="expired")
+            if future.set_running_or_notify_cancel():
+                future.set_exception(DeadlineExceededError(f"Deadline passed while queued ({priority})"))
+
+    def _collect(self):
+        """
+        Block for the first request, then gather more until the window closes or the batch is full
+
+        Returns the batch and whether this worker received its shutdown marker.
+        """
+        first = self._take()
+        if first is None:
+            return [], True
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._take(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+
+        return batch, False
+
+    def _run(self, detector):
+        stop = False
+        while not stop:
+            batch, stop = self._collect()
+            if batch:
+                self._process(detector, batch)
+
+    def _process(self, detector, batch):
+        collected = Counter(priority for _, _, _, priority, _ in batch)
+        try:
+            # Drop requests whose callers have already gone away
+            batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+            if not batch:
+                return
+
+            now = time.perf_counter()
+            with self._stats_lock:
+                self._batch_sizes[len(batch)] += 1
+                for _, _, enqueued_at, priority, _ in batch:
+                    self._served[priority] += 1
+                    self._waits[priority].append(now - enqueued_at)
+            for _, _, enqueued_at, priority, _ in batch:
+                record_stage("queue_wait", now - enqueued_at)
+                QUEUE_WAIT.observe(now - enqueued_at, priority=priority)
+                SCHEDULED_REQUESTS.inc(priority=priority, outcome="served")
+            BATCH_SIZE.observe(len(batch))
+
+            # Stages the detector records on this thread (or relays from its replica) land in the batch trace
+            trace = []
+            error = None
+            token = current_trace.set(trace)
+            try:
+                payloads = detector.detect_batch([image for image, _, _, _, _ in batch])
+            except Exception as e:
+                error = e
+            finally:
+                current_trace.reset(token)
+
+            # Hand the timings back with each result; the request handler merges them into its own trace
+            for _, future, enqueued_at, _, _ in batch:
+                future.batch_timings = trace
+                future.stage_timings = [("queue_wait", now - enqueued_at)] + trace
+
+            if error is not None:
+                for _, future, _, _, _ in batch:
+                    future.set_exception(error)
+                return
+
+            for (_, future, _, _, _), payload in zip(batch, payloads):
+                future.set_result(payload)
+        finally:
+            with self._stats_lock:
+                for priority, count in collected.items():
+                    self._pending[priority] -= count
@@ -0,0 +1,443 @@
+"""
+Reproducible latency/throughput benchmark for the lung opacity detector.
+
+Inputs are synthetic chest X-rays from generate_sample_data at several
+resolutions (fixed seed). The suite measures:
+- MedicalDetector cold start (fresh processes) and warm predict() latency
+  (p50/p95/p99)
+- batched images/s across batch sizes and torch thread counts
+- peak RSS
+- end-to-end /analyze throughput under concurrent load against an in-process
+  uvicorn server
+- ingestion of 16-bit grayscale frames as a PACS bridge holds them: windowing
+  plus JPEG encode/decode against the raw pixel path, in isolation and
+  through /analyze/raw
+
+Results are written as JSON and compared against the committed baseline,
+benchmarks/baseline.json; the run fails when any metric regresses by more
+than the threshold, or when there is no baseline to compare against.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from generate_sample_data import create_synthetic_chest_xray
+
+DEFAULT_BASELINE = 'benchmarks/baseline.json'
+DEFAULT_THRESHOLD = 0.10
+
+# Metric name suffixes and whether larger values are better
+METRIC_DIRECTIONS = {
+    "_ms": False,
+    "_mb": False,
+    "_per_sec": True
+}
+
+
+# 12-bit pixels stored in uint16, windowed over their full range
+RAW_WINDOW = {"window_center": 2048.0, "window_width": 4096.0}
+
+
+def make_inputs(resolutions, count=4, seed=0):
+    """
+    JPEG-encoded synthetic X-rays per resolution, identical on every run
+    """
+    inputs = {}
+    for size in resolutions:
+        images = []
+        for i in range(count):
+            rng = np.random.default_rng([seed, size, i])
+            img, _ = create_synthetic_chest_xray(width=size, height=size, has_opacity=True, rng=rng)
+            ok, encoded = cv2.imencode('.jpg', img)
+            images.append(encoded.tobytes())
+        inputs[size] = images
+    return inputs
+
+
+def make_raw_inputs(resolutions, count=4, seed=0):
+    """
+    The same synthetic X-rays as make_inputs, as 12-bit uint16 pixel arrays
+    """
+    inputs = {}
+    for size in resolutions:
+        frames = []
+        for i in range(count):
+            rng = np.random.default_rng([seed, size, i])
+            img, _ = create_synthetic_chest_xray(width=size, height=size, has_opacity=True, rng=rng)
+            frames.append(img.astype(np.uint16) * 16)
+        inputs[size] = frames
+    return inputs
+
+
+def percentiles(samples_ms):
+    samples = np.array(samples_ms)
+    return {
+        "p50_ms": float(np.percentile(samples, 50)),
+        "p95_ms": float(np.percentile(samples, 95)),
+        "p99_ms": float(np.percentile(samples, 99)),
+        "mean_ms": float(samples.mean())
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def _cold_probe(model_path, image):
+    """
+    Import, model load and first predict() in a fresh interpreter
+    """
+    start = time.perf_counter()
+    from inference import MedicalDetector
+
+    detector = MedicalDetector(model_path)
+    loaded = time.perf_counter()
+    detector.predict(image)
+    done = time.perf_counter()
+    return (loaded - start) * 1000, (done - loaded) * 1000, (done - start) * 1000
+
+
+def bench_cold_start(model_path, image, runs):
+    """
+    Cold latency over several freshly spawned processes, so nothing is warm or cached
+    """
+    context = multiprocessing.get_context('spawn')
+    load, first, total = [], [], []
+    for _ in range(runs):
+        with context.Pool(1) as pool:
+            load_ms, first_ms, total_ms = pool.apply(_cold_probe, (model_path, image))
+        load.append(load_ms)
+        first.append(first_ms)
+        total.append(total_ms)
+
+    return {
+        "runs": runs,
+        "load": percentiles(load),
+        "first_predict": percentiles(first),
+        "total": percentiles(total)
+    }
+
+
+def bench_warm_latency(detector, inputs, repeats):
+    """
+    predict() latency per resolution, including in-memory decode
+    """
+    results = {}
+    for size, images in inputs.items():
+        detector.detect_batch(images[:1])
+        samples = []
+        for i in range(repeats):
+            start = time.perf_counter()
+            detector.predict(images[i % len(images)])
+            samples.append((time.perf_counter() - start) * 1000)
+        results[str(size)] = percentiles(samples)
+    return results
+
+
+def bench_throughput(detector, images, batch_sizes, thread_counts, repeats):
+    """
+    Images per second of detect_batch on pre-decoded arrays for each (threads, batch size)
+    """
+    import torch
+    from inference import load_image
+
+    arrays = [load_image(image) for image in images]
+    original_threads = torch.get_num_threads()
+    results = {}
+    try:
+        for threads in thread_counts:
+            torch.set_num_threads(threads)
+            for batch_size in batch_sizes:
+                batch = [arrays[i % len(arrays)] for i in range(batch_size)]
+                detector.detect_batch(batch)
+
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    detector.detect_batch(batch)
+                elapsed = time.perf_counter() - start
+                results[f"threads_{threads}_batch_{batch_size}"] = {
+                    "images_per_sec": batch_size * repeats / elapsed
+                }
+    finally:
+        torch.set_num_threads(original_threads)
+    return results
+
+
+def bench_ingest(raw_inputs, repeats):
+    """
+    Cost of getting a 16-bit frame into the detector, per resolution (medians)
+
+    JPEG path: window to 8 bits and encode on the client, decode on the server.
+    Raw path: send the buffer as is, wrap and window it on the server.
+    """
+    from inference import load_image, load_raw_pixels
+
+    results = {}
+    for size, frames in raw_inputs.items():
+        encode, decode, raw = [], [], []
+        jpeg_bytes = 0
+        for i in range(repeats):
+            frame = frames[i % len(frames)]
+            buffer = frame.tobytes()
+
+            start = time.perf_counter()
+            windowed = load_raw_pixels(buffer, 'uint16', size, size, **RAW_WINDOW)
+            encoded = cv2.imencode('.jpg', windowed)[1].tobytes()
+            encode.append((time.perf_counter() - start) * 1000)
+            jpeg_bytes = len(encoded)
+
+            start = time.perf_counter()
+            load_image(encoded)
+            decode.append((time.perf_counter() - start) * 1000)
+
+            start = time.perf_counter()
+            load_raw_pixels(buffer, 'uint16', size, size, **RAW_WINDOW)
+            raw.append((time.perf_counter() - start) * 1000)
+
+        results[str(size)] = {
+            "jpeg_client_ms": float(np.median(encode)),
+            "jpeg_server_ms": float(np.median(decode)),
+            "jpeg_total_ms": float(np.median(encode) + np.median(decode)),
+            "raw_server_ms": float(np.median(raw)),
+            "jpeg_upload_kb": jpeg_bytes / 1024,
+            "raw_upload_kb": frames[0].nbytes / 1024
+        }
+    return results
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def bench_api(model_path, images, concurrency, num_requests, raw_frames=None):
+    """
+    /analyze throughput and latency under concurrent clients against in-process uvicorn
+
+    With raw_frames (uint16 arrays of the same images), the same load is also run
+    against /analyze/raw and reported under "raw".
+    """
+    import requests
+    import uvicorn
+
+    # Every benchmark request must reach the model
+    os.environ["HEALVISION_CACHE_MAX_BYTES"] = "0"
+    os.environ["HEALVISION_MODEL_PATH"] = model_path
+    # Keep auditing and result storage on (they are part of the request path) but out of the real files
+    scratch = tempfile.mkdtemp(prefix="healvision-bench-")
+    os.environ["HEALVISION_AUDIT_LOG"] = os.path.join(scratch, "audit.sqlite3")
+    os.environ["HEALVISION_RESULT_STORE"] = os.path.join(scratch, "results.sqlite3")
+    import api
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(api.app, host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    # The model loads and warms up in the background after the server binds
+    while requests.get(f"http://127.0.0.1:{port}/ready").status_code != 200:
+        if not thread.is_alive():
+            raise RuntimeError("API server exited before becoming ready")
+        time.sleep(0.1)
+
+    url = f"http://127.0.0.1:{port}/analyze"
+
+    def call(i):
+        start = time.perf_counter()
+        response = requests.post(
+            url,
+            files={"image": (f"bench_{i}.jpg", images[i % len(images)], "image/jpeg")},
+            data={"patient_id": f"BENCH{i:05d}", "include_explanation": "false"}
+        )
+        return response.status_code, (time.perf_counter() - start) * 1000
+
+    def call_raw(i):
+        frame = raw_frames[i % len(raw_frames)]
+        start = time.perf_counter()
+        response = requests.post(
+            f"{url}/raw",
+            data=frame.tobytes(),
+            params={"dtype": "uint16", "width": frame.shape[1], "height": frame.shape[0], **RAW_WINDOW,
+                    "patient_id": f"BENCH{i:05d}", "include_explanation": "false"},
+            headers={"Content-Type": "application/octet-stream"}
+        )
+        return response.status_code, (time.perf_counter() - start) * 1000
+
+    def run_load(function):
+        function(0)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            outcomes = list(pool.map(function, range(num_requests)))
+        elapsed = time.perf_counter() - start
+
+        ok = [latency for status, latency in outcomes if status == 200]
+        return {
+            "concurrency": concurrency,
+            "requests": num_requests,
+            "succeeded": len(ok),
+            "rejected": sum(1 for status, _ in outcomes if status == 503),
+            "requests_per_sec": len(ok) / elapsed,
+            **(percentiles(ok) if ok else {})
+        }
+
+    try:
+        results = run_load(call)
+        if raw_frames:
+            results["raw"] = run_load(call_raw)
+    finally:
+        server.should_exit = True
+        thread.join(timeout=30)
+    return results
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """
+    Regressions beyond threshold as (metric, baseline, current, relative change)
+    """
+    current = flatten(results["metrics"])
+    reference = flatten(baseline["metrics"])
+    regressions = []
+
+    for name, base_value in reference.items():
+        higher_is_better = next(
+            (better for suffix, better in METRIC_DIRECTIONS.items() if name.endswith(suffix)), None
+        )
+        if higher_is_better is None or name not in current or not base_value:
+            continue
+
+        change = (current[name] - base_value) / base_value
+        if (higher_is_better and change < -threshold) or (not higher_is_better and change > threshold):
+            regressions.append((name, base_value, current[name], change))
+    return regressions
+
+
+def run_benchmarks(model_path, resolutions, batch_sizes, thread_counts, repeats, concurrency,
+                   num_requests, cold_runs=3, skip_api=False, tiled=False):
+    from inference import MedicalDetector
+
+    inputs = make_inputs(resolutions)
+    raw_inputs = make_raw_inputs(resolutions)
+    reference_images = inputs[resolutions[0]]
+
+    cold = bench_cold_start(model_path, reference_images[0], cold_runs)
+    detector = MedicalDetector(model_path)
+    metrics = {
+        "cold_start": cold,
+        "warm_latency": bench_warm_latency(detector, inputs, repeats),
+        "throughput": bench_throughput(detector, reference_images, batch_sizes, thread_counts, max(1, repeats // 4)),
+        "ingest": bench_ingest(raw_inputs, repeats)
+    }
+    if tiled:
+        # Tiled latency grows with the tile count, so fewer repeats
+        tiled_detector = MedicalDetector(model_path, tiling=True)
+        metrics["tiled_latency"] = bench_warm_latency(tiled_detector, inputs, max(1, repeats // 4))
+    if not skip_api:
+        metrics["api"] = bench_api(model_path, reference_images, concurrency, num_requests,
+                                   raw_frames=raw_inputs[resolutions[0]])
+    metrics["memory"] = {"peak_rss_mb": peak_rss_mb()}
+
+    return {
+        "timestamp": datetime.utcnow().isoformat(),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count()
+        },
+        "config": {
+            "model": model_path,
+            "resolutions": resolutions,
+            "batch_sizes": batch_sizes,
+            "thread_counts": thread_counts,
+            "repeats": repeats,
+            "cold_runs": cold_runs,
+            "concurrency": concurrency,
+            "requests": num_requests,
+            "tiled": tiled
+        },
+        "metrics": metrics
+    }
+
+
+if __name__ == "__main__":
+    from inference import DEFAULT_MODEL_PATH
+
+    parser = argparse.ArgumentParser(description="Latency/throughput benchmark with regression check")
+    parser.add_argument('--model', default=DEFAULT_MODEL_PATH)
+    parser.add_argument('--resolutions', type=int, nargs='+', default=[640, 1024, 2048])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--threads', type=int, nargs='+', default=sorted({1, max(1, (os.cpu_count() or 1) // 2), os.cpu_count() or 1}))
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--cold-runs', type=int, default=3, help="Fresh processes for the cold start measurement")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--skip-api', action='store_true', help="Skip the end-to-end /analyze load test")
+    parser.add_argument('--tiled', action='store_true', help="Also measure tiled inference latency per resolution")
+    parser.add_argument('--output', default=None, help="Results file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="Relative regression that fails the run (0.10 = 10%%)")
+    parser.add_argument('--update-baseline', action='store_true', help="Write these results as the new baseline")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.model, args.resolutions, args.batch_sizes, args.threads, args.repeats,
+                             args.concurrency, args.requests, args.cold_runs, args.skip_api, args.tiled)
+
+    output = Path(args.output or f"benchmarks/results/{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to: {output}")
+    print(json.dumps(results["metrics"], indent=2))
+
+    if args.update_baseline:
+        Path(args.baseline).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline updated: {args.baseline}")
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        # A check without a reference must not pass silently
+        print(f"No baseline at {args.baseline}; run with --update-baseline on the reference machine")
+        sys.exit(1)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare_to_baseline(results, baseline, args.threshold)
+
+    print(f"\n=== REGRESSION CHECK (threshold {args.threshold:.0%}) ===")
+    if not regressions:
+        print("No regressions against baseline")
+        sys.exit(0)
+    for name, base_value, value, change in regressions:
+        print(f"REGRESSION {name}: {base_value:.2f} -> {value:.2f} ({change:+.1%})")
+    sys.exit(1)
@@ -0,0 +1,354 @@
+"""
+Compress a trained detector into a faster student with knowledge distillation and structured pruning.
+
+The student is the teacher's own architecture with fewer channels (--width)
+and/or fewer C2f bottlenecks (--depth), e.g. --width 0.5 turns the trained
+yolov8n into a model with half of every layer's channels. It starts either
+- from scratch, or
+- with --prune, from the teacher itself: every convolution keeps the output
+  channels with the largest BatchNorm scale |gamma| (structured L1 channel
+  pruning) and the matching input channels of whatever reads them, through
+  C2f splits, residual bottlenecks, SPPF, Concat and the Detect head.
+
+It is then trained on the dataset.yaml splits through train.py's train_model()
+with the teacher as Ultralytics' distill_model: on top of the usual box and
+class losses the student's neck features are pulled towards the teacher's,
+weighted by the teacher's class scores at every location. With --pseudo-conf
+the teacher's own boxes at or above that confidence that overlap no
+ground-truth box are added to the training labels as further box targets.
+
+The teacher and every student are then evaluated with test.py and timed with
+MedicalDetector on the test split. The latency vs. mAP/recall table marks the
+Pareto-optimal models and is saved to runs/compress/<name>/pareto.json.
+Students are plain Ultralytics checkpoints: MedicalDetector(model_path=...),
+export.py and quantize.py take them unchanged.
+"""
+import argparse
+import json
+import os
+import time
+from copy import deepcopy
+from pathlib import Path
+
+import numpy as np
+import torch
+import yaml
+from torch import nn
+
+from inference import DEFAULT_MODEL_PATH, MedicalDetector
+from export import list_images, measure_latency
+from pack_dataset import label_path, read_labels, split_dirs
+from quantize import summarize
+from test import box_iou, evaluate_model
+from train import train_model
+
+# Metrics of the Pareto table, all higher-is-better, against latency
+PARETO_METRICS = ("map50", "map50_95", "recall")
+
+# Teacher boxes this close to a ground-truth box are already covered by the label
+PSEUDO_LABEL_IOU = 0.5
+
+
+def student_yaml(teacher_yaml, width=0.5, depth=1.0):
+    """
+    Model yaml of the teacher with width and depth multiplied by the given factors
+
+    Scaled model files (yolov8.yaml with n/s/m/l/x) are resolved to the
+    teacher's own depth_multiple/width_multiple/max_channels first.
+    """
+    config = deepcopy(teacher_yaml)
+    scales = config.pop('scales', None)
+    scale = config.pop('scale', None)
+    if scales:
+        teacher_depth, teacher_width, max_channels = scales[scale or next(iter(scales))]
+    else:
+        teacher_depth = config.get('depth_multiple', 1.0)
+        teacher_width = config.get('width_multiple', 1.0)
+        max_channels = config.get('max_channels', float('inf'))
+    config.update(depth_multiple=teacher_depth * depth, width_multiple=teacher_width * width)
+    if max_channels != float('inf'):
+        config['max_channels'] = max_channels
+    config.pop('yaml_file', None)
+    return config
+
+
+def top_channels(bn, k, offset=0, count=None):
+    """
+    Indices of the k channels with the largest |gamma| among bn's channels [offset, offset + count)
+    """
+    count = bn.num_features - offset if count is None else count
+    gamma = bn.weight.detach().abs()[offset:offset + count]
+    return torch.topk(gamma, min(k, count)).indices.sort().values + offset
+
+
+def copy_conv(teacher, student, in_idx, out_idx=None):
+    """
+    Copy the selected output/input channels of a Conv (conv + bn) into the student
+
+    Returns the teacher indices of the output channels kept.
+    """
+    if out_idx is None:
+        out_idx = top_channels(teacher.bn, student.conv.out_channels)
+    student.conv.weight.data.copy_(teacher.conv.weight.data[out_idx][:, in_idx])
+    for name in ('weight', 'bias', 'running_mean', 'running_var'):
+        getattr(student.bn, name).data.copy_(getattr(teacher.bn, name).data[out_idx])
+    return out_idx
+
+
+def copy_conv2d(teacher, student, in_idx):
+    """
+    Copy a prediction Conv2d, which keeps every output channel
+    """
+    student.weight.data.copy_(teacher.weight.data[:, in_idx])
+    if teacher.bias is not None:
+        student.bias.data.copy_(teacher.bias.data)
+
+
+def concat_channels(parts):
+    """
+    Indices after a channel concat of (teacher indices kept, teacher channel count) parts
+    """
+    offset, indices = 0, []
+    for idx, channels in parts:
+        indices.append(idx + offset)
+        offset += channels
+    return torch.cat(indices)
+
+
+def prune_from_teacher(teacher, student):
+    """
+    Initialize a narrower student from the teacher by structured channel pruning
+
+    The student must be built from student_yaml() of the teacher. Every layer
+    output is tracked as (teacher channel indices kept, teacher channel count),
+    so each convolution reads exactly the channels its input layer kept.
+    """
+    from ultralytics.nn.modules import C2f, Concat, Conv, Detect, SPPF
+
+    channels = teacher.yaml.get('channels', 3)
+    image = (torch.arange(channels), channels)
+    outputs = []
+    for t, s in zip(teacher.model, student.model):
+        if type(t) is not type(s):
+            raise ValueError(f"Layer {t.i} differs between teacher ({type(t).__name__}) "
+                             f"and student ({type(s).__name__})")
+        x = ([outputs[j] for j in t.f] if isinstance(t.f, list) else outputs[t.f]) if outputs else image
+
+        if isinstance(t, Conv):
+            out = (copy_conv(t, s, x[0]), t.conv.out_channels)
+        elif isinstance(t, C2f):
+            c = t.c
+            split = (top_channels(t.cv1.bn, s.c, 0, c), top_channels(t.cv1.bn, s.c, c, c))
+            copy_conv(t.cv1, s.cv1, x[0], torch.cat(split))
+            chunks = [(split[0], c), (split[1] - c, c)]
+            for tb, sb in zip(t.m, s.m):  # a shallower student keeps the first bottlenecks
+                hidden = copy_conv(tb.cv1, sb.cv1, chunks[-1][0])
+                chunks.append((copy_conv(tb.cv2, sb.cv2, hidden, chunks[-1][0] if tb.add else None), c))
+            out = (copy_conv(t.cv2, s.cv2, concat_channels(chunks)), t.cv2.conv.out_channels)
+        elif isinstance(t, SPPF):
+            hidden = copy_conv(t.cv1, s.cv1, x[0])
+            pooled = [(hidden, t.cv1.conv.out_channels)] * 4  # x and its three max-pools
+            out = (copy_conv(t.cv2, s.cv2, concat_channels(pooled)), t.cv2.conv.out_channels)
+        elif isinstance(t, Concat):
+            out = (concat_channels(x), sum(channels for _, channels in x))
+        elif isinstance(t, Detect):
+            for level, (idx, _) in enumerate(x):
+                for t_branch, s_branch in ((t.cv2[level], s.cv2[level]), (t.cv3[level], s.cv3[level])):
+                    hidden = copy_conv(t_branch[0], s_branch[0], idx)
+                    hidden = copy_conv(t_branch[1], s_branch[1], hidden)
+                    copy_conv2d(t_branch[2], s_branch[2], hidden)
+            out = None
+        elif isinstance(t, nn.Upsample):
+            out = x
+        else:
+            raise NotImplementedError(f"Pruning does not handle {type(t).__name__} (layer {t.i})")
+        outputs.append(out)
+    return student
+
+
+def build_student(teacher_path, output, width=0.5, depth=1.0, prune=False):
+    """
+    Save an untrained student checkpoint for the teacher's task, classes and input channels
+    """
+    from ultralytics.nn.tasks import DetectionModel, load_checkpoint
+
+    teacher, ckpt = load_checkpoint(teacher_path)
+    teacher = teacher.float().eval()
+    config = student_yaml(teacher.yaml, width, depth)
+    student = DetectionModel(config, ch=teacher.yaml.get('channels', 3), nc=len(teacher.names), verbose=False)
+    if prune:
+        with torch.no_grad():
+            prune_from_teacher(teacher, student)
+    student.names, student.args, student.task = teacher.names, teacher.args, teacher.task
+
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    torch.save({"model": student.half(), "ema": None, "train_args": ckpt.get("train_args", {})}, output)
+    params = sum(p.numel() for p in student.parameters())
+    teacher_params = sum(p.numel() for p in teacher.parameters())
+    print(f"Student ({'pruned from teacher' if prune else 'from scratch'}, width x{width}, depth x{depth}): "
+          f"{params:,} parameters vs. {teacher_params:,}, saved to {output}")
+    return output
+
+
+def xywh_to_xyxy(boxes):
+    return np.concatenate([boxes[:, :2] - boxes[:, 2:] / 2, boxes[:, :2] + boxes[:, 2:] / 2], axis=1)
+
+
+def pseudo_label_dataset(teacher_path, data='dataset.yaml', output_dir='runs/compress/pseudo', conf=0.5, imgsz=640):
+    """
+    dataset.yaml whose train labels also hold the teacher's confident boxes
+
+    Train images are linked into output_dir next to the merged labels; a
+    teacher box is added when it overlaps no ground-truth box by IoU
+    PSEUDO_LABEL_IOU or more. val and test still point at the original splits.
+    """
+    from ultralytics import YOLO
+
+    dirs = split_dirs(data)
+    image_dir = Path(output_dir).resolve() / 'images' / 'train'
+    image_dir.mkdir(parents=True, exist_ok=True)
+    label_dir = image_dir.parent.parent / 'labels' / 'train'
+    label_dir.mkdir(parents=True, exist_ok=True)
+
+    teacher = YOLO(teacher_path, task='detect')
+    images = list_images(dirs['train'])
+    added = 0
+    for image, result in zip(images, teacher.predict([str(p) for p in images], conf=conf, imgsz=imgsz,
+                                                     device='cpu', stream=True, verbose=False)):
+        link = image_dir / image.name
+        if not link.exists():
+            link.symlink_to(image.resolve())
+
+        labels = read_labels(label_path(image))
+        boxes = result.boxes.xywhn.cpu().numpy()
+        classes = result.boxes.cls.cpu().numpy()
+        if len(boxes) and len(labels):
+            new = box_iou(xywh_to_xyxy(boxes), xywh_to_xyxy(labels[:, 1:])).max(axis=1) < PSEUDO_LABEL_IOU
+            boxes, classes = boxes[new], classes[new]
+        rows = [*labels.tolist(), *([cls, *box] for cls, box in zip(classes.tolist(), boxes.tolist()))]
+        added += len(boxes)
+        with open(label_dir / f"{image.stem}.txt", 'w') as f:
+            f.writelines(f"{int(row[0])} " + " ".join(f"{v:.6f}" for v in row[1:]) + "\n" for row in rows)
+
+    with open(data) as f:
+        config = yaml.safe_load(f)
+    config.update(path=str(image_dir.parent.parent), train='images/train',
+                  **{split: str(Path(d).resolve()) for split, d in dirs.items() if split != 'train'})
+    output = image_dir.parent.parent / Path(data).name
+    with open(output, 'w') as f:
+        yaml.safe_dump(config, f, sort_keys=False)
+    print(f"Added {added} teacher boxes (conf >= {conf}) to {len(images)} training images")
+    return str(output)
+
+
+def pareto_front(rows, metrics=PARETO_METRICS):
+    """
+    Mark rows that no other row beats on latency and every metric at once
+    """
+    for row in rows:
+        row["pareto"] = not any(
+            other is not row
+            and other["mean_ms"] <= row["mean_ms"]
+            and all(other[m] >= row[m] for m in metrics)
+            and (other["mean_ms"] < row["mean_ms"] or any(other[m] > row[m] for m in metrics))
+            for other in rows
+        )
+    return rows
+
+
+def compare_models(models, data='dataset.yaml', imgsz=640, split='test', repeats=3):
+    """
+    Evaluate and time each {name: weights} model on the same split
+
+    Returns one row per model with test.py's metrics, MedicalDetector latency,
+    parameter count and Pareto flag.
+    """
+    images = [str(p) for p in list_images(split_dirs(data, (split,))[split])]
+    rows = []
+    for name, path in models.items():
+        metrics = summarize(evaluate_model(str(path), data=data, imgsz=imgsz, plots=False, split=split))
+        detector = MedicalDetector(model_path=str(path), inference_params={"imgsz": imgsz})
+        latency = measure_latency(detector, images, repeats)
+        params = sum(p.numel() for p in detector.model.model.parameters())
+        rows.append({"model": name, "weights": str(path), "params": params, **metrics, **latency})
+    return pareto_front(rows)
+
+
+def print_pareto(rows):
+    print("\n=== LATENCY vs. ACCURACY (* = Pareto-optimal) ===")
+    print(f"{'model':<24} {'params':>10} {'mean ms':>8} {'p95 ms':>8} {'mAP50':>7} {'mAP50-95':>9} {'recall':>7}")
+    for row in sorted(rows, key=lambda r: r["mean_ms"]):
+        print(f"{row['model']:<24} {row['params']:>10,} {row['mean_ms']:8.1f} {row['p95_ms']:8.1f} "
+              f"{row['map50']:7.4f} {row['map50_95']:9.4f} {row['recall']:7.4f}{' *' if row['pareto'] else ''}")
+
+
+def compress(teacher=DEFAULT_MODEL_PATH, data='dataset.yaml', widths=(0.5,), depth=1.0, prune=False, epochs=30,
+             imgsz=640, batch=8, device='cpu', pseudo_conf=None, dis=None, split='test', name='compress',
+             project='runs/compress', **overrides):
+    """
+    Distill the teacher into one student per width and compare them all
+
+    overrides are passed on to train_model() and Ultralytics (e.g. lr0,
+    workers, fraction). Returns the table rows, fastest first.
+    """
+    from inference import model_channels
+    from ultralytics import YOLO
+
+    run_dir = Path(project, name).resolve()
+    run_dir.mkdir(parents=True, exist_ok=True)
+    channels = model_channels(YOLO(teacher, task='detect'), teacher)
+    train_data = data
+    if pseudo_conf is not None:
+        train_data = pseudo_label_dataset(teacher, data, run_dir / 'pseudo', pseudo_conf, imgsz)
+    if dis is not None:
+        overrides["dis"] = dis
+
+    models = {"teacher": teacher}
+    for width in widths:
+        student = f"{'pruned' if prune else 'student'}_w{width:g}_d{depth:g}"
+        initial = build_student(teacher, str(run_dir / f"{student}_init.pt"), width, depth, prune)
+        start = time.perf_counter()
+        model = train_model(channels=channels, epochs=epochs, imgsz=imgsz, batch=batch, device=device,
+                            data=train_data, weights=initial, project=str(run_dir), name=student,
+                            distill_model=str(teacher), **overrides)
+        print(f"Distilled {student} in {time.perf_counter() - start:.0f}s")
+        models[student] = Path(model.trainer.best)
+
+    rows = compare_models(models, data, imgsz, split)
+    print_pareto(rows)
+    report_path = run_dir / 'pareto.json'
+    with open(report_path, 'w') as f:
+        json.dump({"teacher": str(teacher), "split": split, "imgsz": imgsz, "epochs": epochs, "prune": prune,
+                   "pseudo_conf": pseudo_conf, "models": sorted(rows, key=lambda r: r["mean_ms"])}, f, indent=2)
+    print(f"Report saved to: {report_path}")
+    return sorted(rows, key=lambda r: r["mean_ms"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distill and prune the detector into faster students")
+    parser.add_argument('--teacher', default=DEFAULT_MODEL_PATH, help="Trained .pt weights")
+    parser.add_argument('--data', default='dataset.yaml')
+    parser.add_argument('--width', type=float, nargs='+', default=[0.5],
+                        help="Student channel multipliers relative to the teacher, one student each")
+    parser.add_argument('--depth', type=float, default=1.0, help="Student C2f depth multiplier")
+    parser.add_argument('--prune', action='store_true',
+                        help="Initialize students by pruning the teacher's channels instead of from scratch")
+    parser.add_argument('--pseudo-conf', type=float, default=None,
+                        help="Add teacher boxes at or above this confidence to the training labels")
+    parser.add_argument('--dis', type=float, default=None, help="Distillation loss weight (Ultralytics default 6.0)")
+    parser.add_argument('--epochs', type=int, default=30)
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--batch', type=int, default=8)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--split', default='test', help="Split for the latency/accuracy table")
+    parser.add_argument('--name', default='compress')
+    parser.add_argument('--build-only', metavar='OUTPUT', default=None,
+                        help="Only save the (pruned) student of the first --width to OUTPUT, untrained")
+    args = parser.parse_args()
+
+    if args.build_only:
+        build_student(args.teacher, args.build_only, args.width[0], args.depth, args.prune)
+    else:
+        compress(teacher=args.teacher, data=args.data, widths=args.width, depth=args.depth, prune=args.prune,
+                 epochs=args.epochs, imgsz=args.imgsz, batch=args.batch, device=args.device,
+                 pseudo_conf=args.pseudo_conf, dis=args.dis, split=args.split, name=args.name)
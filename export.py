@@ -0,0 +1,167 @@
+"""
+Export the trained model for CPU inference backends and check them against PyTorch.
+
+Writes best.onnx (and best_openvino_model/ where OpenVINO is installed) next
+to best.pt, so MedicalDetector(backend='onnx' | 'openvino') picks them up.
+The parity check runs both backends over data/images/test and compares the
+JSON detections; the latency comparison times warm single-image inference.
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from ultralytics import YOLO
+
+from inference import MedicalDetector, DEFAULT_MODEL_PATH, IMAGE_SUFFIXES, load_image, resolve_backend_path
+
+
+def export_model(model_path=DEFAULT_MODEL_PATH, formats=('onnx', 'openvino'), imgsz=640):
+    """
+    Export the PyTorch weights to the requested formats
+
+    Graphs are exported with dynamic batch/shape so micro-batching keeps working.
+    """
+    model = YOLO(model_path)
+    exported = {}
+
+    for fmt in formats:
+        print(f"Exporting {model_path} to {fmt}...")
+        try:
+            exported[fmt] = model.export(format=fmt, imgsz=imgsz, dynamic=True)
+        except Exception as e:
+            if fmt == 'openvino':
+                # OpenVINO is optional; ONNX Runtime covers CPU inference without it
+                print(f"  Skipping OpenVINO export: {e}")
+                continue
+            raise
+        print(f"  Saved to: {exported[fmt]}")
+
+    return exported
+
+
+def list_images(image_dir):
+    return sorted(p for p in Path(image_dir).iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+
+
+def compare_detections(reference, candidate, conf_tol=1e-3, bbox_tol=0.5):
+    """
+    Compare two detection lists from predict()
+
+    Returns (identical, within_tolerance, max_conf_diff, max_bbox_diff).
+    """
+    if len(reference) != len(candidate):
+        return False, False, float('inf'), float('inf')
+    if not reference:
+        return True, True, 0.0, 0.0
+
+    # Match detections by order of confidence (NMS output is sorted)
+    ref = sorted(reference, key=lambda d: -d["confidence"])
+    got = sorted(candidate, key=lambda d: -d["confidence"])
+    conf_diff = max(abs(r["confidence"] - g["confidence"]) for r, g in zip(ref, got))
+    bbox_diff = max(
+        abs(rc - gc) for r, g in zip(ref, got) for rc, gc in zip(r["bbox"], g["bbox"])
+    )
+
+    identical = ref == got
+    return identical, conf_diff <= conf_tol and bbox_diff <= bbox_tol, conf_diff, bbox_diff
+
+
+def measure_latency(detector, images, repeats=5, warmup=2):
+    """
+    Warm per-image latency in milliseconds (mean, p50, p95), excluding decode
+    """
+    arrays = [load_image(image, detector.channels) for image in images]
+    for _ in range(warmup):
+        detector.detect_batch(arrays[:1])
+
+    timings = []
+    for _ in range(repeats):
+        for image in arrays:
+            start = time.perf_counter()
+            detector.detect_batch([image])
+            timings.append((time.perf_counter() - start) * 1000)
+
+    timings = np.array(timings)
+    return {
+        "mean_ms": float(timings.mean()),
+        "p50_ms": float(np.percentile(timings, 50)),
+        "p95_ms": float(np.percentile(timings, 95))
+    }
+
+
+def check_parity(model_path=DEFAULT_MODEL_PATH, backends=('onnx', 'openvino'),
+                 image_dir='data/images/test', conf_tol=1e-3, bbox_tol=0.5, repeats=5):
+    """
+    Run each exported backend against PyTorch on the test split
+
+    Returns True when every backend matches within tolerance on every image.
+    """
+    images = [str(p) for p in list_images(image_dir)]
+    if not images:
+        raise FileNotFoundError(f"No images found in {image_dir}")
+
+    reference = MedicalDetector(model_path, backend='torch')
+    reference_outputs = [reference.predict(image) for image in images]
+    latencies = {'torch': measure_latency(reference, images, repeats)}
+
+    all_ok = True
+    for backend in backends:
+        if not Path(resolve_backend_path(model_path, backend)).exists():
+            print(f"\nSkipping {backend}: no exported model (run export.py first)")
+            continue
+
+        candidate = MedicalDetector(model_path, backend=backend)
+        identical = within = 0
+        worst_conf = worst_bbox = 0.0
+
+        for image, ref_output in zip(images, reference_outputs):
+            output = candidate.predict(image)
+            same, ok, conf_diff, bbox_diff = compare_detections(
+                ref_output["detections"], output["detections"], conf_tol, bbox_tol
+            )
+            identical += same
+            within += ok
+            worst_conf = max(worst_conf, conf_diff)
+            worst_bbox = max(worst_bbox, bbox_diff)
+            if not ok:
+                print(f"  Mismatch on {Path(image).name}: "
+                      f"{len(ref_output['detections'])} vs {len(output['detections'])} detections")
+
+        latencies[backend] = measure_latency(candidate, images, repeats)
+        all_ok = all_ok and within == len(images)
+
+        print(f"\n=== PARITY: {backend} vs torch ===")
+        print(f"Identical JSON detections: {identical}/{len(images)}")
+        print(f"Within tolerance: {within}/{len(images)}")
+        print(f"Max confidence diff: {worst_conf:.5f}, max bbox diff: {worst_bbox:.3f}px")
+
+    print("\n=== LATENCY (ms per image, warm) ===")
+    print(f"{'backend':<10} {'mean':>8} {'p50':>8} {'p95':>8} {'speedup':>8}")
+    base = latencies['torch']['p50_ms']
+    for backend, stats in latencies.items():
+        print(f"{backend:<10} {stats['mean_ms']:8.1f} {stats['p50_ms']:8.1f} {stats['p95_ms']:8.1f} "
+              f"{base / stats['p50_ms']:7.2f}x")
+
+    return all_ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the lung opacity model for CPU backends")
+    parser.add_argument('--model', default=DEFAULT_MODEL_PATH, help="Trained .pt weights")
+    parser.add_argument('--formats', nargs='+', default=['onnx', 'openvino'], choices=['onnx', 'openvino'])
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--check', action='store_true', help="Run the parity and latency check after exporting")
+    parser.add_argument('--check-only', action='store_true', help="Skip exporting, only run the check")
+    parser.add_argument('--images', default='data/images/test', help="Images for the parity check")
+    args = parser.parse_args()
+
+    if not args.check_only:
+        export_model(args.model, args.formats, args.imgsz)
+
+    if args.check or args.check_only:
+        if not check_parity(args.model, args.formats, args.images):
+            print("\nParity check FAILED")
+            sys.exit(1)
+        print("\nParity check passed")
@@ -1,182 +1,197 @@
 """
 Script to generate sample chest X-ray data for testing the YOLOv8 model.
 This creates synthetic images with simulated lung opacity regions.
+
+Image synthesis is vectorized in NumPy and generation runs across a process
+pool. Every image draws from its own generator seeded by (seed, split, index),
+so the output is identical for a given seed whatever the worker count.
 """
-import numpy as np
-import cv2
+import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from PIL import Image
 
-def create_synthetic_chest_xray(width=640, height=640, has_opacity=False, opacity_position=None, opacity_size=None):
+import cv2
+import numpy as np
+
+SPLITS = ('train', 'val', 'test')
+
+# Anatomy proportions are defined at 640x640 and scaled to the requested resolution
+REFERENCE_SIZE = 640
+
+
+def xray_background(rng, width=640, height=640):
     """
-    Create a synthetic chest X-ray image
+    Base chest X-ray appearance: noisy bright field, darker mediastinum and rib bands
     """
-    # Create base image with typical chest X-ray appearance
-    base_img = np.random.normal(180, 30, (height, width)).astype(np.uint8)
-    
-    # Add some anatomical-like structures
-    # Simulate the mediastinum (central structure)
+    sx, sy = width / REFERENCE_SIZE, height / REFERENCE_SIZE
+    img = rng.standard_normal((height, width), dtype=np.float32) * 30 + 180
+
+    # Central dark area simulating the heart and mediastinum
     center_x = width // 2
-    for y in range(height):
-        # Create a central dark area simulating the heart and mediastinum
-        start_x = max(0, center_x - 40)
-        end_x = min(width, center_x + 40)
-        base_img[y, start_x:end_x] = np.clip(base_img[y, start_x:end_x] - 40, 0, 255)
-        
-        # Add some rib-like structures
-        if y % 40 < 10:
-            for rib_x in range(0, width, 30):
-                rib_width = 5
-                base_img[y:y+3, max(0, rib_x-rib_width//2):min(width, rib_x+rib_width//2)] = \
-                    np.clip(base_img[y:y+3, max(0, rib_x-rib_width//2):min(width, rib_x+rib_width//2)] - 20, 0, 255)
-    
-    # Add lung opacity if specified
+    half_width = max(1, round(40 * sx))
+    img[:, max(0, center_x - half_width):min(width, center_x + half_width)] -= 40
+
+    # Rib-like structures on a regular grid
+    rib_rows = (np.arange(height) % max(1, round(40 * sy))) < max(1, round(12 * sy))
+    rib_cols = ((np.arange(width) + round(2 * sx)) % max(1, round(30 * sx))) < max(1, round(4 * sx))
+    img[np.ix_(rib_rows, rib_cols)] -= 20
+
+    return img
+
+
+def add_opacity(img, opacity_x, opacity_y, opacity_w, opacity_h):
+    """
+    Brighten an elliptical region centred on (opacity_x, opacity_y), in place
+    """
+    height, width = img.shape
+    x0, x1 = max(0, opacity_x - opacity_w // 2), min(width, opacity_x + opacity_w // 2 + 1)
+    y0, y1 = max(0, opacity_y - opacity_h // 2), min(height, opacity_y + opacity_h // 2 + 1)
+    if x0 >= x1 or y0 >= y1:
+        return
+
+    # Rasterize the ellipse only over its bounding box
+    mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    cv2.ellipse(mask, (opacity_x - x0, opacity_y - y0), (opacity_w // 2, opacity_h // 2), 0, 0, 360, 255, -1)
+    img[y0:y1, x0:x1][mask == 255] += 50
+
+
+def random_opacity(rng, width=640, height=640):
+    """
+    Random opacity (center x, center y, width, height) inside the lung area
+    """
+    scale = min(width, height) / REFERENCE_SIZE
+    opacity_x = int(rng.integers(width // 4, 3 * width // 4))
+    opacity_y = int(rng.integers(height // 4, 3 * height // 4))
+    opacity_w = int(rng.integers(max(2, round(30 * scale)), max(3, round(100 * scale))))
+    opacity_h = int(rng.integers(max(2, round(30 * scale)), max(3, round(100 * scale))))
+    return opacity_x, opacity_y, opacity_w, opacity_h
+
+
+def create_synthetic_chest_xray(width=640, height=640, has_opacity=False, opacity_position=None, opacity_size=None,
+                                rng=None):
+    """
+    Create a synthetic chest X-ray image
+
+    Returns the grayscale uint8 image and the opacity as (center x, center y,
+    width, height), or None without an opacity.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    img = xray_background(rng, width, height)
+    bbox = None
+
     if has_opacity:
-        if opacity_position is None:
-            # Random position in lung area (avoiding central region)
-            opacity_x = np.random.randint(width // 4, 3 * width // 4)
-            opacity_y = np.random.randint(height // 4, 3 * height // 4)
-        else:
+        opacity_x, opacity_y, opacity_w, opacity_h = random_opacity(rng, width, height)
+        if opacity_position is not None:
             opacity_x, opacity_y = opacity_position
-            
-        if opacity_size is None:
-            opacity_w = np.random.randint(30, 100)
-            opacity_h = np.random.randint(30, 100)
-        else:
+        if opacity_size is not None:
             opacity_w, opacity_h = opacity_size
-        
-        # Create an elliptical opacity region
-        mask = np.zeros((height, width), dtype=np.uint8)
-        cv2.ellipse(mask, (opacity_x, opacity_y), (opacity_w//2, opacity_h//2), 0, 0, 360, 255, -1)
-        
-        # Apply the opacity (make it brighter to simulate white opacity)
-        opacity_region = base_img.copy()
-        opacity_region = np.where(mask[..., None] == 255, 
-                                 np.clip(base_img + 50, 0, 255), 
-                                 base_img)
-        
-        return opacity_region, (opacity_x, opacity_y, opacity_w, opacity_h)
-    
-    return base_img, None
+
+        add_opacity(img, opacity_x, opacity_y, opacity_w, opacity_h)
+        bbox = (opacity_x, opacity_y, opacity_w, opacity_h)
+
+    return np.clip(img, 0, 255).astype(np.uint8), bbox
+
+
+def synthesize_sample(rng, width=640, height=640, opacity_prob=0.7, max_opacities=3):
+    """
+    Synthetic X-ray with zero to max_opacities opacities
+
+    Returns the uint8 image and a list of (center x, center y, width, height).
+    """
+    img = xray_background(rng, width, height)
+    boxes = []
+
+    if rng.random() < opacity_prob:
+        for _ in range(int(rng.integers(1, max_opacities + 1))):
+            box = random_opacity(rng, width, height)
+            add_opacity(img, *box)
+            boxes.append(box)
+
+    return np.clip(img, 0, 255).astype(np.uint8), boxes
+
 
 def normalize_bbox(x, y, w, h, img_width, img_height):
     """
-    Convert absolute coordinates to YOLO format (normalized center coordinates)
+    Convert an opacity centred on (x, y) to YOLO format (normalized center coordinates)
     """
-    x_center = (x + w/2) / img_width
-    y_center = (y + h/2) / img_height
+    x_center = x / img_width
+    y_center = y / img_height
     width_norm = w / img_width
     height_norm = h / img_height
     return x_center, y_center, width_norm, height_norm
 
-def generate_sample_dataset(num_train=20, num_val=5, num_test=5):
+
+def image_seed(seed, split, index):
+    """
+    Independent per-image seed, stable across runs and worker counts
+    """
+    return np.random.SeedSequence([seed, SPLITS.index(split), index])
+
+
+def _generate_image(task):
+    data_root, split, index, seed, width, height, opacity_prob, max_opacities = task
+
+    rng = np.random.default_rng(image_seed(seed, split, index))
+    img, boxes = synthesize_sample(rng, width, height, opacity_prob, max_opacities)
+
+    name = f"{split}_{index:03d}"
+    cv2.imwrite(str(Path(data_root) / "images" / split / f"{name}.jpg"), img)
+    with open(Path(data_root) / "labels" / split / f"{name}.txt", 'w') as f:
+        for x, y, w, h in boxes:
+            x_norm, y_norm, w_norm, h_norm = normalize_bbox(x, y, w, h, width, height)
+            f.write(f"0 {x_norm:.6f} {y_norm:.6f} {w_norm:.6f} {h_norm:.6f}\n")
+
+    return len(boxes)
+
+
+def generate_sample_dataset(num_train=20, num_val=5, num_test=5, data_root="data", width=640, height=640,
+                            seed=0, workers=None, opacity_prob=0.7, max_opacities=3):
     """
     Generate sample dataset for testing
     """
     print("Generating sample chest X-ray dataset...")
-    
-    # Define paths
-    data_root = Path("data")
-    train_img_dir = data_root / "images" / "train"
-    val_img_dir = data_root / "images" / "val"
-    test_img_dir = data_root / "images" / "test"
-    train_lbl_dir = data_root / "labels" / "train"
-    val_lbl_dir = data_root / "labels" / "val"
-    test_lbl_dir = data_root / "labels" / "test"
-    
-    # Create directories
-    for dir_path in [train_img_dir, val_img_dir, test_img_dir, train_lbl_dir, val_lbl_dir, test_lbl_dir]:
-        dir_path.mkdir(parents=True, exist_ok=True)
-    
-    # Generate training images
-    print(f"Generating {num_train} training images...")
-    for i in range(num_train):
-        has_opacity = np.random.random() > 0.3  # 70% chance of having opacity
-        img, bbox = create_synthetic_chest_xray(has_opacity=has_opacity)
-        
-        img_path = train_img_dir / f"train_{i:03d}.jpg"
-        # Ensure the directory exists
-        train_img_dir.mkdir(parents=True, exist_ok=True)
-        # Ensure the image is the right data type for PIL and has correct dimensions
-        img_uint8 = np.clip(img, 0, 255).astype(np.uint8)
-        # Make sure it's 2D for grayscale
-        if len(img_uint8.shape) == 3:
-            img_uint8 = img_uint8[:, :, 0]  # Take first channel if RGB
-        # Convert to PIL Image and save
-        pil_img = Image.fromarray(img_uint8, mode='L')  # 'L' for grayscale
-        pil_img.save(img_path)
-        
-        # Create label file
-        lbl_path = train_lbl_dir / f"train_{i:03d}.txt"
-        # Ensure the directory exists
-        train_lbl_dir.mkdir(parents=True, exist_ok=True)
-        with open(lbl_path, 'w') as f:
-            if has_opacity and bbox:
-                x, y, w, h = bbox
-                x_norm, y_norm, w_norm, h_norm = normalize_bbox(x, y, w, h, 640, 640)
-                f.write(f"0 {x_norm:.6f} {y_norm:.6f} {w_norm:.6f} {h_norm:.6f}\n")
-    
-    # Generate validation images
-    print(f"Generating {num_val} validation images...")
-    for i in range(num_val):
-        has_opacity = np.random.random() > 0.3  # 70% chance of having opacity
-        img, bbox = create_synthetic_chest_xray(has_opacity=has_opacity)
-        
-        img_path = val_img_dir / f"val_{i:03d}.jpg"
-        # Ensure the directory exists
-        val_img_dir.mkdir(parents=True, exist_ok=True)
-        # Ensure the image is the right data type for PIL and has correct dimensions
-        img_uint8 = np.clip(img, 0, 255).astype(np.uint8)
-        # Make sure it's 2D for grayscale
-        if len(img_uint8.shape) == 3:
-            img_uint8 = img_uint8[:, :, 0]  # Take first channel if RGB
-        # Convert to PIL Image and save
-        pil_img = Image.fromarray(img_uint8, mode='L')  # 'L' for grayscale
-        pil_img.save(img_path)
-        
-        # Create label file
-        lbl_path = val_lbl_dir / f"val_{i:03d}.txt"
-        # Ensure the directory exists
-        val_lbl_dir.mkdir(parents=True, exist_ok=True)
-        with open(lbl_path, 'w') as f:
-            if has_opacity and bbox:
-                x, y, w, h = bbox
-                x_norm, y_norm, w_norm, h_norm = normalize_bbox(x, y, w, h, 640, 640)
-                f.write(f"0 {x_norm:.6f} {y_norm:.6f} {w_norm:.6f} {h_norm:.6f}\n")
-    
-    # Generate test images
-    print(f"Generating {num_test} test images...")
-    for i in range(num_test):
-        has_opacity = np.random.random() > 0.3  # 70% chance of having opacity
-        img, bbox = create_synthetic_chest_xray(has_opacity=has_opacity)
-        
-        img_path = test_img_dir / f"test_{i:03d}.jpg"
-        # Ensure the directory exists
-        test_img_dir.mkdir(parents=True, exist_ok=True)
-        # Ensure the image is the right data type for PIL and has correct dimensions
-        img_uint8 = np.clip(img, 0, 255).astype(np.uint8)
-        # Make sure it's 2D for grayscale
-        if len(img_uint8.shape) == 3:
-            img_uint8 = img_uint8[:, :, 0]  # Take first channel if RGB
-        # Convert to PIL Image and save
-        pil_img = Image.fromarray(img_uint8, mode='L')  # 'L' for grayscale
-        pil_img.save(img_path)
-        
-        # Create label file
-        lbl_path = test_lbl_dir / f"test_{i:03d}.txt"
-        # Ensure the directory exists
-        test_lbl_dir.mkdir(parents=True, exist_ok=True)
-        with open(lbl_path, 'w') as f:
-            if has_opacity and bbox:
-                x, y, w, h = bbox
-                x_norm, y_norm, w_norm, h_norm = normalize_bbox(x, y, w, h, 640, 640)
-                f.write(f"0 {x_norm:.6f} {y_norm:.6f} {w_norm:.6f} {h_norm:.6f}\n")
-    
+
+    counts = {'train': num_train, 'val': num_val, 'test': num_test}
+    for split in SPLITS:
+        (Path(data_root) / "images" / split).mkdir(parents=True, exist_ok=True)
+        (Path(data_root) / "labels" / split).mkdir(parents=True, exist_ok=True)
+
+    tasks = [
+        (str(data_root), split, i, seed, width, height, opacity_prob, max_opacities)
+        for split in SPLITS for i in range(counts[split])
+    ]
+    workers = workers or os.cpu_count() or 1
+    print(f"Generating {len(tasks)} {width}x{height} images with {workers} worker{'s' if workers > 1 else ''}...")
+
+    if workers == 1:
+        opacities = [_generate_image(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            opacities = list(pool.map(_generate_image, tasks, chunksize=max(1, min(256, len(tasks) // (workers * 4)))))
+
     print("Sample dataset generation completed!")
     print(f"Training images: {num_train}")
     print(f"Validation images: {num_val}")
     print(f"Test images: {num_test}")
+    print(f"Images with opacity: {sum(1 for n in opacities if n)}, total opacities: {sum(opacities)}")
+
 
 if __name__ == "__main__":
-    generate_sample_dataset()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Generate a synthetic chest X-ray dataset")
+    parser.add_argument('--train', type=int, default=20)
+    parser.add_argument('--val', type=int, default=5)
+    parser.add_argument('--test', type=int, default=5)
+    parser.add_argument('--output', default='data', help="Dataset root (images/ and labels/ per split)")
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=640)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--opacity-prob', type=float, default=0.7, help="Fraction of images with opacities")
+    parser.add_argument('--max-opacities', type=int, default=3, help="Most opacities in one image")
+    args = parser.parse_args()
+
+    generate_sample_dataset(args.train, args.val, args.test, args.output, args.width, args.height,
+                            args.seed, args.workers, args.opacity_prob, args.max_opacities)
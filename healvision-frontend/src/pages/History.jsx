@@ -1,59 +1,66 @@
-import React, { useState } from 'react'
+import React, { useState, useEffect } from 'react'
 import { motion } from 'framer-motion'
 import { Search, Filter, Calendar, Eye, Download } from 'lucide-react'
+import axios from 'axios'
+import toast from 'react-hot-toast'
+
+const PAGE_SIZE = 20
 
 const History = () => {
   const [searchTerm, setSearchTerm] = useState('')
+  const [patientFilter, setPatientFilter] = useState('')
   const [filterStatus, setFilterStatus] = useState('all')
+  const [historyData, setHistoryData] = useState([])
+  const [isLoading, setIsLoading] = useState(false)
+  // Cursors of the pages visited so far; the last one is the current page (null: first page)
+  const [cursors, setCursors] = useState([null])
+  const [nextCursor, setNextCursor] = useState(null)
+
+  const currentCursor = cursors[cursors.length - 1]
+
+  useEffect(() => {
+    const fetchHistory = async () => {
+      setIsLoading(true)
+      try {
+        const params = { limit: PAGE_SIZE }
+        if (patientFilter) params.patient_id = patientFilter
+        if (filterStatus !== 'all') params.status = filterStatus
+        if (currentCursor) params.cursor = currentCursor
 
-  // Mock data - in real app this would come from API
-  const historyData = [
-    {
-      id: 1,
-      patient_id: 'PAT001',
-      patient_name: 'John Doe',
-      date: '2024-01-15T14:30:00',
-      result: 'Normal',
-      confidence: 98.5,
-      detections: 0
-    },
-    {
-      id: 2,
-      patient_id: 'PAT002',
-      patient_name: 'Jane Smith',
-      date: '2024-01-14T11:15:00',
-      result: 'Abnormal',
-      confidence: 87.2,
-      detections: 1
-    },
-    {
-      id: 3,
-      patient_id: 'PAT003',
-      patient_name: 'Robert Johnson',
-      date: '2024-01-14T09:45:00',
-      result: 'Normal',
-      confidence: 96.8,
-      detections: 0
-    },
-    {
-      id: 4,
-      patient_id: 'PAT004',
-      patient_name: 'Emily Davis',
-      date: '2024-01-13T16:20:00',
-      result: 'Abnormal',
-      confidence: 92.1,
-      detections: 2
+        const response = await axios.get('/api/history', { params })
+        setHistoryData(response.data.items)
+        setNextCursor(response.data.next_cursor)
+      } catch (error) {
+        console.error('History error:', error)
+        toast.error(error.response?.data?.error || 'Could not load analysis history.')
+      } finally {
+        setIsLoading(false)
+      }
     }
-  ]
+    fetchHistory()
+  }, [patientFilter, filterStatus, currentCursor])
+
+  // Filters are applied server-side; changing one starts again from the first page
+  const applySearch = (e) => {
+    e.preventDefault()
+    setCursors([null])
+    setPatientFilter(searchTerm.trim())
+  }
+
+  const changeStatus = (status) => {
+    setCursors([null])
+    setFilterStatus(status)
+  }
+
+  const filteredData = historyData.map(item => ({
+    ...item,
+    date: item.analyzed_at.endsWith('Z') ? item.analyzed_at : `${item.analyzed_at}Z`,
+    result: item.num_detections > 0 ? 'Abnormal' : 'Normal',
+    confidence: item.num_detections > 0 ? (item.max_confidence * 100).toFixed(1) : null,
+    detections: item.num_detections
+  }))
 
-  const filteredData = historyData.filter(item => {
-    const matchesSearch = item.patient_name.toLowerCase().includes(searchTerm.toLowerCase()) ||
-                         item.patient_id.toLowerCase().includes(searchTerm.toLowerCase())
-    const matchesFilter = filterStatus === 'all' || 
-                         (filterStatus === 'normal' && item.result === 'Normal') ||
-                         (filterStatus === 'abnormal' && item.result === 'Abnormal')
-    return matchesSearch && matchesFilter
-  })
+  const firstRow = (cursors.length - 1) * PAGE_SIZE + 1
 
   return (
     <motion.div
@@ -69,23 +76,23 @@ const History = () => {
       {/* Filters */}
       <div className="card p-6 mb-6">
         <div className="flex flex-col md:flex-row md:items-center md:justify-between space-y-4 md:space-y-0">
-          <div className="flex-1 max-w-md">
+          <form onSubmit={applySearch} className="flex-1 max-w-md">
             <div className="relative">
               <Search className="absolute left-3 top-1/2 transform -translate-y-1/2 text-gray-400 h-5 w-5" />
               <input
                 type="text"
-                placeholder="Search by patient name or ID..."
+                placeholder="Search by patient ID..."
                 value={searchTerm}
                 onChange={(e) => setSearchTerm(e.target.value)}
                 className="input-field pl-10"
               />
             </div>
-          </div>
+          </form>
           
           <div className="flex space-x-3">
             <select
               value={filterStatus}
-              onChange={(e) => setFilterStatus(e.target.value)}
+              onChange={(e) => changeStatus(e.target.value)}
               className="input-field"
             >
               <option value="all">All Results</option>
@@ -138,8 +145,8 @@ const History = () => {
                 >
                   <td className="px-6 py-4 whitespace-nowrap">
                     <div>
-                      <div className="text-sm font-medium text-gray-900">{item.patient_name}</div>
-                      <div className="text-sm text-gray-500">{item.patient_id}</div>
+                      <div className="text-sm font-medium text-gray-900">{item.patient_id}</div>
+                      <div className="text-sm text-gray-500">{item.study_id || item.filename}</div>
                     </div>
                   </td>
                   <td className="px-6 py-4 whitespace-nowrap text-sm text-gray-900">
@@ -158,7 +165,7 @@ const History = () => {
                     </span>
                   </td>
                   <td className="px-6 py-4 whitespace-nowrap text-sm text-gray-900">
-                    {item.confidence}%
+                    {item.confidence !== null ? `${item.confidence}%` : '—'}
                   </td>
                   <td className="px-6 py-4 whitespace-nowrap text-sm text-gray-900">
                     {item.detections}
@@ -179,7 +186,7 @@ const History = () => {
           </table>
         </div>
         
-        {filteredData.length === 0 && (
+        {!isLoading && filteredData.length === 0 && (
           <div className="text-center py-12">
             <Search className="mx-auto h-12 w-12 text-gray-400 mb-4" />
             <h3 className="text-lg font-medium text-gray-900 mb-1">No results found</h3>
@@ -192,12 +199,24 @@ const History = () => {
       {filteredData.length > 0 && (
         <div className="flex items-center justify-between mt-6">
           <div className="text-sm text-gray-700">
-            Showing <span className="font-medium">1</span> to <span className="font-medium">{filteredData.length}</span> of{' '}
-            <span className="font-medium">{filteredData.length}</span> results
+            Showing <span className="font-medium">{firstRow}</span> to{' '}
+            <span className="font-medium">{firstRow + filteredData.length - 1}</span>
           </div>
           <div className="flex space-x-2">
-            <button className="btn-secondary">Previous</button>
-            <button className="btn-primary">Next</button>
+            <button
+              className="btn-secondary"
+              disabled={cursors.length === 1 || isLoading}
+              onClick={() => setCursors(cursors.slice(0, -1))}
+            >
+              Previous
+            </button>
+            <button
+              className="btn-primary"
+              disabled={!nextCursor || isLoading}
+              onClick={() => setCursors([...cursors, nextCursor])}
+            >
+              Next
+            </button>
           </div>
         </div>
       )}
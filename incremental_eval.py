@@ -0,0 +1,517 @@
+"""
+Incremental evaluation from cached per-image predictions.
+
+model.val() re-runs the whole split on every call. Here the raw predictions
+(confidence down to 0.001, as validation uses) are cached per image, keyed
+by the SHA-256 of the model weights plus the inference parameters, and by
+the SHA-256 of the image content. A run only infers images that are new or
+changed; edited labels need no inference at all. File hashes are themselves
+cached by path, size and mtime, so unchanged images are not even re-read.
+
+Metrics are computed with NumPy from the cached predictions:
+- mAP@0.5 and mAP@0.5:0.95 (COCO 101-point interpolation)
+- precision/recall/F1-confidence curves and the precision-recall curve
+- precision/recall/F1 at any list of confidence thresholds
+- the confusion matrix at a confidence threshold
+
+Predictions are matched to labels once per run, greedily in descending
+confidence (like Ultralytics). A prediction's match does not depend on
+lower-confidence predictions, so every confidence threshold can then be
+read off cumulative counts; a sweep costs a sorted search, not a re-run.
+Numbers can differ slightly from model.val(), which letterboxes whole
+batches to a common rectangular shape.
+
+    python incremental_eval.py --model best.pt --split val --sweep 0.1 0.25 0.5
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import yaml
+
+from inference import MedicalDetector, DEFAULT_INFERENCE_PARAMS, file_sha256, resolve_backend_path
+from pack_dataset import label_path, list_split_images, read_labels, split_dirs
+from test import box_iou
+
+# Validation settings: keep nearly every box so any threshold can be evaluated later
+PREDICTION_PARAMS = {"conf": 0.001, "iou": 0.7, "max_det": 300}
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+# Class-agnostic IoU for the confusion matrix (as in Ultralytics)
+CONFUSION_IOU = 0.45
+DEFAULT_SWEEP = (0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9)
+
+
+class FileHashes:
+    """
+    Content hashes of image files, recomputed only when size or mtime change
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._entries = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self._entries = json.load(f)
+        self._dirty = False
+
+    def get(self, image_path):
+        stat = os.stat(image_path)
+        key = str(Path(image_path).resolve())
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns:
+            entry = [stat.st_size, stat.st_mtime_ns, file_sha256(image_path)]
+            self._entries[key] = entry
+            self._dirty = True
+        return entry[2]
+
+    def save(self):
+        if self._dirty:
+            _atomic_write(self.path, lambda f: f.write(json.dumps(self._entries).encode()))
+            self._dirty = False
+
+
+class PredictionCache:
+    """
+    Raw predictions per image content hash, for one set of weights and inference parameters
+    """
+
+    def __init__(self, cache_dir, weights_hash, params):
+        key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+        self.path = Path(cache_dir) / f"{weights_hash[:16]}_{key}.npz"
+        # image hash -> (shape (h, w), boxes (n, 4) xyxy, scores (n,), classes (n,))
+        self._entries = {}
+        self._dirty = False
+        if self.path.exists():
+            self._load()
+
+    def _load(self):
+        # Every NpzFile key access reads the whole array again, so read each one once
+        with np.load(self.path) as data:
+            hashes, shapes, offsets = data["hashes"], data["shapes"], data["offsets"]
+            boxes, scores, classes = data["boxes"], data["scores"], data["classes"]
+        for i, image_hash in enumerate(hashes):
+            lo, hi = offsets[i], offsets[i + 1]
+            self._entries[str(image_hash)] = (
+                tuple(int(v) for v in shapes[i]), boxes[lo:hi], scores[lo:hi], classes[lo:hi]
+            )
+
+    def __contains__(self, image_hash):
+        return image_hash in self._entries
+
+    def __getitem__(self, image_hash):
+        return self._entries[image_hash]
+
+    def add(self, image_hash, shape, boxes, scores, classes):
+        self._entries[image_hash] = (tuple(shape), boxes.astype(np.float32), scores.astype(np.float32),
+                                     classes.astype(np.int16))
+        self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        entries = list(self._entries.items())
+        counts = [len(scores) for _, (_, _, scores, _) in entries]
+
+        def write(f):
+            np.savez(
+                f,
+                hashes=np.array([image_hash for image_hash, _ in entries], dtype='U64'),
+                shapes=np.array([shape for _, (shape, _, _, _) in entries], dtype=np.int32).reshape(-1, 2),
+                offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                boxes=np.concatenate([boxes for _, (_, boxes, _, _) in entries] or [np.zeros((0, 4))]).astype(np.float32),
+                scores=np.concatenate([scores for _, (_, _, scores, _) in entries] or [np.zeros(0)]).astype(np.float32),
+                classes=np.concatenate([classes for _, (_, _, _, classes) in entries] or [np.zeros(0)]).astype(np.int16)
+            )
+
+        _atomic_write(self.path, write)
+        self._dirty = False
+
+
+def _atomic_write(path, write):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def labels_xyxy(labels, shape):
+    """
+    YOLO labels (class, x, y, w, h normalized) -> classes and pixel x1, y1, x2, y2 boxes
+    """
+    height, width = shape
+    xywh = labels[:, 1:] * np.array([width, height, width, height], dtype=np.float32)
+    boxes = np.concatenate([xywh[:, :2] - xywh[:, 2:] / 2, xywh[:, :2] + xywh[:, 2:] / 2], axis=1)
+    return labels[:, 0].astype(np.int16), boxes
+
+
+def match_image(pred_boxes, pred_scores, pred_classes, gt_boxes, gt_classes):
+    """
+    Greedy matching of one image's predictions (in descending confidence) to its labels
+
+    Returns:
+        correct: (n, 10) whether each prediction is a true positive at each IoU threshold
+        matched_class: (n,) label class claimed by each prediction at CONFUSION_IOU, class-agnostic (-1: none)
+        claimed_by: (m,) confidence of the prediction claiming each label at CONFUSION_IOU (0: unclaimed)
+    """
+    n, m = len(pred_scores), len(gt_classes)
+    correct = np.zeros((n, len(IOU_THRESHOLDS)), dtype=bool)
+    matched_class = np.full(n, -1, dtype=np.int16)
+    claimed_by = np.zeros(m, dtype=np.float32)
+    if n == 0 or m == 0:
+        return correct, matched_class, claimed_by
+
+    iou = box_iou(pred_boxes, gt_boxes)  # (n, m)
+    same_class = pred_classes[:, None] == gt_classes[None, :]
+    class_iou = np.where(same_class, iou, 0.0)
+
+    claimed = np.zeros((m, len(IOU_THRESHOLDS)), dtype=bool)
+    for j in np.flatnonzero((class_iou >= IOU_THRESHOLDS[0]).any(axis=1)):
+        available = np.where(claimed, 0.0, class_iou[j][:, None])  # (m, 10)
+        best = available.argmax(axis=0)
+        correct[j] = available[best, np.arange(len(IOU_THRESHOLDS))] >= IOU_THRESHOLDS
+        claimed[best, np.arange(len(IOU_THRESHOLDS))] |= correct[j]
+
+    taken = np.zeros(m, dtype=bool)
+    for j in np.flatnonzero((iou >= CONFUSION_IOU).any(axis=1)):
+        available = np.where(taken, 0.0, iou[j])
+        best = int(available.argmax())
+        if available[best] >= CONFUSION_IOU:
+            taken[best] = True
+            matched_class[j] = gt_classes[best]
+            claimed_by[best] = pred_scores[j]
+    return correct, matched_class, claimed_by
+
+
+def compute_ap(recall, precision):
+    """
+    Area under the precision envelope, 101-point interpolated (COCO)
+    """
+    mrec = np.concatenate(([0.0], recall, [recall[-1] if len(recall) else 1.0], [1.0]))
+    mpre = np.concatenate(([1.0], precision, [0.0], [0.0]))
+    mpre = np.flip(np.maximum.accumulate(np.flip(mpre)))
+    x = np.linspace(0, 1, 101)
+    y = np.interp(x, mrec, mpre)
+    return float(((y[1:] + y[:-1]) / 2 * np.diff(x)).sum())
+
+
+class Evaluation:
+    """
+    Matched predictions of a whole split; every metric is derived from these arrays
+    """
+
+    def __init__(self, scores, pred_classes, correct, matched_class, gt_classes, gt_claimed_by, names):
+        order = np.argsort(-scores, kind='stable')
+        self.scores = scores[order]
+        self.pred_classes = pred_classes[order]
+        self.correct = correct[order]
+        self.matched_class = matched_class[order]
+        self.gt_classes = gt_classes
+        self.gt_claimed_by = gt_claimed_by
+        self.names = names
+        self.classes = np.arange(len(names))
+        self.num_gt = np.bincount(gt_classes.astype(np.int64), minlength=len(names))
+
+    def _cumulative(self, c):
+        mask = self.pred_classes == c
+        tp = np.cumsum(self.correct[mask], axis=0)
+        fp = np.cumsum(~self.correct[mask], axis=0)
+        return self.scores[mask], tp, fp
+
+    def average_precision(self):
+        """
+        (nc, 10) AP per class and IoU threshold
+        """
+        ap = np.zeros((len(self.classes), len(IOU_THRESHOLDS)))
+        for c in self.classes:
+            _, tp, fp = self._cumulative(c)
+            if self.num_gt[c] == 0 or not len(tp):
+                continue
+            recall = tp / self.num_gt[c]
+            precision = tp / (tp + fp)
+            for t in range(len(IOU_THRESHOLDS)):
+                ap[c, t] = compute_ap(recall[:, t], precision[:, t])
+        return ap
+
+    def at_thresholds(self, thresholds, iou_index=0):
+        """
+        Precision, recall and F1 per class at each confidence threshold: (nc, k) arrays
+        """
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        precision = np.zeros((len(self.classes), len(thresholds)))
+        recall = np.zeros_like(precision)
+        for c in self.classes:
+            scores, tp, fp = self._cumulative(c)
+            # Number of predictions with score >= threshold (scores are descending)
+            count = np.searchsorted(-scores, -thresholds, side='right')
+            tp_at = np.where(count > 0, tp[np.maximum(count - 1, 0), iou_index] if len(tp) else 0, 0)
+            fp_at = np.where(count > 0, fp[np.maximum(count - 1, 0), iou_index] if len(fp) else 0, 0)
+            precision[c] = np.where(count > 0, tp_at / np.maximum(tp_at + fp_at, 1), 1.0)
+            recall[c] = tp_at / max(self.num_gt[c], 1)
+        f1 = 2 * precision * recall / np.maximum(precision + recall, 1e-16)
+        return precision, recall, f1
+
+    def curves(self, points=1000):
+        """
+        Precision/recall/F1-confidence curves and the precision-recall curve at IoU 0.5
+        """
+        confidence = np.linspace(0, 1, points)
+        precision, recall, f1 = self.at_thresholds(confidence)
+        pr_recall = np.linspace(0, 1, points)
+        pr_precision = np.zeros((len(self.classes), points))
+        for c in self.classes:
+            _, tp, fp = self._cumulative(c)
+            if self.num_gt[c] and len(tp):
+                rec = tp[:, 0] / self.num_gt[c]
+                prec = np.maximum.accumulate((tp[:, 0] / (tp[:, 0] + fp[:, 0]))[::-1])[::-1]
+                pr_precision[c] = np.interp(pr_recall, rec, prec, right=0.0)
+        return {"confidence": confidence, "precision": precision, "recall": recall, "f1": f1,
+                "pr_recall": pr_recall, "pr_precision": pr_precision}
+
+    def confusion_matrix(self, conf=0.25):
+        """
+        (nc + 1, nc + 1) counts, rows predicted and columns true class; the last index is background
+        """
+        nc = len(self.classes)
+        matrix = np.zeros((nc + 1, nc + 1), dtype=np.int64)
+        kept = self.scores >= conf
+        pred = self.pred_classes[kept].astype(np.int64)
+        true = self.matched_class[kept].astype(np.int64)
+        true = np.where(true < 0, nc, true)
+        np.add.at(matrix, (pred, true), 1)
+        missed = self.gt_classes[self.gt_claimed_by < conf].astype(np.int64)
+        np.add.at(matrix, (np.full(len(missed), nc), missed), 1)
+        return matrix
+
+
+class IncrementalEvaluator:
+    def __init__(self, model_path, imgsz=DEFAULT_INFERENCE_PARAMS["imgsz"], batch=16, backend='torch',
+                 cache_dir='runs/eval_cache'):
+        """
+        Args:
+            model_path: Weights to evaluate (exported backends resolved as in MedicalDetector)
+            imgsz: Inference size
+            batch: Images per forward pass for images missing from the cache
+            cache_dir: Where predictions and file hashes are cached
+        """
+        self.model_path = model_path
+        self.backend = backend
+        self.batch = batch
+        self.params = {**PREDICTION_PARAMS, "imgsz": imgsz, "backend": backend}
+        self.weights_hash = file_sha256(resolve_backend_path(model_path, backend))
+        self.cache = PredictionCache(cache_dir, self.weights_hash, self.params)
+        self.file_hashes = FileHashes(Path(cache_dir) / "file_hashes.json")
+        self._detector = None
+
+    def _infer(self, paths, image_hashes):
+        if self._detector is None:
+            params = {k: v for k, v in self.params.items() if k != "backend"}
+            self._detector = MedicalDetector(self.model_path, inference_params=params, backend=self.backend)
+        for start in range(0, len(paths), self.batch):
+            chunk = paths[start:start + self.batch]
+            results = self._detector.infer(chunk, verbose=False)
+            for image_hash, result in zip(image_hashes[start:start + self.batch], results):
+                boxes = result.boxes
+                self.cache.add(image_hash, result.orig_shape, boxes.xyxy.cpu().numpy(), boxes.conf.cpu().numpy(),
+                               boxes.cls.cpu().numpy())
+            print(f"Inferred {min(start + self.batch, len(paths))}/{len(paths)} new or changed images")
+
+    def predictions(self, paths):
+        """
+        Cached predictions for every image, inferring only those not cached yet
+        """
+        image_hashes = [self.file_hashes.get(path) for path in paths]
+        self.file_hashes.save()
+        missing = {}
+        for path, image_hash in zip(paths, image_hashes):
+            if image_hash not in self.cache:
+                missing.setdefault(image_hash, path)
+        if missing:
+            self._infer(list(missing.values()), list(missing))
+            self.cache.save()
+        return [self.cache[image_hash] for image_hash in image_hashes], len(missing)
+
+    def evaluate(self, paths, names):
+        """
+        Match cached predictions of the given images against their current labels
+        """
+        start = time.perf_counter()
+        predictions, inferred = self.predictions(paths)
+        inference_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        scores, pred_classes, correct, matched_class, gt_classes, gt_claimed_by = [], [], [], [], [], []
+        for path, (shape, boxes, image_scores, classes) in zip(paths, predictions):
+            image_gt_classes, gt_boxes = labels_xyxy(read_labels(label_path(path)), shape)
+            image_correct, image_matched, image_claimed = match_image(boxes, image_scores, classes,
+                                                                      gt_boxes, image_gt_classes)
+            scores.append(image_scores)
+            pred_classes.append(classes)
+            correct.append(image_correct)
+            matched_class.append(image_matched)
+            gt_classes.append(image_gt_classes)
+            gt_claimed_by.append(image_claimed)
+
+        evaluation = Evaluation(
+            np.concatenate(scores or [np.zeros(0, np.float32)]),
+            np.concatenate(pred_classes or [np.zeros(0, np.int16)]),
+            np.concatenate(correct or [np.zeros((0, len(IOU_THRESHOLDS)), bool)]),
+            np.concatenate(matched_class or [np.zeros(0, np.int16)]),
+            np.concatenate(gt_classes or [np.zeros(0, np.int16)]),
+            np.concatenate(gt_claimed_by or [np.zeros(0, np.float32)]),
+            names
+        )
+        evaluation.images = len(paths)
+        evaluation.inferred = inferred
+        evaluation.inference_seconds = inference_seconds
+        evaluation.matching_seconds = time.perf_counter() - start
+        return evaluation
+
+
+def dataset_names(data):
+    with open(data) as f:
+        names = yaml.safe_load(f)['names']
+    return [names[i] for i in sorted(names)] if isinstance(names, dict) else list(names)
+
+
+def plot_evaluation(evaluation, curves, matrix, save_dir):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    save_dir = Path(save_dir)
+    save_dir.mkdir(parents=True, exist_ok=True)
+
+    fig, axes = plt.subplots(1, 3, figsize=(18, 5))
+    for c, name in enumerate(evaluation.names):
+        axes[0].plot(curves["pr_recall"], curves["pr_precision"][c], label=name)
+        axes[1].plot(curves["confidence"], curves["f1"][c], label=name)
+        axes[2].plot(curves["confidence"], curves["precision"][c], label=f"{name} precision")
+        axes[2].plot(curves["confidence"], curves["recall"][c], label=f"{name} recall")
+    for ax, (xlabel, ylabel) in zip(axes, [("Recall", "Precision"), ("Confidence", "F1"),
+                                           ("Confidence", "Precision / Recall")]):
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        ax.set_xlim(0, 1)
+        ax.set_ylim(0, 1.02)
+        ax.legend()
+    fig.tight_layout()
+    fig.savefig(save_dir / "curves.png", dpi=150)
+    plt.close(fig)
+
+    labels = list(evaluation.names) + ["background"]
+    fig, ax = plt.subplots(figsize=(2 + len(labels), 1.5 + len(labels)))
+    ax.imshow(matrix, cmap='Blues')
+    for (i, j), value in np.ndenumerate(matrix):
+        ax.text(j, i, str(value), ha='center', va='center')
+    ax.set_xticks(range(len(labels)), labels)
+    ax.set_yticks(range(len(labels)), labels)
+    ax.set_xlabel("True")
+    ax.set_ylabel("Predicted")
+    fig.tight_layout()
+    fig.savefig(save_dir / "confusion_matrix.png", dpi=150)
+    plt.close(fig)
+
+
+def evaluate_incremental(model_path='runs/train/lung_opacity_detection/weights/best.pt', data='dataset.yaml',
+                         split='val', imgsz=DEFAULT_INFERENCE_PARAMS["imgsz"], batch=16, backend='torch',
+                         conf=DEFAULT_INFERENCE_PARAMS["conf"], sweep=DEFAULT_SWEEP, cache_dir='runs/eval_cache',
+                         plots=True, save_dir='runs/eval/incremental'):
+    """
+    Evaluate a model on a dataset split, re-inferring only images not seen with these weights
+
+    Args:
+        conf: Confidence threshold for the confusion matrix and the headline precision/recall
+        sweep: Confidence thresholds to report precision/recall/F1 at
+
+    Returns:
+        Dict with mAP, per-class AP, precision/recall/F1 at conf, the sweep table and the confusion matrix
+    """
+    names = dataset_names(data)
+    paths = list_split_images(split_dirs(data, [split])[split])
+    evaluator = IncrementalEvaluator(model_path, imgsz, batch, backend, cache_dir)
+    evaluation = evaluator.evaluate(paths, names)
+
+    start = time.perf_counter()
+    ap = evaluation.average_precision()
+    precision, recall, f1 = evaluation.at_thresholds([conf])
+    sweep = sorted(sweep)
+    sweep_precision, sweep_recall, sweep_f1 = evaluation.at_thresholds(sweep)
+    curves = evaluation.curves()
+    matrix = evaluation.confusion_matrix(conf)
+    metrics_seconds = time.perf_counter() - start
+
+    # Classes without labels in the split do not count towards the means
+    labelled = evaluation.num_gt > 0
+    results = {
+        "images": evaluation.images,
+        "inferred": evaluation.inferred,
+        "map50": float(ap[labelled, 0].mean()) if labelled.any() else 0.0,
+        "map": float(ap[labelled].mean()) if labelled.any() else 0.0,
+        "precision": float(precision[labelled, 0].mean()) if labelled.any() else 0.0,
+        "recall": float(recall[labelled, 0].mean()) if labelled.any() else 0.0,
+        "f1": float(f1[labelled, 0].mean()) if labelled.any() else 0.0,
+        "conf": conf,
+        "per_class": {
+            name: {"ap50": float(ap[c, 0]), "ap": float(ap[c].mean()), "labels": int(evaluation.num_gt[c])}
+            for c, name in enumerate(names)
+        },
+        "sweep": [
+            {"conf": threshold, "precision": float(sweep_precision[labelled, k].mean()) if labelled.any() else 0.0,
+             "recall": float(sweep_recall[labelled, k].mean()) if labelled.any() else 0.0,
+             "f1": float(sweep_f1[labelled, k].mean()) if labelled.any() else 0.0}
+            for k, threshold in enumerate(sweep)
+        ],
+        "confusion_matrix": matrix.tolist(),
+        "seconds": {
+            "inference": round(evaluation.inference_seconds, 3),
+            "matching": round(evaluation.matching_seconds, 3),
+            "metrics": round(metrics_seconds, 3)
+        }
+    }
+
+    print(f"\n=== INCREMENTAL EVALUATION ({split}) ===")
+    print(f"Images: {results['images']} ({results['inferred']} inferred, the rest from cache)")
+    print(f"mAP@0.5: {results['map50']:.4f}")
+    print(f"mAP@0.5-0.95: {results['map']:.4f}")
+    print(f"Precision@{conf}: {results['precision']:.4f}")
+    print(f"Recall@{conf}: {results['recall']:.4f}")
+    print(f"F1@{conf}: {results['f1']:.4f}")
+    for name, values in results["per_class"].items():
+        print(f"Class {name} - AP@0.5: {values['ap50']:.4f}, AP@0.5-0.95: {values['ap']:.4f} ({values['labels']} labels)")
+    print(f"\n{'conf':>6} {'precision':>9} {'recall':>7} {'f1':>7}")
+    for row in results["sweep"]:
+        print(f"{row['conf']:>6.2f} {row['precision']:>9.4f} {row['recall']:>7.4f} {row['f1']:>7.4f}")
+    print(f"\nConfusion matrix @ conf {conf} (rows predicted, columns true, last = background):\n{matrix}")
+    print(f"Timing: {results['seconds']}")
+
+    if plots:
+        plot_evaluation(evaluation, curves, matrix, save_dir)
+        print(f"Plots saved to: {save_dir}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate from cached per-image predictions")
+    parser.add_argument('--model', default='runs/train/lung_opacity_detection/weights/best.pt')
+    parser.add_argument('--data', default='dataset.yaml')
+    parser.add_argument('--split', default='val')
+    parser.add_argument('--imgsz', type=int, default=DEFAULT_INFERENCE_PARAMS["imgsz"])
+    parser.add_argument('--batch', type=int, default=16)
+    parser.add_argument('--backend', default='torch')
+    parser.add_argument('--conf', type=float, default=DEFAULT_INFERENCE_PARAMS["conf"])
+    parser.add_argument('--sweep', type=float, nargs='+', default=list(DEFAULT_SWEEP))
+    parser.add_argument('--cache-dir', default='runs/eval_cache')
+    parser.add_argument('--no-plots', action='store_true')
+    parser.add_argument('--output', default=None, help="Also write the results as JSON")
+    args = parser.parse_args()
+
+    results = evaluate_incremental(args.model, args.data, args.split, args.imgsz, args.batch, args.backend,
+                                   args.conf, args.sweep, args.cache_dir, not args.no_plots)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -1,106 +1,455 @@
-from ultralytics import YOLO
 import cv2
+import numpy as np
 import os
 import json
+import glob
+import time
+import argparse
 import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
+from metrics import counter, gauge, record_stage, stage
+from tiling import DEFAULT_TILING_PARAMS, detect_tiled
+
+DEFAULT_MODEL_PATH = 'runs/train/lung_opacity_detection/weights/best.pt'
+
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+# Ultralytics predict defaults, made explicit so they can be part of result cache keys
+DEFAULT_INFERENCE_PARAMS = {"imgsz": 640, "conf": 0.25, "iou": 0.7}
+
+# Cascade triage pass: a low-resolution run that only has to decide whether an image needs the
+# full pass. The threshold is deliberately far below the serving conf so positives are not screened out.
+DEFAULT_CASCADE_PARAMS = {"imgsz": 320, "conf": 0.05}
+
+MODEL_LOAD_SECONDS = gauge("healvision_model_load_seconds", "Time taken to load the most recent model")
+CASCADE_IMAGES = counter("healvision_cascade_images_total", "Images screened out or escalated by the cascade triage pass",
+                         ("outcome",))
+
+# Inference backends; exported graphs are written next to the .pt weights by export.py
+# (FP32) and quantize.py (INT8, only once they pass the recall gate)
+BACKENDS = ('torch', 'onnx', 'openvino', 'onnx_int8', 'openvino_int8')
+
+def resolve_backend_path(model_path, backend='torch'):
+    """
+    Location of the weights a backend runs for a given .pt model
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {BACKENDS}")
+    
+    path = Path(model_path)
+    if backend == 'torch' or path.suffix != '.pt':
+        return str(model_path)
+    if backend == 'onnx':
+        return str(path.with_suffix('.onnx'))
+    if backend == 'onnx_int8':
+        return str(path.with_name(f"{path.stem}_int8.onnx"))
+    if backend == 'openvino_int8':
+        return str(path.parent / f"{path.stem}_int8_openvino_model")
+    return str(path.parent / f"{path.stem}_openvino_model")
 
 class MedicalDetector:
-    def __init__(self, model_path='runs/train/lung_opacity_detection/weights/best.pt'):
+    def __init__(self, model_path=DEFAULT_MODEL_PATH, inference_params=None, backend='torch', cascade=None,
+                 tiling=None):
         """
         Initialize the medical detector with trained YOLOv8 model
+        
+        The 'onnx' and 'openvino' backends run the graph exported by export.py, and
+        the '_int8' variants the model published by quantize.py, all with the same
+        letterbox preprocessing and NMS postprocessing.
+        
+        cascade (True or a dict overriding DEFAULT_CASCADE_PARAMS) enables two-stage
+        detection: a low-resolution triage pass screens every image and only images
+        with a triage detection at or above cascade "conf" get the full pass. The
+        triage pass runs the torch weights (or cascade "model_path") since exported
+        graphs have a fixed input size.
+        
+        tiling (True or a dict overriding tiling.DEFAULT_TILING_PARAMS, plus "batch"
+        for tiles per forward pass) runs each image as overlapping native-resolution
+        tiles and merges the boxes, instead of shrinking the whole film to imgsz.
+        
+        Images are decoded with as many channels as the model takes (self.channels),
+        so a grayscale model never sees a 3-channel copy of the film.
         """
-        print(f"Loading model from: {model_path}")
-        self.model = YOLO(model_path)
+        self.backend = backend
+        self.weights_path = resolve_backend_path(model_path, backend)
+        print(f"Loading model from: {self.weights_path}")
+        start = time.perf_counter()
+        # Imported here so importing this module (e.g. from api.py) does not pull in torch
+        from ultralytics import YOLO
+        self.model = YOLO(self.weights_path, task='detect')
+        self.load_seconds = time.perf_counter() - start
+        MODEL_LOAD_SECONDS.set(self.load_seconds)
         self.model_path = model_path
+        # Grayscale-trained weights (train.py --channels 1) get images decoded straight to one channel
+        self.channels = model_channels(self.model, self.weights_path)
+        if self.channels == 1:
+            print("Model takes single-channel (grayscale) input")
+        self.inference_params = {**DEFAULT_INFERENCE_PARAMS, **(inference_params or {})}
+        
+        self.cascade = None
+        if cascade:
+            self.cascade = {**DEFAULT_CASCADE_PARAMS, **(cascade if isinstance(cascade, dict) else {})}
+            self.cascade.setdefault("model_path", model_path)
+            print(f"Loading cascade triage model from: {self.cascade['model_path']}")
+            self.triage_model = YOLO(self.cascade["model_path"], task='detect')
+        
+        self.tiling = None
+        if tiling:
+            self.tiling = {**DEFAULT_TILING_PARAMS, "batch": 16, **(tiling if isinstance(tiling, dict) else {})}
+        
+        # (stage, seconds) samples of the most recent batch, for callers in other processes
+        self.last_stage_timings = []
     
-    def predict(self, image_path, patient_metadata=None):
+    def infer(self, images, verbose=True):
         """
-        Run inference on a chest X-ray image and return standardized JSON
+        Run a single batched forward pass and return the raw YOLO results
+        
+        Images may be file paths, encoded image bytes or decoded NumPy arrays.
         """
-        # Check if image exists
-        if not os.path.exists(image_path):
-            raise FileNotFoundError(f"Image not found at {image_path}")
+        timings = []
+        start = time.perf_counter()
+        arrays = [load_image(image, self.channels) for image in images]
+        timings.append(("decode", time.perf_counter() - start))
         
-        print(f"Running inference on image: {image_path}")
+        results = self.model(arrays, save=False, batch=len(arrays), verbose=verbose, **self.inference_params)
         
-        # Run inference
-        results = self.model(image_path, save=False)
-        result = results[0]
-        
-        # Process detections
-        detections = []
-        for det in result.boxes:
-            class_id = int(det.cls[0])
-            confidence = float(det.conf[0])
-            bbox = det.xyxy[0].tolist()  # x1, y1, x2, y2
-            
-            detection = {
-                "label": "lung_opacity",
-                "confidence": round(confidence, 4),
-                "bbox": [round(coord, 2) for coord in bbox]  # x1, y1, x2, y2
-            }
-            detections.append(detection)
-        
-        # Create standardized JSON output
-        output = {
-            "detections": detections,
-            "image_metadata": {
-                "filename": Path(image_path).name,
-                "image_size": {
-                    "width": result.orig_img.shape[1],
-                    "height": result.orig_img.shape[0]
-                }
-            }
-        }
+        # Ultralytics reports per-image milliseconds for its own stages
+        for result in results:
+            for name in ("preprocess", "inference", "postprocess"):
+                timings.append((name, result.speed[name] / 1000.0))
         
-        # Add patient metadata if provided
-        if patient_metadata:
-            output["patient_metadata"] = patient_metadata
-            
-            # Generate cryptographic hash for audit trail
-            timestamp = datetime.utcnow().isoformat()
-            output["timestamp"] = timestamp
+        for name, seconds in timings:
+            record_stage(name, seconds)
+        self.last_stage_timings = timings
+        return results
+    
+    def triage(self, images, conf=None):
+        """
+        Cascade first stage: highest low-resolution detection confidence per image
+        
+        Images scoring below conf (default: the cascade threshold) come back as 0.0.
+        """
+        conf = self.cascade["conf"] if conf is None else conf
+        results = self.triage_model(images, save=False, batch=len(images), verbose=False,
+                                    imgsz=self.cascade["imgsz"], conf=conf, iou=self.inference_params["iou"])
+        return [float(result.boxes.conf.max()) if len(result.boxes) else 0.0 for result in results]
+    
+    def detect_batch(self, images, cascade=True, tiled=True):
+        """
+        Run a single batched forward pass and return one detection payload per image
+        
+        With a cascade configured, images screened out by the triage pass get an empty
+        payload without a full pass; cascade=False forces the full pass for every image.
+        With tiling configured each image is run as a batch of tiles; tiled=False
+        runs the images whole.
+        """
+        if self.tiling is not None and tiled:
+            return self._detect_tiled(images, cascade)
+        if self.cascade is not None and cascade:
+            return self._detect_cascade(images)
+        
+        results = self.infer(images)
+        
+        start = time.perf_counter()
+        payloads = [format_result(result) for result in results]
+        seconds = time.perf_counter() - start
+        record_stage("format", seconds)
+        self.last_stage_timings.append(("format", seconds))
+        return payloads
+    
+    def _detect_tiled(self, images, cascade):
+        params = dict(self.tiling)
+        chunk_size = params.pop("batch")
+        timings = []
+        
+        def run_tiles(tiles):
+            payloads = self.detect_batch(tiles, cascade=cascade, tiled=False)
+            timings.extend(self.last_stage_timings)
+            return payloads
+        
+        payloads = []
+        for image in images:
+            array = load_image(image, self.channels)
+            start = time.perf_counter()
+            payloads.append(detect_tiled(array, run_tiles, chunk_size=chunk_size, **params))
+            # Wall time of the whole image, tiles and merge included
+            timings.append(("tiled_image", time.perf_counter() - start))
+            record_stage("tiled_image", timings[-1][1])
+        self.last_stage_timings = timings
+        return payloads
+    
+    def _detect_cascade(self, images):
+        timings = []
+        start = time.perf_counter()
+        arrays = [load_image(image, self.channels) for image in images]
+        timings.append(("decode", time.perf_counter() - start))
+        
+        start = time.perf_counter()
+        scores = self.triage(arrays)
+        timings.append(("triage", time.perf_counter() - start))
+        for name, seconds in timings:
+            record_stage(name, seconds)
+        
+        escalated = [i for i, score in enumerate(scores) if score > 0.0]
+        CASCADE_IMAGES.inc(len(escalated), outcome="escalated")
+        CASCADE_IMAGES.inc(len(arrays) - len(escalated), outcome="screened_out")
+        
+        payloads = [
+            {"detections": [], "image_size": {"width": array.shape[1], "height": array.shape[0]}}
+            for array in arrays
+        ]
+        if escalated:
+            full = self.detect_batch([arrays[i] for i in escalated], cascade=False)
+            for i, payload in zip(escalated, full):
+                payloads[i] = payload
+            timings.extend(self.last_stage_timings)
+        self.last_stage_timings = timings
+        return payloads
+    
+    def predict(self, image, patient_metadata=None, filename=None):
+        """
+        Run inference on a chest X-ray image and return standardized JSON
+        
+        Args:
+            image: Path to the image, encoded image bytes, or a decoded NumPy array
+            patient_metadata: Optional patient metadata for the audit trail
+            filename: Name reported in image_metadata (defaults to the file name of a path)
+        """
+        if isinstance(image, (str, Path)):
+            # Check if image exists
+            if not os.path.exists(image):
+                raise FileNotFoundError(f"Image not found at {image}")
             
-            # Create hash input
-            hash_input = f"{patient_metadata.get('patient_id', '')}_{len(detections)}_{timestamp}"
-            output["audit_hash"] = hashlib.sha256(hash_input.encode()).hexdigest()
+            print(f"Running inference on image: {image}")
+            if filename is None:
+                filename = Path(image).name
+        
+        # Run inference
+        payload = self.detect_batch([image])[0]
         
-        return output
+        return build_output(payload, filename or "image", patient_metadata)
     
-    def analyze_with_explanation(self, image_path, patient_metadata=None):
+    def analyze_with_explanation(self, image, patient_metadata=None, filename=None):
         """
         Enhanced analysis with LLM-generated clinical explanation
         """
         # Get standard detection results
-        results = self.predict(image_path, patient_metadata)
+        results = self.predict(image, patient_metadata, filename)
+        
+        return add_clinical_explanation(results)
+
+def model_channels(model, weights_path):
+    """
+    Input channels of a loaded YOLO model: 1 for grayscale weights, otherwise 3
+    
+    Exported graphs carry the channel count in their Ultralytics metadata.
+    """
+    if hasattr(model.model, 'yaml'):
+        return int(model.model.yaml.get('channels', 3))
+    from ultralytics.nn.backends.base import BaseBackend
+    return int(BaseBackend.read_metadata(weights_path).get('channels', 3))
+
+def load_image(image, channels=3):
+    """
+    Decode an image path, encoded bytes or array into a uint8 array without temp files
+    
+    channels=3 gives a BGR (H, W, 3) array. channels=1 gives a grayscale (H, W)
+    array, decoded directly to one channel; arrays that already have one channel
+    are returned as they are.
+    """
+    if isinstance(image, np.ndarray):
+        if channels == 1:
+            if image.ndim == 3 and image.shape[2] in (3, 4):
+                return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY if image.shape[2] == 3 else cv2.COLOR_BGRA2GRAY)
+            return image
+        if image.ndim == 2:
+            return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        return image
+    
+    if isinstance(image, (str, Path)):
+        if not os.path.exists(image):
+            raise FileNotFoundError(f"Image not found at {image}")
+        buffer = np.fromfile(image, dtype=np.uint8)
+    else:
+        buffer = np.frombuffer(image, dtype=np.uint8)
+    
+    decoded = cv2.imdecode(buffer, cv2.IMREAD_GRAYSCALE if channels == 1 else cv2.IMREAD_COLOR)
+    if decoded is None:
+        raise ValueError("Could not decode image data")
+    return decoded
+
+def load_raw_pixels(buffer, dtype, width, height, window_center=None, window_width=None, invert=False):
+    """
+    Wrap a raw grayscale pixel buffer (row-major, no header) as a uint8 image for the detector
+
+    8-bit pixels without windowing or inversion are used in place, without a copy.
+    Other pixels go through a lookup table built from the window (DICOM-style
+    linear VOI: center/width; default the image's own min..max). invert is for
+    MONOCHROME1 data, where low values are bright.
+
+    Args:
+        buffer: bytes-like object holding exactly width * height pixels
+        dtype: NumPy dtype of a pixel: uint8, uint16 or int16, optionally with byte order ('>u2')
+    """
+    try:
+        dtype = np.dtype(dtype)
+    except TypeError as e:
+        raise ValueError(f"Unknown pixel dtype '{dtype}'") from e
+    if dtype.kind not in 'ui' or dtype.itemsize > 2:
+        raise ValueError(f"Unsupported pixel dtype '{dtype}', expected 8- or 16-bit integers")
+    if width < 1 or height < 1:
+        raise ValueError("width and height must be positive")
+    if len(buffer) != width * height * dtype.itemsize:
+        raise ValueError(f"Expected {width * height * dtype.itemsize} bytes for {width}x{height} {dtype}, "
+                         f"got {len(buffer)}")
+
+    pixels = np.frombuffer(buffer, dtype=dtype).reshape(height, width)
+    if dtype == np.uint8 and window_width is None and not invert:
+        return pixels
+
+    if window_width is None:
+        low, high = float(pixels.min()), float(pixels.max())
+    else:
+        if window_width <= 0:
+            raise ValueError("window_width must be positive")
+        low = window_center - window_width / 2.0
+        high = window_center + window_width / 2.0
+
+    native = dtype.newbyteorder('=')
+    if dtype != native:
+        pixels = pixels.astype(native)
+    # One table entry per possible pixel value, indexed by the pixel's bits read as unsigned
+    index_dtype = np.uint16 if dtype.itemsize == 2 else np.uint8
+    values = np.arange(256 ** dtype.itemsize, dtype=index_dtype).view(native).astype(np.float32)
+    lut = np.clip((values - low) * (255.0 / max(high - low, 1e-6)), 0, 255).astype(np.uint8)
+    if invert:
+        lut = 255 - lut
+    return lut[pixels.view(index_dtype)]
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """
+    SHA-256 of a file's contents (used to identify model weights)
+    
+    Directories (e.g. OpenVINO models) hash every file with its relative path.
+    """
+    path = Path(path)
+    files = sorted(p for p in path.rglob('*') if p.is_file()) if path.is_dir() else [path]
+    
+    digest = hashlib.sha256()
+    for file in files:
+        if path.is_dir():
+            digest.update(file.relative_to(path).as_posix().encode())
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def warm_up(detector, runs=2, imgsz=DEFAULT_INFERENCE_PARAMS["imgsz"]):
+    """
+    Run dummy inferences so the first real request does not pay for graph warm-up
+
+    Works for anything with detect_batch(), including process replicas.
+    """
+    dummy = np.full((imgsz, imgsz, getattr(detector, "channels", 3)), 114, dtype=np.uint8)
+    start = time.perf_counter()
+    for _ in range(runs):
+        # A cascade would screen the blank image out before the full pass
+        detector.detect_batch([dummy], cascade=False, tiled=False)
+    if getattr(detector, "cascade", None):
+        detector.detect_batch([dummy])
+    return time.perf_counter() - start
+
+def format_result(result):
+    """
+    Convert a single YOLO result into a detection payload (detections + image size)
+    """
+    # Process detections
+    detections = []
+    for det in result.boxes:
+        class_id = int(det.cls[0])
+        confidence = float(det.conf[0])
+        bbox = det.xyxy[0].tolist()  # x1, y1, x2, y2
         
-        # Generate clinical explanation (mock LLM integration)
-        detections = results["detections"]
+        detection = {
+            "label": "lung_opacity",
+            "confidence": round(confidence, 4),
+            "bbox": [round(coord, 2) for coord in bbox]  # x1, y1, x2, y2
+        }
+        detections.append(detection)
+    
+    return {
+        "detections": detections,
+        "image_size": {
+            "width": result.orig_img.shape[1],
+            "height": result.orig_img.shape[0]
+        }
+    }
+
+def build_output(payload, filename, patient_metadata=None):
+    """
+    Build the standardized JSON output from a detection payload
+    """
+    detections = payload["detections"]
+    
+    # Create standardized JSON output
+    output = {
+        "detections": detections,
+        "image_metadata": {
+            "filename": filename,
+            "image_size": dict(payload["image_size"])
+        }
+    }
+    
+    # Add patient metadata if provided
+    if patient_metadata:
+        output["patient_metadata"] = patient_metadata
         
-        if not detections:
-            explanation = "No lung opacities detected. Chest X-ray appears normal."
-        else:
-            count = len(detections)
-            confidences = [d["confidence"] for d in detections]
-            avg_confidence = sum(confidences) / len(confidences)
-            
-            explanation = f"Detected {count} lung opacity{"s" if count > 1 else ""} with average confidence of {avg_confidence:.1%}. "
-            explanation += "Findings suggest possible pneumonia or other pulmonary pathology. Clinical correlation recommended."
+        # Generate cryptographic hash for audit trail
+        timestamp = datetime.utcnow().isoformat()
+        output["timestamp"] = timestamp
         
-        results["clinical_explanation"] = explanation
-        return results
+        # Create hash input
+        hash_input = f"{patient_metadata.get('patient_id', '')}_{len(detections)}_{timestamp}"
+        output["audit_hash"] = hashlib.sha256(hash_input.encode()).hexdigest()
+    
+    return output
+
+def add_clinical_explanation(results):
+    """
+    Attach the (mock LLM) clinical explanation to standardized results
+    """
+    detections = results["detections"]
+    
+    if not detections:
+        explanation = "No lung opacities detected. Chest X-ray appears normal."
+    else:
+        count = len(detections)
+        confidences = [d["confidence"] for d in detections]
+        avg_confidence = sum(confidences) / len(confidences)
+        
+        explanation = f"Detected {count} lung opacity{'s' if count > 1 else ''} with average confidence of {avg_confidence:.1%}. "
+        explanation += "Findings suggest possible pneumonia or other pulmonary pathology. Clinical correlation recommended."
+    
+    results["clinical_explanation"] = explanation
+    return results
 
-def run_inference(image_path, model_path='runs/train/lung_opacity_detection/weights/best.pt', output_path='output'):
+def run_inference(image_path, model_path=DEFAULT_MODEL_PATH, output_path='output', detector=None):
     """
     Backward compatible function - now wraps the MedicalDetector class
     """
-    detector = MedicalDetector(model_path)
+    if detector is None:
+        detector = MedicalDetector(model_path)
     
     try:
-        # Run prediction
-        results = detector.predict(image_path)
+        if not os.path.exists(image_path):
+            raise FileNotFoundError(f"Image not found at {image_path}")
+        
+        # Run prediction once; the same result feeds the JSON and the annotated image
+        results_obj = detector.infer([image_path])[0]
+        results = build_output(format_result(results_obj), Path(image_path).name)
         
         # Create output directory
         os.makedirs(output_path, exist_ok=True)
@@ -115,7 +464,6 @@ def run_inference(image_path, model_path='runs/train/lung_opacity_detection/weig
         print(f"\nJSON results saved to: {json_output_path}")
         
         # Also save annotated image for visualization
-        results_obj = detector.model(image_path, save=False)[0]
         annotated_img = results_obj.plot()
         output_image_path = os.path.join(output_path, f"inference_result_{image_filename}.jpg")
         cv2.imwrite(output_image_path, annotated_img)
@@ -136,10 +484,141 @@ def run_inference(image_path, model_path='runs/train/lung_opacity_detection/weig
         print(f"Error during inference: {e}")
         return None
 
+def expand_source(source):
+    """
+    List the images under a directory (recursively) or matching a glob pattern, in stable order
+    """
+    if os.path.isdir(source):
+        paths = (p for p in Path(source).rglob('*') if p.is_file())
+    else:
+        paths = (Path(p) for p in glob.glob(source, recursive=True))
+    return sorted(str(p) for p in paths if p.suffix.lower() in IMAGE_SUFFIXES)
+
+def load_completed(output_file):
+    """
+    Image paths already present in a JSONL output file (for resuming)
+    
+    A partially written last line from an interrupted run is truncated away.
+    """
+    if not os.path.exists(output_file):
+        return set()
+    
+    completed = set()
+    valid_bytes = 0
+    with open(output_file, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                completed.add(json.loads(line)["image_path"])
+            except (ValueError, KeyError):
+                pass
+            valid_bytes += len(line)
+    
+    if valid_bytes != os.path.getsize(output_file):
+        with open(output_file, 'r+b') as f:
+            f.truncate(valid_bytes)
+    return completed
+
+def run_batch_inference(source, output_file, model_path=DEFAULT_MODEL_PATH, batch_size=16,
+                        prefetch_workers=4, annotate_dir=None, backend='torch', detector=None, cascade=None,
+                        tiling=None):
+    """
+    Run inference over a directory or glob of images, streaming one JSON line per image
+    
+    Images are decoded ahead of time by a background thread pool and run through the
+    model in batches. Images already present in output_file are skipped, so an
+    interrupted backfill can simply be restarted. cascade and tiling are passed to
+    MedicalDetector (annotated images need every full, untiled result, so annotate_dir
+    disables both).
+    """
+    paths = expand_source(source)
+    completed = load_completed(output_file)
+    pending = [path for path in paths if path not in completed]
+    print(f"Found {len(paths)} images, {len(completed)} already done, {len(pending)} to process")
+    if not pending:
+        return 0
+    
+    if detector is None:
+        detector = MedicalDetector(model_path, backend=backend, cascade=None if annotate_dir else cascade,
+                                   tiling=None if annotate_dir else tiling)
+    if annotate_dir:
+        os.makedirs(annotate_dir, exist_ok=True)
+    output_dir = os.path.dirname(output_file)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    
+    processed = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=prefetch_workers) as pool, open(output_file, 'a') as out:
+        # Keep a bounded number of batches decoding ahead of the model
+        decoding = deque()
+        remaining = iter(pending)
+        
+        def refill():
+            while len(decoding) < batch_size * (prefetch_workers + 1):
+                path = next(remaining, None)
+                if path is None:
+                    return
+                decoding.append((path, pool.submit(load_image, path, detector.channels)))
+        
+        refill()
+        while decoding:
+            batch_paths, arrays, lines = [], [], []
+            while decoding and len(batch_paths) < batch_size:
+                path, future = decoding.popleft()
+                try:
+                    arrays.append(future.result())
+                    batch_paths.append(path)
+                except Exception as e:
+                    lines.append({"image_path": path, "error": f"Decode failed: {e}"})
+            refill()
+            
+            if (getattr(detector, "cascade", None) or getattr(detector, "tiling", None)) and not annotate_dir:
+                payloads = detector.detect_batch(arrays) if arrays else []
+                for path, payload in zip(batch_paths, payloads):
+                    lines.append({"image_path": path, **build_output(payload, Path(path).name)})
+            else:
+                results = detector.infer(arrays, verbose=False) if arrays else []
+                for path, result in zip(batch_paths, results):
+                    output = build_output(format_result(result), Path(path).name)
+                    lines.append({"image_path": path, **output})
+                    if annotate_dir:
+                        cv2.imwrite(os.path.join(annotate_dir, f"inference_result_{Path(path).stem}.jpg"), result.plot())
+            
+            for line in lines:
+                out.write(json.dumps(line) + '\n')
+            out.flush()
+            
+            processed += len(lines)
+            elapsed = time.perf_counter() - start
+            print(f"Processed {processed}/{len(pending)} images ({processed / elapsed:.1f} img/s)")
+    
+    return processed
+
 if __name__ == "__main__":
-    # Example usage (this will fail if no test image exists, but that's OK for now)
-    print("YOLOv8 Inference Script")
-    print("Note: To run inference, place a test image in the appropriate location and update the path below.")
+    parser = argparse.ArgumentParser(description="YOLOv8 lung opacity inference")
+    parser.add_argument('source', nargs='?', help="Image directory or glob pattern (e.g. 'archive/**/*.jpg')")
+    parser.add_argument('--output', default='output/detections.jsonl', help="JSONL file, appended to and resumable")
+    parser.add_argument('--model', default=DEFAULT_MODEL_PATH)
+    parser.add_argument('--backend', default='torch', choices=BACKENDS)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--prefetch-workers', type=int, default=4, help="Background decode threads")
+    parser.add_argument('--annotate-dir', default=None, help="Also write annotated images here")
+    parser.add_argument('--cascade', action='store_true', help="Screen images with a low-resolution triage pass first")
+    parser.add_argument('--cascade-imgsz', type=int, default=DEFAULT_CASCADE_PARAMS["imgsz"])
+    parser.add_argument('--cascade-conf', type=float, default=DEFAULT_CASCADE_PARAMS["conf"])
+    parser.add_argument('--tiled', action='store_true', help="Run full-resolution images as overlapping tiles")
+    parser.add_argument('--tile-size', type=int, default=DEFAULT_TILING_PARAMS["tile_size"])
+    parser.add_argument('--tile-overlap', type=float, default=DEFAULT_TILING_PARAMS["overlap"])
+    args = parser.parse_args()
     
-    # Example usage with a placeholder path
-    # run_inference('data/images/test/your_test_image.jpg')
\ No newline at end of file
+    if args.source is None:
+        print("YOLOv8 Inference Script")
+        print("Usage: python inference.py <directory or glob> [--output results.jsonl] [--batch-size 16]")
+        print("For a single image from Python: run_inference('data/images/test/your_test_image.jpg')")
+    else:
+        cascade = {"imgsz": args.cascade_imgsz, "conf": args.cascade_conf} if args.cascade else None
+        tiling = {"tile_size": args.tile_size, "overlap": args.tile_overlap} if args.tiled else None
+        run_batch_inference(args.source, args.output, args.model, args.batch_size,
+                            args.prefetch_workers, args.annotate_dir, args.backend, cascade=cascade, tiling=tiling)
\ No newline at end of file
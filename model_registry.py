@@ -0,0 +1,344 @@
+"""
+Registry of versioned model weights with hot-swap and LRU residency.
+
+Several versions can be registered (e.g. the current best.pt and a candidate
+from a new train.py run). Requests pick a version by name or fall back to the
+default. Only some versions are resident at a time: loading one that does not
+fit the memory budget evicts the least recently used residents.
+
+Every resident version has its own replicas and BatchScheduler. Requests hold a
+lease on the resident they were routed to, so evicting or swapping a version
+only stops new requests from reaching it; its scheduler is closed once the
+last in-flight request has finished.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+
+from inference import resolve_backend_path
+from metrics import counter, gauge
+
+MODEL_EVENTS = counter("healvision_model_events_total", "Model registry loads, swaps and evictions", ("event",))
+RESIDENT_MODELS = gauge("healvision_resident_models", "Model versions currently loaded")
+RESIDENT_BYTES = gauge("healvision_resident_model_bytes", "Memory of the loaded model versions (measured RSS, or an estimate)")
+
+
+class UnknownModelError(KeyError):
+    """Raised when a request names a model version that is not registered"""
+
+
+# Per-replica memory estimate for when RSS cannot be measured (no /proc): fixed runtime
+# overhead plus a multiple of the weights size. Rough figures from YOLOv8n at 640 on CPU,
+# loaded and warmed up; an estimate only, not a bound.
+BACKEND_MEMORY_ESTIMATES = {
+    'torch': (200 * 1024 * 1024, 4.0),
+    'onnx': (250 * 1024 * 1024, 2.0),
+    'onnx_int8': (250 * 1024 * 1024, 2.0),
+    'openvino': (300 * 1024 * 1024, 2.0),
+    'openvino_int8': (300 * 1024 * 1024, 2.0)
+}
+
+
+def model_bytes(model_path, backend='torch'):
+    """
+    Size on disk of the weights a backend runs
+    """
+    path = Path(resolve_backend_path(model_path, backend))
+    if path.is_dir():
+        return sum(p.stat().st_size for p in path.rglob('*') if p.is_file())
+    return path.stat().st_size
+
+
+def estimate_replica_bytes(model_path, backend='torch'):
+    """
+    Estimated memory of one loaded replica, from BACKEND_MEMORY_ESTIMATES
+    """
+    overhead, factor = BACKEND_MEMORY_ESTIMATES[backend]
+    return int(overhead + factor * model_bytes(model_path, backend))
+
+
+def rss_bytes(pid='self'):
+    """
+    Resident set size of a process in bytes, or None where /proc is not available
+    """
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class ResidentModel:
+    """
+    A loaded model version: replicas, scheduler and the leases held by in-flight requests
+    """
+
+    def __init__(self, version, spec, batcher, memory_bytes, model_hash=None, replica_pool=None):
+        self.version = version
+        self.spec = spec
+        self.batcher = batcher
+        self.memory_bytes = memory_bytes
+        self.model_hash = model_hash
+        self.replica_pool = replica_pool
+        self.loaded_at = time.time()
+
+        self._lock = threading.Lock()
+        self._leases = 0
+        self._retired = False
+        self._closed = False
+
+    def acquire(self):
+        with self._lock:
+            if self._retired:
+                return False
+            self._leases += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._leases -= 1
+            drained = self._retired and self._leases == 0
+        if drained:
+            self._close()
+
+    def retire(self, wait=False):
+        """
+        Stop taking new leases; shut down once in-flight requests have drained
+
+        With wait=True an already drained model is shut down before returning.
+        """
+        with self._lock:
+            self._retired = True
+            drained = self._leases == 0
+        if drained:
+            self._close(wait)
+
+    def in_flight(self):
+        with self._lock:
+            return self._leases
+
+    def _close(self, wait=False):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if wait:
+            self._shutdown()
+        else:
+            # Off the caller's thread: release() may run on a batch worker of this very scheduler
+            threading.Thread(target=self._shutdown, name=f"retire-{self.version}", daemon=True).start()
+
+    def _shutdown(self):
+        self.batcher.close(timeout=30)
+        if self.replica_pool is not None:
+            self.replica_pool.close()
+        print(f"Model {self.version} unloaded")
+
+
+class ModelRegistry:
+    def __init__(self, load_model, memory_budget_bytes=None):
+        """
+        Args:
+            load_model: Callable (version, spec) -> ResidentModel that loads and warms up a version
+            memory_budget_bytes: Cap on the summed memory_bytes of resident versions (None: unbounded)
+        """
+        self.load_model = load_model
+        self.memory_budget_bytes = memory_budget_bytes
+
+        self._lock = threading.Lock()
+        self._specs = {}
+        self._resident = OrderedDict()  # version -> ResidentModel, least recently used first
+        self._loading = {}  # version -> Future of the ResidentModel being loaded
+        self.default_version = None
+
+    def register(self, version, model_path, backend='torch', default=False, preload=False):
+        """
+        Add a version, or atomically replace the weights behind an existing one
+
+        A replaced version that is resident (or preload=True) is loaded and warmed
+        up before the swap, so requests never wait on the new weights; requests
+        already running on the old weights finish on them.
+        """
+        spec = {"model_path": str(model_path), "backend": backend}
+        Path(resolve_backend_path(model_path, backend)).stat()  # fail early on missing weights
+
+        with self._lock:
+            swap = preload or (version in self._resident and self._specs.get(version) != spec)
+        replacement = self.load_model(version, spec) if swap else None
+
+        with self._lock:
+            self._specs[version] = spec
+            if default or self.default_version is None:
+                self.default_version = version
+            if replacement is not None:
+                previous = self._resident.pop(version, None)
+                self._make_room(replacement.memory_bytes)
+                self._resident[version] = replacement
+                self._update_gauges()
+            else:
+                previous = None
+
+        if previous is not None:
+            previous.retire()
+            MODEL_EVENTS.inc(event="swap")
+            print(f"Model {version} swapped to {model_path}")
+        return version
+
+    def set_default(self, version):
+        with self._lock:
+            if version not in self._specs:
+                raise UnknownModelError(version)
+            self.default_version = version
+
+    def unregister(self, version):
+        with self._lock:
+            if version not in self._specs:
+                raise UnknownModelError(version)
+            if version == self.default_version:
+                raise ValueError("Cannot remove the default model version")
+            del self._specs[version]
+            resident = self._resident.pop(version, None)
+            self._update_gauges()
+        if resident is not None:
+            resident.retire()
+
+    def resolve(self, version=None):
+        """
+        Registered version name for a request (the default when none is given)
+        """
+        with self._lock:
+            version = version or self.default_version
+            if version not in self._specs:
+                raise UnknownModelError(version)
+            return version
+
+    def is_resident(self, version=None):
+        with self._lock:
+            return (version or self.default_version) in self._resident
+
+    def acquire(self, version=None):
+        """
+        Lease the resident model for a version, loading it first if needed (may block)
+
+        The caller must call release() on the returned model when its request is done.
+        """
+        version = self.resolve(version)
+        while True:
+            with self._lock:
+                resident = self._resident.get(version)
+                if resident is not None:
+                    self._resident.move_to_end(version)
+                    if resident.acquire():
+                        return resident
+                    continue  # retired between lookup and lease; the replacement is already in place
+
+                loading = self._loading.get(version)
+                owner = loading is None
+                if owner:
+                    loading = self._loading[version] = Future()
+                    spec = self._specs[version]
+
+            if owner:
+                self._load(version, spec, loading)
+            loading.result()
+
+    def _load(self, version, spec, loading):
+        try:
+            resident = self.load_model(version, spec)
+        except Exception as e:
+            with self._lock:
+                self._loading.pop(version, None)
+            loading.set_exception(e)
+            MODEL_EVENTS.inc(event="load_failed")
+            return
+
+        with self._lock:
+            self._loading.pop(version, None)
+            if self._specs.get(version) != spec:
+                # Re-registered while loading; that registration already installed its own weights
+                stale = resident
+            else:
+                stale = None
+                self._make_room(resident.memory_bytes)
+                self._resident[version] = resident
+                self._update_gauges()
+        if stale is not None:
+            stale.retire()
+        MODEL_EVENTS.inc(event="load")
+        loading.set_result(resident)
+
+    def _make_room(self, needed_bytes):
+        """
+        Evict least recently used residents until needed_bytes fits the budget (lock held)
+        """
+        if self.memory_budget_bytes is None:
+            return
+        while self._resident and self._resident_bytes() + needed_bytes > self.memory_budget_bytes:
+            version, evicted = self._resident.popitem(last=False)
+            evicted.retire()
+            MODEL_EVENTS.inc(event="eviction")
+            print(f"Evicting model {version} to stay within the memory budget")
+        if needed_bytes > self.memory_budget_bytes:
+            print(f"Warning: model needs {needed_bytes} bytes, more than the whole budget "
+                  f"({self.memory_budget_bytes}); loading it anyway")
+
+    def _resident_bytes(self):
+        return sum(resident.memory_bytes for resident in self._resident.values())
+
+    def _update_gauges(self):
+        RESIDENT_MODELS.set(len(self._resident))
+        RESIDENT_BYTES.set(self._resident_bytes())
+
+    def residents(self):
+        with self._lock:
+            return list(self._resident.values())
+
+    def queue_depth(self):
+        return sum(resident.batcher.queue_depth() for resident in self.residents())
+
+    def stats(self):
+        with self._lock:
+            specs = dict(self._specs)
+            resident = dict(self._resident)
+            default = self.default_version
+            budget = self.memory_budget_bytes
+            used = self._resident_bytes()
+
+        return {
+            "default": default,
+            "memory_budget_bytes": budget,
+            "resident_bytes": used,
+            "models": {
+                version: {
+                    **spec,
+                    "resident": version in resident,
+                    "memory_bytes": resident[version].memory_bytes if version in resident else None,
+                    "in_flight": resident[version].in_flight() if version in resident else 0,
+                    "loaded_at": resident[version].loaded_at if version in resident else None
+                }
+                for version, spec in specs.items()
+            }
+        }
+
+    def close(self):
+        with self._lock:
+            residents = list(self._resident.values())
+            self._resident.clear()
+            self._update_gauges()
+        for resident in residents:
+            resident.retire(wait=True)
+
+
+def load_registry_file(path):
+    """
+    Read a registry file: {"default": "v1", "models": {"v1": {"model_path": ..., "backend": ...}}}
+    """
+    with open(path) as f:
+        config = json.load(f)
+    if not config.get("models"):
+        raise ValueError(f"No models defined in {path}")
+    return config
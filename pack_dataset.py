@@ -0,0 +1,408 @@
+"""
+Pack the dataset into memory-mapped shards for training and evaluation.
+
+Each split listed in dataset.yaml becomes:
+- <split>_<imgsz>_<C>ch.images.npy: uint8 array (N, imgsz, imgsz, C) with every image
+  resized the way Ultralytics does it (long side to imgsz) and stored
+  top-left aligned
+- <split>_<imgsz>_<C>ch.labels.npz: box index (class, x, y, w, h normalized) with
+  per-image offsets, plus original and resized shapes
+- <split>_<imgsz>_<C>ch.json: manifest with a fingerprint of the source files
+
+The shard is opened with np.load(mmap_mode='r'), so data loader workers share
+the page cache instead of each decoding JPEGs. Shards are rebuilt whenever
+the fingerprint (file names, sizes and mtimes of images and labels) changes.
+Every packer writes to temporary files of its own and renames them into
+place, so processes packing the same split at once do not corrupt each other.
+Chest X-rays are grayscale, so the default is a single channel that is
+expanded to BGR on load unless the model itself takes one channel.
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import uuid
+from copy import copy
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+import yaml
+from ultralytics.data.dataset import YOLODataset
+from ultralytics.models.yolo.detect import DetectionTrainer, DetectionValidator
+from ultralytics.utils import colorstr
+from ultralytics.utils.torch_utils import unwrap_model
+
+from inference import IMAGE_SUFFIXES
+
+PACK_VERSION = 1
+DEFAULT_CHANNELS = 1
+
+
+def default_pack_dir(image_dir):
+    """
+    data/images/<split> -> data/packed
+    """
+    return Path(image_dir).resolve().parent.parent / 'packed'
+
+
+def label_path(image_path):
+    """
+    Ultralytics convention: .../images/<split>/x.jpg -> .../labels/<split>/x.txt
+    """
+    parts = list(Path(image_path).parts)
+    index = len(parts) - 1 - parts[::-1].index('images')
+    parts[index] = 'labels'
+    return Path(*parts).with_suffix('.txt')
+
+
+def shard_stem(image_dir, imgsz, channels, pack_dir=None):
+    """
+    data/images/<split> -> data/packed/<split>_<imgsz>_<channels>ch
+    """
+    pack_dir = Path(pack_dir) if pack_dir else default_pack_dir(image_dir)
+    return pack_dir / f"{Path(image_dir).name}_{imgsz}_{channels}ch"
+
+
+def list_split_images(image_dir):
+    image_dir = Path(image_dir)
+    if not image_dir.is_dir():
+        raise ValueError(f"Packed datasets need an image directory, got {image_dir}")
+    return sorted(p for p in image_dir.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+
+
+def fingerprint(images, imgsz, channels):
+    """
+    Hash of the source files' names, sizes and mtimes plus the packing parameters
+    """
+    digest = hashlib.sha256(f"{PACK_VERSION}:{imgsz}:{channels}".encode())
+    for image in images:
+        for path in (image, label_path(image)):
+            try:
+                stat = path.stat()
+                digest.update(f"{path.name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+            except FileNotFoundError:
+                digest.update(f"{path.name}:missing\n".encode())
+    return digest.hexdigest()
+
+
+def read_labels(path):
+    """
+    YOLO label file -> (n, 5) float32 of class, x, y, w, h (polygons reduced to boxes)
+    """
+    rows = []
+    if path.exists():
+        with open(path) as f:
+            for line in f:
+                values = [float(v) for v in line.split()]
+                if len(values) == 5:
+                    rows.append(values)
+                elif len(values) > 5:
+                    xy = np.array(values[1:]).reshape(-1, 2)
+                    (x0, y0), (x1, y1) = xy.min(0), xy.max(0)
+                    rows.append([values[0], (x0 + x1) / 2, (y0 + y1) / 2, x1 - x0, y1 - y0])
+    return np.array(rows, dtype=np.float32).reshape(-1, 5)
+
+
+def resize_like_ultralytics(image, imgsz):
+    """
+    Long side to imgsz keeping aspect ratio, as BaseDataset.load_image(rect_mode=True)
+    """
+    h0, w0 = image.shape[:2]
+    r = imgsz / max(h0, w0)
+    if r != 1:
+        w, h = min(math.ceil(w0 * r), imgsz), min(math.ceil(h0 * r), imgsz)
+        image = cv2.resize(image, (w, h), interpolation=cv2.INTER_LINEAR)
+    return image
+
+
+def pack_split(image_dir, imgsz=640, pack_dir=None, channels=DEFAULT_CHANNELS, workers=None):
+    """
+    Decode, resize and write one split to its shard, label index and manifest
+
+    Returns the manifest path.
+    """
+    images = list_split_images(image_dir)
+    if not images:
+        raise FileNotFoundError(f"No images found in {image_dir}")
+
+    stem = shard_stem(image_dir, imgsz, channels, pack_dir)
+    stem.parent.mkdir(parents=True, exist_ok=True)
+    # Unique per packer: concurrent packers of the same split must not share temporary files
+    tmp = f"{os.getpid()}-{uuid.uuid4().hex[:8]}.tmp"
+    print(f"Packing {len(images)} images from {image_dir} into {stem}.images.npy...")
+
+    source_fingerprint = fingerprint(images, imgsz, channels)
+    shard_tmp = Path(f"{stem}.images.{tmp}.npy")
+    shard = np.lib.format.open_memmap(shard_tmp, mode='w+', dtype=np.uint8,
+                                      shape=(len(images), imgsz, imgsz, channels))
+    original_shapes = np.zeros((len(images), 2), dtype=np.int32)
+    resized_shapes = np.zeros((len(images), 2), dtype=np.int32)
+    flag = cv2.IMREAD_GRAYSCALE if channels == 1 else cv2.IMREAD_COLOR
+
+    def pack_one(i):
+        image = cv2.imread(str(images[i]), flag)
+        if image is None:
+            raise ValueError(f"Could not decode {images[i]}")
+        original_shapes[i] = image.shape[:2]
+        image = resize_like_ultralytics(image, imgsz)
+        h, w = image.shape[:2]
+        resized_shapes[i] = (h, w)
+        shard[i, :h, :w] = image.reshape(h, w, channels)
+
+    # cv2 releases the GIL for decode and resize
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        list(pool.map(pack_one, range(len(images))))
+    shard.flush()
+    del shard
+
+    labels = [read_labels(label_path(image)) for image in images]
+    offsets = np.zeros(len(images) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(lb) for lb in labels])
+    boxes = np.concatenate(labels) if labels else np.zeros((0, 5), dtype=np.float32)
+
+    index_tmp = Path(f"{stem}.labels.{tmp}.npz")
+    np.savez(index_tmp, boxes=boxes, offsets=offsets, original_shapes=original_shapes,
+             resized_shapes=resized_shapes)
+
+    manifest = {
+        "version": PACK_VERSION,
+        "fingerprint": source_fingerprint,
+        "image_dir": str(Path(image_dir).resolve()),
+        "imgsz": imgsz,
+        "channels": channels,
+        "count": len(images),
+        "boxes": int(len(boxes)),
+        "files": [str(image.resolve()) for image in images]
+    }
+
+    # Manifest goes last: a shard is only valid once its manifest matches
+    os.replace(shard_tmp, f"{stem}.images.npy")
+    os.replace(index_tmp, f"{stem}.labels.npz")
+    manifest_tmp = Path(f"{stem}.json.{tmp}")
+    with open(manifest_tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_tmp, f"{stem}.json")
+
+    print(f"  {len(images)} images, {len(boxes)} boxes")
+    return Path(f"{stem}.json")
+
+
+class PackedSplit:
+    """
+    Read-only view of a packed split; the shard is memory-mapped on first access
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = Path(manifest_path)
+        with open(self.manifest_path) as f:
+            self.manifest = json.load(f)
+
+        stem = str(self.manifest_path)[:-len('.json')]
+        self.shard_path = f"{stem}.images.npy"
+        with np.load(f"{stem}.labels.npz") as index:
+            self.boxes = index["boxes"]
+            self.offsets = index["offsets"]
+            self.original_shapes = index["original_shapes"]
+            self.resized_shapes = index["resized_shapes"]
+
+        self.files = self.manifest["files"]
+        self.channels = self.manifest["channels"]
+        self._images = None
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = np.load(self.shard_path, mmap_mode='r')
+        return self._images
+
+    def labels(self, i):
+        return self.boxes[self.offsets[i]:self.offsets[i + 1]]
+
+    def image(self, i):
+        """
+        Resized image i as (h, w, C), a view into the shard
+        """
+        h, w = self.resized_shapes[i]
+        return self.images[i, :h, :w]
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getstate__(self):
+        # Worker processes reopen the memmap instead of receiving a pickled copy
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+
+def load_packed(image_dir, imgsz=640, pack_dir=None, channels=DEFAULT_CHANNELS):
+    """
+    Packed split for image_dir, (re)building it if missing or stale
+    """
+    manifest_path = Path(f"{shard_stem(image_dir, imgsz, channels, pack_dir)}.json")
+
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        current = fingerprint(list_split_images(image_dir), imgsz, channels)
+        if manifest.get("fingerprint") == current:
+            return PackedSplit(manifest_path)
+        print(f"Packed split {manifest_path} is stale, repacking...")
+
+    return PackedSplit(pack_split(image_dir, imgsz, pack_dir, channels))
+
+
+class PackedYOLODataset(YOLODataset):
+    """
+    YOLODataset reading images and labels from a packed split instead of JPEGs and .txt files
+    """
+
+    def __init__(self, *args, pack_dir=None, pack_channels=DEFAULT_CHANNELS, **kwargs):
+        self.pack_dir = pack_dir
+        self.pack_channels = pack_channels
+        kwargs["cache"] = None  # the shard already is the cache
+        super().__init__(*args, **kwargs)
+
+    def get_img_files(self, img_path):
+        self.packed = load_packed(img_path, self.imgsz, self.pack_dir, self.pack_channels)
+        return list(self.packed.files)
+
+    def get_labels(self):
+        labels = []
+        for i, im_file in enumerate(self.im_files):
+            lb = self.packed.labels(i)
+            labels.append({
+                "im_file": im_file,
+                "shape": tuple(int(v) for v in self.packed.original_shapes[i]),
+                "cls": lb[:, 0:1].copy(),
+                "bboxes": lb[:, 1:].copy(),
+                "segments": [],
+                "keypoints": None,
+                "normalized": True,
+                "bbox_format": "xywh"
+            })
+        if not labels:
+            raise RuntimeError(f"No images in packed split {self.packed.manifest_path}")
+        return labels
+
+    def load_image(self, i, rect_mode=True, resize_short=False):
+        if self.ims[i] is not None:
+            return self.ims[i], self.im_hw0[i], self.im_hw[i]
+
+        im = self.packed.image(i)
+        if self.packed.channels == 1 and self.channels == 3:
+            im = cv2.cvtColor(im, cv2.COLOR_GRAY2BGR)
+        else:
+            im = np.ascontiguousarray(im)
+        if not rect_mode:
+            im = cv2.resize(im, (self.imgsz, self.imgsz), interpolation=cv2.INTER_LINEAR)
+        if im.ndim == 2:
+            im = im[..., None]
+
+        h0, w0 = (int(v) for v in self.packed.original_shapes[i])
+        if self.augment:
+            # Recently loaded images feed the mosaic buffer, as in BaseDataset
+            self.ims[i], self.im_hw0[i], self.im_hw[i] = im, (h0, w0), im.shape[:2]
+            self.buffer.append(i)
+            if 1 < len(self.buffer) >= self.max_buffer_length:
+                j = self.buffer.pop(0)
+                self.ims[j], self.im_hw0[j], self.im_hw[j] = None, None, None
+        return im, (h0, w0), im.shape[:2]
+
+
+def build_packed_dataset(cfg, img_path, batch, data, mode='train', rect=False, stride=32):
+    """
+    build_yolo_dataset() equivalent returning a PackedYOLODataset
+    """
+    return PackedYOLODataset(
+        img_path=img_path,
+        imgsz=cfg.imgsz,
+        batch_size=batch,
+        augment=mode == 'train',
+        hyp=cfg,
+        rect=cfg.rect or rect,
+        single_cls=cfg.single_cls or False,
+        stride=stride,
+        pad=0.0 if mode == 'train' else 0.5,
+        prefix=colorstr(f"{mode}: "),
+        task=cfg.task,
+        classes=cfg.classes,
+        data=data
+    )
+
+
+class PackedDetectionValidator(DetectionValidator):
+    def build_dataset(self, img_path, mode='val', batch=None):
+        return build_packed_dataset(self.args, img_path, batch, self.data, mode=mode, stride=self.stride)
+
+
+class PackedDetectionTrainer(DetectionTrainer):
+    def build_dataset(self, img_path, mode='train', batch=None):
+        gs = max(int(unwrap_model(self.model).stride.max()), 32)
+        return build_packed_dataset(self.args, img_path, batch, self.data, mode=mode, rect=mode == 'val', stride=gs)
+
+    def get_validator(self):
+        return PackedDetectionValidator(
+            self.test_loader, save_dir=self.save_dir, args=copy(self.args), _callbacks=self.callbacks
+        )
+
+
+def split_dirs(data='dataset.yaml', splits=('train', 'val', 'test')):
+    """
+    Image directories of the requested splits in dataset.yaml
+    """
+    with open(data) as f:
+        config = yaml.safe_load(f)
+
+    root = Path(config.get('path', '.'))
+    if not root.is_absolute() and not root.exists():
+        root = Path(data).parent / root
+    return {split: root / config[split] for split in splits if config.get(split)}
+
+
+def dataset_with_channels(data='dataset.yaml', channels=1, output_dir='runs/data'):
+    """
+    dataset.yaml for models with a different input channel count
+
+    Ultralytics builds the model and loads images with the yaml's "channels"
+    (default 3). Returns data unchanged when it already matches, otherwise the
+    path of a copy with the channel count set and the dataset root made absolute.
+    """
+    with open(data) as f:
+        config = yaml.safe_load(f)
+    if config.get('channels', 3) == channels:
+        return data
+
+    root = Path(config.get('path', '.'))
+    if not root.is_absolute() and not root.exists():
+        root = Path(data).parent / root
+    config.update(path=str(root.resolve()), channels=channels)
+
+    output = Path(output_dir) / f"{Path(data).stem}_{channels}ch.yaml"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as f:
+        yaml.safe_dump(config, f, sort_keys=False)
+    return str(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack dataset splits into memory-mapped shards")
+    parser.add_argument('--data', default='dataset.yaml')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--splits', nargs='+', default=['train', 'val', 'test'])
+    parser.add_argument('--channels', type=int, default=DEFAULT_CHANNELS, choices=[1, 3],
+                        help="1 stores grayscale (expanded to BGR on load for 3-channel models), 3 stores BGR")
+    parser.add_argument('--pack-dir', default=None, help="Output directory (default: <dataset root>/packed)")
+    parser.add_argument('--force', action='store_true', help="Repack even if the shards are up to date")
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    for split, image_dir in split_dirs(args.data, args.splits).items():
+        if args.force:
+            pack_split(image_dir, args.imgsz, args.pack_dir, args.channels, args.workers)
+        else:
+            packed = load_packed(image_dir, args.imgsz, args.pack_dir, args.channels)
+            print(f"{split}: {len(packed)} images up to date in {packed.manifest_path}")
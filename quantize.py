@@ -0,0 +1,214 @@
+"""
+INT8 post-training quantization with a recall gate.
+
+Calibrates on data/images/val, produces an INT8 model that MedicalDetector can
+load (backend='onnx_int8' or 'openvino_int8'), and evaluates it against the
+FP32 model with evaluate_model() from test.py on the held-out test split, so
+the images that calibrated the model do not also judge it. The quantized model is only
+published next to best.pt when its recall drops by no more than the tolerance;
+otherwise it stays in the staging directory and the script exits non-zero.
+"""
+import argparse
+import json
+import shutil
+import sys
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from export import export_model, list_images
+from inference import DEFAULT_MODEL_PATH, resolve_backend_path
+from test import evaluate_model
+
+DEFAULT_STAGING_DIR = 'runs/quantize'
+
+
+class ValCalibrationReader:
+    """
+    ONNX Runtime calibration data: validation images letterboxed like the predictor does
+    """
+
+    def __init__(self, input_name, image_dir='data/images/val', imgsz=640, max_images=None, channels=3):
+        from ultralytics.data.augment import LetterBox
+
+        self.input_name = input_name
+        self.channels = channels
+        self.letterbox = LetterBox(new_shape=(imgsz, imgsz), auto=False)
+        self.images = list_images(image_dir)[:max_images]
+        if not self.images:
+            raise FileNotFoundError(f"No calibration images found in {image_dir}")
+        self._iter = iter(self.images)
+
+    def get_next(self):
+        path = next(self._iter, None)
+        if path is None:
+            return None
+
+        if self.channels == 1:
+            image = self.letterbox(image=cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)[..., None])
+        else:
+            # BGR -> RGB
+            image = self.letterbox(image=cv2.imread(str(path), cv2.IMREAD_COLOR))[..., ::-1]
+        # HWC uint8 -> CHW float32 in [0, 1], batch of one
+        tensor = image.transpose(2, 0, 1)[None].astype(np.float32) / 255.0
+        return {self.input_name: np.ascontiguousarray(tensor)}
+
+    def rewind(self):
+        self._iter = iter(self.images)
+
+
+def quantize_onnx(model_path, staging_dir, calib_dir='data/images/val', imgsz=640, max_calib_images=None):
+    """
+    Static INT8 quantization (QDQ, per-channel weights) of the exported ONNX graph
+    """
+    import onnx
+    import onnxruntime
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+
+    fp32_path = Path(resolve_backend_path(model_path, 'onnx'))
+    if not fp32_path.exists():
+        fp32_path = Path(export_model(model_path, formats=('onnx',), imgsz=imgsz)['onnx'])
+
+    model_input = onnxruntime.InferenceSession(str(fp32_path), providers=['CPUExecutionProvider']).get_inputs()[0]
+    # Grayscale models (train.py --channels 1) take (N, 1, H, W)
+    reader = ValCalibrationReader(model_input.name, calib_dir, imgsz, max_calib_images, channels=model_input.shape[1])
+    print(f"Calibrating on {len(reader.images)} images from {calib_dir}...")
+
+    staged_path = Path(staging_dir) / Path(resolve_backend_path(model_path, 'onnx_int8')).name
+    staged_path.parent.mkdir(parents=True, exist_ok=True)
+    quantize_static(
+        str(fp32_path),
+        str(staged_path),
+        reader,
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True
+    )
+
+    # Keep the Ultralytics metadata (stride, names, imgsz) so the model loads like the FP32 one
+    fp32_model = onnx.load(str(fp32_path))
+    int8_model = onnx.load(str(staged_path))
+    del int8_model.metadata_props[:]
+    int8_model.metadata_props.extend(fp32_model.metadata_props)
+    onnx.save(int8_model, str(staged_path))
+
+    return staged_path
+
+
+def quantize_openvino(model_path, staging_dir, data='dataset.yaml', imgsz=640):
+    """
+    NNCF INT8 quantization through the Ultralytics OpenVINO exporter (calibrates on the val split)
+
+    The exporter writes <stem>_int8_openvino_model/ next to the weights, which
+    for model_path itself is the published openvino_int8 model. It therefore
+    exports from a copy of the weights in staging_dir, so the published model
+    only changes once the candidate has passed the gate.
+    """
+    from ultralytics import YOLO
+    from pack_dataset import dataset_with_channels
+
+    staged_weights = Path(staging_dir) / Path(model_path).name
+    staged_weights.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copy2(model_path, staged_weights)
+    staged_path = Path(resolve_backend_path(staged_weights, 'openvino_int8'))
+    if staged_path.exists():
+        shutil.rmtree(staged_path)
+
+    model = YOLO(str(staged_weights))
+    # The calibration images are loaded with the dataset's channel count
+    data = dataset_with_channels(data, model.model.yaml.get('channels', 3))
+    exported = Path(model.export(format='openvino', int8=True, data=data, imgsz=imgsz, dynamic=True))
+    if exported.resolve() != staged_path.resolve():
+        shutil.move(str(exported), str(staged_path))
+    return staged_path
+
+
+def recall_gate(reference, candidate, max_recall_drop):
+    """
+    Accept the candidate only if recall did not drop by more than max_recall_drop
+    """
+    return reference["recall"] - candidate["recall"] <= max_recall_drop
+
+
+def summarize(metrics):
+    return {
+        "map50": float(metrics.box.map50),
+        "map50_95": float(metrics.box.map),
+        "precision": float(metrics.box.mp),
+        "recall": float(metrics.box.mr)
+    }
+
+
+def quantize_and_gate(model_path=DEFAULT_MODEL_PATH, fmt='onnx', max_recall_drop=0.01, data='dataset.yaml',
+                      calib_dir='data/images/val', imgsz=640, staging_dir=DEFAULT_STAGING_DIR, gate_split='test'):
+    """
+    Quantize, evaluate against the FP32 model and publish only if the recall gate passes
+
+    Both models are evaluated on gate_split of data, which should not be the
+    calibration split. Returns the published path, or None if the model was rejected.
+    """
+    if fmt == 'onnx':
+        staged_path = quantize_onnx(model_path, staging_dir, calib_dir, imgsz)
+    elif fmt == 'openvino':
+        staged_path = quantize_openvino(model_path, staging_dir, data, imgsz)
+    else:
+        raise ValueError(f"Unsupported quantization format: {fmt}")
+    print(f"Quantized model staged at: {staged_path}")
+
+    reference = summarize(evaluate_model(model_path, data=data, imgsz=imgsz, plots=False, split=gate_split))
+    candidate = summarize(evaluate_model(str(staged_path), data=data, imgsz=imgsz, plots=False, split=gate_split))
+    accepted = recall_gate(reference, candidate, max_recall_drop)
+
+    print("\n=== QUANTIZATION GATE ===")
+    print(f"{'metric':<12} {'fp32':>8} {'int8':>8} {'delta':>8}")
+    for name in ("map50", "map50_95", "precision", "recall"):
+        print(f"{name:<12} {reference[name]:8.4f} {candidate[name]:8.4f} {candidate[name] - reference[name]:+8.4f}")
+    print(f"Recall drop tolerance: {max_recall_drop:.4f} (on the {gate_split} split)")
+
+    report = {
+        "format": fmt,
+        "source": str(model_path),
+        "staged": str(staged_path),
+        "max_recall_drop": max_recall_drop,
+        "gate_split": gate_split,
+        "fp32": reference,
+        "int8": candidate,
+        "accepted": accepted
+    }
+    with open(Path(staging_dir) / f"gate_{fmt}.json", 'w') as f:
+        json.dump(report, f, indent=2)
+
+    if not accepted:
+        print("REJECTED: recall dropped beyond tolerance, model not published")
+        return None
+
+    published_path = Path(resolve_backend_path(model_path, f"{fmt}_int8"))
+    if published_path.is_dir():
+        shutil.rmtree(published_path)
+    if staged_path.is_dir():
+        shutil.copytree(staged_path, published_path)
+    else:
+        shutil.copy2(staged_path, published_path)
+    print(f"ACCEPTED: published to {published_path}")
+    return published_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="INT8 post-training quantization with a recall gate")
+    parser.add_argument('--model', default=DEFAULT_MODEL_PATH, help="Trained .pt weights")
+    parser.add_argument('--format', default='onnx', choices=['onnx', 'openvino'])
+    parser.add_argument('--max-recall-drop', type=float, default=0.01,
+                        help="Largest acceptable absolute drop in recall vs. FP32")
+    parser.add_argument('--data', default='dataset.yaml')
+    parser.add_argument('--calib-dir', default='data/images/val')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--gate-split', default='test',
+                        help="dataset.yaml split the recall gate evaluates on (keep it apart from calibration)")
+    args = parser.parse_args()
+
+    published = quantize_and_gate(args.model, args.format, args.max_recall_drop, args.data,
+                                  args.calib_dir, args.imgsz, gate_split=args.gate_split)
+    if published is None:
+        sys.exit(1)
@@ -0,0 +1,252 @@
+"""
+Multi-process MedicalDetector replicas for CPU-only serving.
+
+Each replica is a separate process holding its own YOLO model, pinned to a
+slice of the CPU cores with a matching torch intra-op thread count, so pre-
+and post-processing of different batches no longer contend for one GIL.
+
+Decoded images reach a replica through a shared-memory slab owned by the
+parent (one per replica, reused across batches); only small (offset, shape,
+dtype) descriptors and the JSON-sized detection payloads cross the pipe.
+"""
+import multiprocessing as mp
+import os
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from metrics import record_stage
+
+DEFAULT_SLAB_BYTES = 64 * 1024 * 1024
+SLAB_ALIGNMENT = 64
+
+
+def available_cores():
+    """
+    CPU cores this process is allowed to run on
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def split_cores(num_replicas, cores=None):
+    """
+    Split the CPU cores into contiguous, equally sized slices, one per replica
+    """
+    cores = list(cores) if cores is not None else available_cores()
+    per_replica = max(1, len(cores) // num_replicas)
+
+    slices = []
+    for i in range(num_replicas):
+        core_slice = cores[i * per_replica:(i + 1) * per_replica]
+        # More replicas than cores: share cores round-robin
+        slices.append(core_slice or [cores[i % len(cores)]])
+    return slices
+
+
+def _aligned(nbytes):
+    return (nbytes + SLAB_ALIGNMENT - 1) // SLAB_ALIGNMENT * SLAB_ALIGNMENT
+
+
+def pin_to_cores(cores):
+    """
+    Restrict the calling process to cores with a matching torch thread count
+
+    Call before anything imports torch: its thread pools size themselves from
+    OMP_NUM_THREADS / MKL_NUM_THREADS on first import.
+    """
+    num_threads = str(len(cores))
+    os.environ["OMP_NUM_THREADS"] = num_threads
+    os.environ["MKL_NUM_THREADS"] = num_threads
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+    import torch
+    torch.set_num_threads(len(cores))
+
+
+def _replica_main(model_path, cores, detector_kwargs, conn):
+    """
+    Replica process entry point: pin to cores, load the model and serve batches
+    """
+    pin_to_cores(cores)
+
+    from inference import MedicalDetector
+    detector = MedicalDetector(model_path, **detector_kwargs)
+    conn.send(("ready", (detector.load_seconds, detector.channels)))
+
+    slab = None
+    retired = []
+    while True:
+        op, arg = conn.recv()
+        if op == "stop":
+            break
+
+        if op == "attach":
+            if slab is not None:
+                retired.append(slab)
+            slab = shared_memory.SharedMemory(name=arg)
+            # The predictor may still reference the previous batch; unmap old slabs once it lets go
+            for old in list(retired):
+                try:
+                    old.close()
+                    retired.remove(old)
+                except BufferError:
+                    pass
+            conn.send(("ok", None))
+            continue
+
+        if op == "detect":
+            specs, cascade, tiled = arg
+            # Zero-copy views onto the parent's slab
+            images = [
+                np.ndarray(shape, dtype=np.dtype(dtype), buffer=slab.buf, offset=offset)
+                for offset, shape, dtype in specs
+            ]
+            try:
+                payloads = detector.detect_batch(images, cascade=cascade, tiled=tiled)
+                conn.send(("ok", (payloads, detector.last_stage_timings)))
+            except Exception as e:
+                conn.send(("error", f"{type(e).__name__}: {e}"))
+            del images
+
+    conn.close()
+
+
+class ProcessReplica:
+    def __init__(self, model_path, cores, context, slab_bytes=DEFAULT_SLAB_BYTES, detector_kwargs=None):
+        """
+        Start a replica process; call wait_ready() before submitting batches
+
+        detector_kwargs are passed to MedicalDetector inside the replica.
+        """
+        self.model_path = model_path
+        self.detector_kwargs = dict(detector_kwargs or {})
+        self.cascade = self.detector_kwargs.get("cascade")
+        self.cores = list(cores)
+        self._slab_bytes = slab_bytes
+        self._slab = None
+        self._lock = threading.Lock()
+
+        self._conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_replica_main,
+            args=(model_path, self.cores, self.detector_kwargs, child_conn),
+            name=f"healvision-replica-{self.cores[0]}",
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+    def wait_ready(self):
+        """
+        Block until the replica has loaded its model, then hand it a slab
+        """
+        status, value = self._conn.recv()
+        if status != "ready":
+            raise RuntimeError(f"Replica on cores {self.cores} failed to start")
+        # Uploads are decoded here, so with the model's channel count
+        self.load_seconds, self.channels = value
+        with self._lock:
+            self._ensure_slab(self._slab_bytes)
+
+    def _ensure_slab(self, nbytes):
+        if self._slab is not None and self._slab.size >= nbytes:
+            return
+
+        # Grow to the larger of the request and double the current slab
+        size = max(nbytes, 2 * self._slab.size if self._slab is not None else 0)
+        slab = shared_memory.SharedMemory(create=True, size=size)
+        self._conn.send(("attach", slab.name))
+        self._conn.recv()
+
+        if self._slab is not None:
+            self._slab.close()
+            self._slab.unlink()
+        self._slab = slab
+
+    def detect_batch(self, images, cascade=True, tiled=True):
+        """
+        Decode the batch here, copy it into shared memory once and run it in the replica
+        """
+        from inference import load_image
+
+        start = time.perf_counter()
+        # Arrays are copied as they are: grayscale stays one channel and is expanded in the replica if needed
+        arrays = [np.ascontiguousarray(image if isinstance(image, np.ndarray) else load_image(image, self.channels))
+                  for image in images]
+        record_stage("decode", time.perf_counter() - start)
+
+        with self._lock:
+            self._ensure_slab(sum(_aligned(array.nbytes) for array in arrays))
+
+            specs = []
+            offset = 0
+            for array in arrays:
+                np.ndarray(array.shape, dtype=array.dtype, buffer=self._slab.buf, offset=offset)[...] = array
+                specs.append((offset, array.shape, array.dtype.str))
+                offset += _aligned(array.nbytes)
+
+            self._conn.send(("detect", (specs, cascade, tiled)))
+            status, value = self._conn.recv()
+
+        if status == "error":
+            raise RuntimeError(f"Replica inference failed: {value}")
+
+        # Stage timings measured inside the replica feed this process's histograms
+        payloads, timings = value
+        for name, seconds in timings:
+            record_stage(name, seconds)
+        return payloads
+
+    def close(self, timeout=10):
+        with self._lock:
+            if self.process.is_alive():
+                try:
+                    self._conn.send(("stop", None))
+                except (BrokenPipeError, OSError):
+                    pass
+                self.process.join(timeout)
+                if self.process.is_alive():
+                    self.process.terminate()
+            self._conn.close()
+
+            if self._slab is not None:
+                self._slab.close()
+                self._slab.unlink()
+                self._slab = None
+
+
+class ReplicaPool:
+    def __init__(self, num_replicas, model_path, cores=None, slab_bytes=DEFAULT_SLAB_BYTES,
+                 detector_kwargs=None):
+        """
+        Start num_replicas model processes, each pinned to its own slice of cores
+
+        The replicas expose detect_batch() and can be passed straight to BatchScheduler.
+        """
+        if num_replicas < 1:
+            raise ValueError("num_replicas must be at least 1")
+
+        context = mp.get_context("spawn")
+        core_slices = split_cores(num_replicas, cores)
+
+        print(f"Starting {num_replicas} model replica processes on cores {core_slices}")
+        self.replicas = [
+            ProcessReplica(model_path, core_slice, context, slab_bytes, detector_kwargs)
+            for core_slice in core_slices
+        ]
+        # Models load in parallel; wait for all of them
+        try:
+            for replica in self.replicas:
+                replica.wait_ready()
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        for replica in self.replicas:
+            replica.close()
@@ -0,0 +1,227 @@
+"""
+Content-addressed cache of detection payloads.
+
+Entries are keyed by the SHA-256 of the image bytes together with the model
+weights hash and the inference parameters, so a resubmitted study (retry,
+re-read, second opinion) skips the model entirely. Only the detection payload
+is cached; patient metadata, timestamp and audit hash are still built fresh
+for every request by build_output().
+
+The in-memory tier is bounded by payload bytes with LRU + TTL eviction; an
+optional disk tier keeps payloads across restarts. Concurrent identical
+requests coalesce onto a single in-flight inference.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+
+from metrics import counter
+
+CACHE_EVENTS = counter("healvision_cache_events_total", "Result cache hits, misses and evictions", ("event",))
+
+
+def cache_key(image_bytes, weights_hash, inference_params):
+    """
+    Key for an image under a specific model and set of inference parameters
+    """
+    digest = hashlib.sha256()
+    digest.update(weights_hash.encode())
+    digest.update(json.dumps(inference_params, sort_keys=True).encode())
+    digest.update(hashlib.sha256(image_bytes).digest())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl_seconds=3600.0, disk_dir=None):
+        """
+        Args:
+            max_bytes: Memory budget for cached payloads (serialized size)
+            ttl_seconds: Age after which an entry is no longer served
+            disk_dir: Optional directory for a persistent second tier
+        """
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (payload, size, expires_at)
+        self._inflight = {}  # (key, group) -> Future of the running inference
+        self._bytes = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get_or_submit(self, key, submit, group=None):
+        """
+        Return a Future for the payload under key, calling submit() only on a full miss
+
+        Cached payloads are shared between requests and must not be mutated. A request
+        only joins an in-flight inference of the same group (e.g. priority class and
+        deadline), so it never waits at another request's priority or fails on its deadline.
+        """
+        with self._lock:
+            payload = self._get_memory(key)
+            if payload is not None:
+                self.hits += 1
+                CACHE_EVENTS.inc(event="hit")
+                return _completed(payload)
+            if (key, group) in self._inflight:
+                self.coalesced += 1
+                CACHE_EVENTS.inc(event="coalesced")
+                return _follow(self._inflight[key, group])
+
+        payload = self._read_disk(key)
+        if payload is not None:
+            with self._lock:
+                self.disk_hits += 1
+                CACHE_EVENTS.inc(event="disk_hit")
+                self._put_memory(key, payload)
+            return _completed(payload)
+
+        with self._lock:
+            # Another request may have started the same inference meanwhile
+            if (key, group) in self._inflight:
+                self.coalesced += 1
+                CACHE_EVENTS.inc(event="coalesced")
+                return _follow(self._inflight[key, group])
+            future = submit()
+            self._inflight[key, group] = future
+            self.misses += 1
+            CACHE_EVENTS.inc(event="miss")
+
+        future.add_done_callback(lambda f: self._complete(key, group, f))
+        return _follow(future)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "disk": str(self.disk_dir) if self.disk_dir else None,
+                "inflight": len(self._inflight),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+    def _complete(self, key, group, future):
+        with self._lock:
+            self._inflight.pop((key, group), None)
+            if future.cancelled() or future.exception() is not None:
+                return
+            self._put_memory(key, future.result())
+        self._write_disk(key, future.result())
+
+    def _get_memory(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        payload, size, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            self._bytes -= size
+            self.expirations += 1
+            CACHE_EVENTS.inc(event="expiration")
+            return None
+
+        self._entries.move_to_end(key)
+        return payload
+
+    def _put_memory(self, key, payload):
+        size = len(json.dumps(payload))
+        if size > self.max_bytes:
+            return
+
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (payload, size, time.monotonic() + self.ttl_seconds)
+        self._bytes += size
+
+        # Evict least recently used entries until back under budget
+        while self._bytes > self.max_bytes:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+            CACHE_EVENTS.inc(event="eviction")
+
+    def _disk_path(self, key):
+        return self.disk_dir / key[:2] / f"{key}.json"
+
+    def _read_disk(self, key):
+        if self.disk_dir is None:
+            return None
+
+        path = self._disk_path(key)
+        try:
+            if time.time() - path.stat().st_mtime >= self.ttl_seconds:
+                path.unlink()
+                with self._lock:
+                    self.expirations += 1
+                    CACHE_EVENTS.inc(event="expiration")
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_disk(self, key, payload):
+        if self.disk_dir is None:
+            return
+
+        path = self._disk_path(key)
+        try:
+            path.parent.mkdir(exist_ok=True)
+            # Write then rename so readers never see a partial file
+            tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp_path, 'w') as f:
+                json.dump(payload, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Warning: could not write cache entry {key}: {e}")
+
+
+def _completed(payload):
+    future = Future()
+    future.set_result(payload)
+    return future
+
+
+def _follow(shared):
+    """
+    Per-caller Future mirroring a shared in-flight one
+
+    Cancelling it (e.g. a client disconnecting) never cancels the shared inference.
+    """
+    future = Future()
+
+    def copy_outcome(source):
+        if not future.set_running_or_notify_cancel():
+            return
+        if hasattr(source, "stage_timings"):
+            future.stage_timings = source.stage_timings
+        if source.cancelled():
+            future.set_exception(RuntimeError("Inference was cancelled"))
+        elif source.exception() is not None:
+            future.set_exception(source.exception())
+        else:
+            future.set_result(source.result())
+
+    shared.add_done_callback(copy_outcome)
+    return future
@@ -0,0 +1,362 @@
+"""
+Persistent, indexed store of analysis results for the history API.
+
+Every analysis with patient metadata is kept in SQLite (WAL mode) together
+with the columns the history views filter and sort on: patient_id,
+study_id, analysis timestamp and the highest detection confidence (0 for
+a normal study).
+
+Writes are queued and committed in groups by a writer thread, so requests
+never wait on the disk. Listing uses keyset pagination: a page ends with
+a cursor holding the sort key of its last row, and the next page starts
+strictly after it. A page is an index range scan of `limit` rows at any
+table size and any depth:
+- patient_id and study_id each have composite indexes ending in either
+  sort key; other filters given with them only scan that patient's or
+  study's rows
+- time bounds are ranges on the time sort key, confidence bounds and status
+  on the confidence sort key
+- status has its own (abnormal, analyzed_at, id) expression index for
+  sort=time
+Time bounds with sort=confidence and min_confidence with sort=time have no
+index to range over, so they are rejected unless patient_id or study_id
+narrows the scan.
+"""
+import base64
+import json
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from pathlib import Path
+
+from metrics import counter, histogram
+
+STORE_RECORDS = counter("healvision_result_store_records_total", "Analysis results persisted or lost to write errors",
+                        ("outcome",))
+STORE_GROUP_SIZE = histogram("healvision_result_store_group_size", "Results written per transaction",
+                             buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    analyzed_at TEXT NOT NULL,
+    patient_id TEXT,
+    study_id TEXT,
+    filename TEXT,
+    model_version TEXT,
+    num_detections INTEGER NOT NULL,
+    max_confidence REAL NOT NULL,
+    audit_hash TEXT,
+    result TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_by_time ON results (analyzed_at, id);
+CREATE INDEX IF NOT EXISTS results_by_patient ON results (patient_id, analyzed_at, id);
+CREATE INDEX IF NOT EXISTS results_by_study ON results (study_id, analyzed_at, id);
+CREATE INDEX IF NOT EXISTS results_by_confidence ON results (max_confidence, id);
+CREATE INDEX IF NOT EXISTS results_by_patient_confidence ON results (patient_id, max_confidence, id);
+CREATE INDEX IF NOT EXISTS results_by_study_confidence ON results (study_id, max_confidence, id);
+CREATE INDEX IF NOT EXISTS results_by_status ON results ((max_confidence > 0), analyzed_at, id);
+"""
+
+# Sort order -> column the keyset cursor pages on (always followed by id as tie-breaker)
+SORT_COLUMNS = {"time": "analyzed_at", "confidence": "max_confidence"}
+
+# Type of the cursor key per sort order
+SORT_KEY_TYPES = {"time": (str,), "confidence": (int, float)}
+
+SUMMARY_COLUMNS = ("id", "analyzed_at", "patient_id", "study_id", "filename", "model_version",
+                   "num_detections", "max_confidence", "audit_hash")
+
+MAX_PAGE_SIZE = 500
+
+
+class InvalidCursorError(ValueError):
+    """Raised when a pagination cursor is malformed or belongs to another sort order"""
+
+
+def encode_cursor(sort, key, row_id):
+    raw = json.dumps([sort, key, row_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, key, row_id = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursorError(f"Invalid cursor: {e}") from e
+    if (cursor_sort != sort or not isinstance(row_id, int) or isinstance(row_id, bool)
+            or not isinstance(key, SORT_KEY_TYPES[sort]) or isinstance(key, bool)):
+        raise InvalidCursorError("Cursor does not belong to this query")
+    return key, row_id
+
+
+def parse_timestamp(value, name="timestamp"):
+    """
+    An ISO-8601 time in the form analyzed_at is stored in: naive UTC, datetime.isoformat()
+
+    Times with a UTC offset are converted to UTC; times without one are taken as UTC.
+    """
+    try:
+        moment = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be an ISO-8601 time, got {value!r}")
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment.isoformat()
+
+
+def summarize(results, model_version=None):
+    """
+    Row values for a standardized analysis output (see inference.build_output)
+    """
+    detections = results["detections"]
+    patient_metadata = results.get("patient_metadata") or {}
+    return {
+        "analyzed_at": results["timestamp"],
+        "patient_id": patient_metadata.get("patient_id"),
+        "study_id": patient_metadata.get("study_id"),
+        "filename": results["image_metadata"]["filename"],
+        "model_version": model_version,
+        "num_detections": len(detections),
+        "max_confidence": max((d["confidence"] for d in detections), default=0.0),
+        "audit_hash": results.get("audit_hash"),
+        "result": json.dumps(results, separators=(',', ':'))
+    }
+
+
+class ResultStore:
+    def __init__(self, path, max_batch_size=256, max_delay_ms=100.0):
+        """
+        Open (or create) the store and start its writer thread
+
+        Args:
+            path: SQLite database file
+            max_batch_size: Most results written in one transaction
+            max_delay_ms: How long the first result of a group may wait for others
+        """
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_batch_size = max_batch_size
+        self.max_delay_ms = max_delay_ms
+
+        self._queue = queue.Queue()
+        self._closed = False
+        self._stats_lock = threading.Lock()
+        self.written = 0
+        self.failed = 0
+        self.groups = 0
+
+        self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # NORMAL: a power loss may drop the last groups but never corrupts the store;
+        # the durable record of every analysis is the audit log
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+        # Readers get their own connection per thread; WAL lets them run alongside the writer
+        self._readers = threading.local()
+        self._reader_conns = []
+
+        self._writer = threading.Thread(target=self._run, name="result-store-writer", daemon=True)
+        self._writer.start()
+
+    def add(self, results, model_version=None):
+        """
+        Queue a standardized analysis output and return a Future of its row id
+        """
+        if self._closed:
+            raise RuntimeError("ResultStore is closed")
+
+        future = Future()
+        self._queue.put((summarize(results, model_version), future))
+        return future
+
+    def get(self, result_id):
+        """
+        Full stored analysis output by id, or None
+        """
+        row = self._reader().execute(
+            f"SELECT {', '.join(SUMMARY_COLUMNS)}, result FROM results WHERE id = ?", (result_id,)).fetchone()
+        if row is None:
+            return None
+        item = dict(zip(SUMMARY_COLUMNS, row))
+        item["result"] = json.loads(row[-1])
+        return item
+
+    def query(self, patient_id=None, study_id=None, since=None, until=None, status=None,
+              min_confidence=None, sort="time", limit=50, cursor=None):
+        """
+        One page of result summaries, newest (or most confident) first
+
+        Args:
+            patient_id, study_id: Exact-match filters
+            since, until: ISO-8601 bounds on the analysis time (inclusive, exclusive), UTC unless
+                          they carry an offset
+            status: "normal" (no detections) or "abnormal"
+            min_confidence: Lower bound on the highest detection confidence
+            sort: "time" or "confidence"
+            limit: Page size (at most MAX_PAGE_SIZE)
+            cursor: next_cursor of the previous page
+
+        Returns:
+            Dict with "items" and "next_cursor" (None on the last page)
+
+        Raises:
+            ValueError: For invalid arguments, and for filters no index can serve
+                        with this sort order (see the module docstring)
+        """
+        if sort not in SORT_COLUMNS:
+            raise ValueError(f"Unknown sort '{sort}', expected one of {tuple(SORT_COLUMNS)}")
+        if status not in (None, "normal", "abnormal"):
+            raise ValueError("status must be 'normal' or 'abnormal'")
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        if patient_id is None and study_id is None:
+            if sort == "time" and min_confidence is not None:
+                raise ValueError("min_confidence needs sort=confidence, or a patient_id or study_id")
+            if sort == "confidence" and (since is not None or until is not None):
+                raise ValueError("since/until need sort=time, or a patient_id or study_id")
+
+        sort_column = SORT_COLUMNS[sort]
+        where, params = [], []
+        if patient_id is not None:
+            where.append("patient_id = ?")
+            params.append(patient_id)
+        if study_id is not None:
+            where.append("study_id = ?")
+            params.append(study_id)
+        if since is not None:
+            where.append("analyzed_at >= ?")
+            params.append(parse_timestamp(since, "since"))
+        if until is not None:
+            where.append("analyzed_at < ?")
+            params.append(parse_timestamp(until, "until"))
+        if status is not None and sort == "confidence":
+            where.append("max_confidence > 0" if status == "abnormal" else "max_confidence = 0")
+        elif status is not None:
+            # Same expression as results_by_status
+            where.append("(max_confidence > 0) = ?")
+            params.append(int(status == "abnormal"))
+        if min_confidence is not None:
+            where.append("max_confidence >= ?")
+            params.append(min_confidence)
+        if cursor is not None:
+            key, row_id = decode_cursor(cursor, sort)
+            where.append(f"({sort_column}, id) < (?, ?)")
+            params.extend([key, row_id])
+
+        sql = f"SELECT {', '.join(SUMMARY_COLUMNS)} FROM results"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        # One extra row tells whether another page follows
+        sql += f" ORDER BY {sort_column} DESC, id DESC LIMIT ?"
+        rows = self._reader().execute(sql, params + [limit + 1]).fetchall()
+
+        items = [dict(zip(SUMMARY_COLUMNS, row)) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = items[-1]
+            next_cursor = encode_cursor(sort, last[sort_column], last["id"])
+        return {"items": items, "next_cursor": next_cursor}
+
+    def close(self, timeout=None):
+        """
+        Stop accepting results, write everything already queued and close the database
+        """
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+        self._writer.join(timeout)
+        if not self._writer.is_alive():
+            self._conn.close()
+        with self._stats_lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns.clear()
+
+    def stats(self):
+        with self._stats_lock:
+            groups = self.groups
+            written = self.written
+            return {
+                "path": str(self.path),
+                "written": written,
+                "failed": self.failed,
+                "groups": groups,
+                "mean_group_size": round(written / groups, 3) if groups else 0.0,
+                "backlog": self._queue.qsize()
+            }
+
+    def _reader(self):
+        conn = getattr(self._readers, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA query_only=ON")
+            self._readers.conn = conn
+            with self._stats_lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    def _collect(self):
+        """
+        Block for the first result, then gather more until the window closes or the group is full
+
+        Returns the group and whether the shutdown marker was received.
+        """
+        first = self._queue.get()
+        if first is None:
+            return [], True
+
+        group = [first]
+        deadline = time.monotonic() + self.max_delay_ms / 1000.0
+        while len(group) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return group, True
+            group.append(item)
+
+        return group, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            group, stop = self._collect()
+            if group:
+                self._write(group)
+
+    def _write(self, group):
+        columns = list(group[0][0])
+        sql = f"INSERT INTO results ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) RETURNING id"
+        try:
+            self._conn.execute("BEGIN IMMEDIATE")
+            ids = [self._conn.execute(sql, [row[c] for c in columns]).fetchone()[0] for row, _ in group]
+            self._conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            if self._conn.in_transaction:
+                self._conn.execute("ROLLBACK")
+            print(f"Result store write failed, {len(group)} results lost: {e}")
+            with self._stats_lock:
+                self.failed += len(group)
+            STORE_RECORDS.inc(len(group), outcome="failed")
+            for _, future in group:
+                future.set_exception(e)
+            return
+
+        STORE_GROUP_SIZE.observe(len(group))
+        STORE_RECORDS.inc(len(group), outcome="written")
+        with self._stats_lock:
+            self.written += len(group)
+            self.groups += 1
+        for (_, future), row_id in zip(group, ids):
+            future.set_result(row_id)
@@ -0,0 +1,344 @@
+"""
+Parallel hyperparameter sweep over train.py's train_model() with successive halving.
+
+Several trials train at once, each in its own process pinned to a slice of the
+CPU cores with a matching torch thread count (as replica_pool.py does for
+serving). Every trial runs the learning rate schedule of the full epoch budget
+and reports its validation metrics after each epoch. At the rung epochs
+(min_epochs, min_epochs * eta, ...) asynchronous successive halving decides
+whether it goes on: a trial continues only if its metric is in the top 1/eta
+of the values recorded at that rung so far. Stopped trials free their cores
+for the next trial in the queue.
+
+The search space is a YAML file mapping train_model() parameters or
+Ultralytics overrides (lr0, weight_decay, mosaic, ...) to
+- a list: one of the values
+- {low, high, log, int}: a value sampled from the range
+- anything else: a fixed value
+Without --trials a space made only of lists and fixed values is run as a full
+grid; otherwise --trials (default 8) configurations are sampled at random.
+
+Every trial ends up in one leaderboard, runs/sweep/<name>/leaderboard.json,
+rewritten after each epoch report so a running sweep can be followed.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import time
+from multiprocessing.connection import wait
+from pathlib import Path
+
+import numpy as np
+import yaml
+
+from replica_pool import available_cores, pin_to_cores, split_cores
+
+DEFAULT_SPACE = {
+    # The default optimizer='auto' picks its own learning rate and ignores lr0
+    "optimizer": "SGD",
+    "lr0": {"low": 1e-4, "high": 1e-2, "log": True},
+    "weight_decay": {"low": 1e-5, "high": 1e-3, "log": True},
+    "batch": [8, 16],
+    "mosaic": [0.5, 1.0]
+}
+
+# Validation metrics reported by the Ultralytics detection trainer
+METRICS = {
+    "map50": "metrics/mAP50(B)",
+    "map50_95": "metrics/mAP50-95(B)",
+    "precision": "metrics/precision(B)",
+    "recall": "metrics/recall(B)"
+}
+
+# Configurations sampled from a space with ranges when no number of trials is given
+DEFAULT_TRIALS = 8
+
+# Set by the sweep for every trial
+RESERVED_PARAMS = ("epochs", "project", "name", "callbacks")
+
+
+def load_space(path):
+    with open(path) as f:
+        space = yaml.safe_load(f)
+    if not isinstance(space, dict):
+        raise ValueError(f"{path} must map parameter names to values, lists or ranges")
+    return space
+
+
+def _is_range(value):
+    return isinstance(value, dict) and "low" in value and "high" in value
+
+
+def sample_trials(space, num_trials=None, seed=0):
+    """
+    Parameter dicts to train, one per trial
+
+    Without num_trials a space of lists and fixed values gives its full grid and
+    a space with ranges DEFAULT_TRIALS random configurations.
+    """
+    reserved = [key for key in space if key in RESERVED_PARAMS]
+    if reserved:
+        raise ValueError(f"{reserved} are set by the sweep and cannot be part of the search space")
+
+    if num_trials is None and any(_is_range(value) for value in space.values()):
+        num_trials = DEFAULT_TRIALS
+    if num_trials is None:
+        choices = [value if isinstance(value, list) else [value] for value in space.values()]
+        return [dict(zip(space, values)) for values in itertools.product(*choices)]
+
+    rng = np.random.default_rng(seed)
+    trials = []
+    for _ in range(num_trials):
+        params = {}
+        for key, value in space.items():
+            if isinstance(value, list):
+                value = value[int(rng.integers(len(value)))]
+            elif _is_range(value):
+                low, high = float(value["low"]), float(value["high"])
+                if value.get("log"):
+                    sample = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+                else:
+                    sample = float(rng.uniform(low, high))
+                value = int(round(sample)) if value.get("int") else sample
+            params[key] = value
+        trials.append(params)
+    return trials
+
+
+def rung_epochs(min_epochs, max_epochs, eta=3):
+    """
+    Epochs at which successive halving compares trials: min_epochs * eta^k below max_epochs
+    """
+    if min_epochs < 1 or eta < 2:
+        raise ValueError("min_epochs must be at least 1 and eta at least 2")
+    rungs = []
+    epoch = min_epochs
+    while epoch < max_epochs:
+        rungs.append(epoch)
+        epoch *= eta
+    return rungs
+
+
+class SuccessiveHalving:
+    def __init__(self, rungs, eta=3):
+        """
+        Asynchronous successive halving: trials are compared at each rung as they reach it
+        """
+        self.eta = eta
+        self.recorded = {rung: [] for rung in rungs}
+
+    def should_stop(self, epoch, value):
+        """
+        Record a trial's metric; True when it is below the top 1/eta of its rung so far
+        """
+        if epoch not in self.recorded:
+            return False
+        values = self.recorded[epoch]
+        values.append(value)
+        return value < np.percentile(values, (1 - 1 / self.eta) * 100)
+
+
+def trial_metrics(metrics):
+    return {name: round(float(metrics.get(key, 0.0)), 5) for name, key in METRICS.items()}
+
+
+def _trial_main(params, cores, conn):
+    """
+    Trial process entry point: pin to cores, train and report each epoch to the sweep
+    """
+    pin_to_cores(cores)
+
+    import torch
+    from train import train_model
+
+    finished = False
+
+    def on_train_start(trainer):
+        # select_device() resets the thread count to Ultralytics' machine-wide default
+        torch.set_num_threads(len(cores))
+
+    def on_fit_epoch_end(trainer):
+        nonlocal finished
+        # Once training stops, the final validation of best.pt runs this callback once more
+        if finished:
+            return
+        conn.send(("epoch", (trainer.epoch + 1, trial_metrics(trainer.metrics))))
+        if conn.recv() == "stop":
+            trainer.stop = True
+        finished = trainer.stop
+
+    try:
+        model = train_model(**params, callbacks={"on_train_start": on_train_start,
+                                                 "on_fit_epoch_end": on_fit_epoch_end})
+        conn.send(("done", (trial_metrics(model.trainer.metrics), str(model.trainer.best))))
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+    conn.close()
+
+
+def rank_trials(records, metric):
+    return sorted(records, key=lambda record: -1.0 if record.get(metric) is None else -record[metric])
+
+
+def write_leaderboard(path, records, metric, rungs, eta):
+    with open(path, 'w') as f:
+        json.dump({"metric": metric, "rungs": rungs, "eta": eta, "trials": rank_trials(records, metric)}, f, indent=2)
+
+
+def print_leaderboard(records, metric):
+    print(f"\n=== SWEEP LEADERBOARD (by {metric}) ===")
+    print(f"{'rank':>4}  {'trial':<10} {'status':<10} {'epochs':>6} {'mAP50':>7} {'mAP50-95':>8} {'recall':>7}  params")
+    for rank, record in enumerate(rank_trials(records, metric), 1):
+        values = [record.get(name) for name in ("map50", "map50_95", "recall")]
+        cells = " ".join(f"{'-' if v is None else f'{v:.4f}':>{w}}" for v, w in zip(values, (7, 8, 7)))
+        print(f"{rank:>4}  {record['trial']:<10} {record['status']:<10} {record['epochs']:>6} {cells}  "
+              f"{json.dumps(record['params'])}")
+
+
+def run_sweep(space=None, num_trials=None, parallel=None, cores=None, max_epochs=30, min_epochs=3, eta=3,
+              metric='map50_95', name='sweep', project='runs/sweep', seed=0, base_params=None):
+    """
+    Run the sweep and return the trial records, best first
+
+    base_params are train_model() arguments shared by every trial (e.g. packed,
+    channels, data); parameters in the space take precedence over them.
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric '{metric}', expected one of {tuple(METRICS)}")
+    cores = list(cores) if cores is not None else available_cores()
+    parallel = parallel or max(1, len(cores) // 4)
+    rungs = rung_epochs(min_epochs, max_epochs, eta)
+    sampled = sample_trials(space or DEFAULT_SPACE, num_trials, seed)
+    trials = [{**(base_params or {}), **params} for params in sampled]
+
+    sweep_dir = Path(project, name).resolve()
+    sweep_dir.mkdir(parents=True, exist_ok=True)
+    leaderboard_path = sweep_dir / 'leaderboard.json'
+
+    # Adapt grayscale weights and data once here rather than in every trial at the same time
+    if any(params.get("channels", 3) == 1 for params in trials):
+        from pack_dataset import dataset_with_channels
+        from train import adapt_to_grayscale
+        for params in trials:
+            if params.get("channels", 3) == 1:
+                weights = params.get("weights", 'yolov8n.pt')
+                params["weights"] = adapt_to_grayscale(weights, str(sweep_dir / f"{Path(weights).stem}_1ch.pt"))
+                params["data"] = dataset_with_channels(params.get("data", 'dataset.yaml'), 1)
+
+    # Likewise pack the splits the trials read up front instead of racing to pack them on first use
+    packs = {(params.get("data", 'dataset.yaml'), params.get("imgsz", 640)) for params in trials if params.get("packed")}
+    if packs:
+        from pack_dataset import load_packed, split_dirs
+        for data, imgsz in sorted(packs):
+            for image_dir in split_dirs(data, ('train', 'val')).values():
+                load_packed(image_dir, imgsz)
+
+    slots = split_cores(parallel, cores)
+    print(f"Sweeping {len(trials)} trials, {len(slots)} at a time on cores {slots}")
+    print(f"Successive halving on {metric} at epochs {rungs} (eta={eta}), at most {max_epochs} epochs")
+
+    context = mp.get_context("spawn")
+    scheduler = SuccessiveHalving(rungs, eta)
+    records = []
+    pending = list(enumerate(trials))
+    free_slots = list(range(len(slots)))
+    running = {}
+
+    while pending or running:
+        while pending and free_slots:
+            slot = free_slots.pop(0)
+            index, params = pending.pop(0)
+            trial = f"trial_{index:03d}"
+            record = {"trial": trial, "params": sampled[index], "status": "running",
+                      "epochs": 0, **dict.fromkeys(METRICS), "weights": None, "seconds": None,
+                      "cores": slots[slot], "history": []}
+            records.append(record)
+
+            params = {"workers": len(slots[slot]) // 2, "plots": False, **params,
+                      "epochs": max_epochs, "project": str(sweep_dir), "name": trial}
+            conn, child_conn = context.Pipe()
+            process = context.Process(target=_trial_main, args=(params, slots[slot], child_conn),
+                                      name=f"healvision-sweep-{trial}", daemon=True)
+            process.start()
+            child_conn.close()
+            running[conn] = (record, process, slot, time.perf_counter())
+            print(f"Started {trial} on cores {slots[slot]}: {json.dumps(record['params'])}")
+
+        for conn in wait(list(running)):
+            record, process, slot, started = running[conn]
+            try:
+                op, value = conn.recv()
+            except EOFError:
+                process.join()
+                op, value = "error", f"Trial process exited with code {process.exitcode}"
+
+            if op == "epoch":
+                epoch, metrics = value
+                record["history"].append({"epoch": epoch, **metrics})
+                record["epochs"] = epoch
+                stop = scheduler.should_stop(epoch, metrics[metric])
+                if stop:
+                    record["status"] = "stopped"
+                    print(f"Stopping {record['trial']} at epoch {epoch}: {metric} {metrics[metric]:.4f}")
+                try:
+                    conn.send("stop" if stop else "continue")
+                except (BrokenPipeError, OSError):
+                    pass
+                write_leaderboard(leaderboard_path, records, metric, rungs, eta)
+                continue
+
+            if op == "done":
+                metrics, weights = value
+                record.update(metrics, weights=weights)
+                if record["status"] == "running":
+                    record["status"] = "completed"
+            else:
+                record.update(status="failed", error=value)
+                print(f"{record['trial']} failed: {value}")
+            record["seconds"] = round(time.perf_counter() - started, 1)
+
+            process.join()
+            conn.close()
+            del running[conn]
+            free_slots.append(slot)
+            write_leaderboard(leaderboard_path, records, metric, rungs, eta)
+
+    print_leaderboard(records, metric)
+    ranked = rank_trials(records, metric)
+    if ranked and ranked[0]["weights"]:
+        print(f"\nBest model: {ranked[0]['weights']}")
+    print(f"Leaderboard saved to: {leaderboard_path}")
+    return ranked
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parallel hyperparameter sweep with successive halving")
+    parser.add_argument('--space', default=None, help="YAML search space (default: sweep.DEFAULT_SPACE)")
+    parser.add_argument('--trials', type=int, default=None,
+                        help=f"Random configurations to try (default: the full grid of a list-only space, "
+                             f"else {DEFAULT_TRIALS})")
+    parser.add_argument('--parallel', type=int, default=None, help="Trials at once (default: one per 4 cores)")
+    parser.add_argument('--epochs', type=int, default=30, help="Epoch budget of a trial that is never stopped")
+    parser.add_argument('--min-epochs', type=int, default=3, help="First successive halving rung")
+    parser.add_argument('--eta', type=int, default=3, help="Keep the top 1/eta of the trials at each rung")
+    parser.add_argument('--metric', default='map50_95', choices=list(METRICS))
+    parser.add_argument('--name', default='sweep')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data', default='dataset.yaml')
+    parser.add_argument('--packed', action='store_true', help="Read the dataset from memory-mapped shards")
+    parser.add_argument('--channels', type=int, default=3, choices=[1, 3])
+    args = parser.parse_args()
+
+    run_sweep(
+        space=load_space(args.space) if args.space else None,
+        num_trials=args.trials,
+        parallel=args.parallel,
+        max_epochs=args.epochs,
+        min_epochs=args.min_epochs,
+        eta=args.eta,
+        metric=args.metric,
+        name=args.name,
+        seed=args.seed,
+        base_params={"data": args.data, "packed": args.packed, "channels": args.channels}
+    )
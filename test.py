@@ -1,25 +1,43 @@
 from ultralytics import YOLO
+import argparse
+import time
 import matplotlib.pyplot as plt
 import numpy as np
 
-def evaluate_model(model_path='runs/train/lung_opacity_detection/weights/best.pt'):
+def evaluate_model(model_path='runs/train/lung_opacity_detection/weights/best.pt', data='dataset.yaml',
+                   imgsz=640, batch=8, plots=True, split='val', packed=False):
     """
     Evaluate the trained YOLOv8 model
+    
+    model_path may also point to an exported (ONNX/OpenVINO, FP32 or INT8) model.
+    With packed=True the split is read from the shards built by pack_dataset.py.
+    Grayscale models are evaluated on the same images loaded as one channel.
     """
+    from inference import model_channels
+    from pack_dataset import dataset_with_channels
+    
     print("Loading trained model for evaluation...")
     
     # Load the trained model
-    model = YOLO(model_path)
+    model = YOLO(model_path, task='detect')
+    data = dataset_with_channels(data, model_channels(model, model_path))
+    
+    validator = None
+    if packed:
+        from pack_dataset import PackedDetectionValidator
+        validator = PackedDetectionValidator
     
     # Validate the model
     print("Starting model validation...")
     metrics = model.val(
-        data='dataset.yaml',
-        imgsz=640,
-        batch=8,
+        validator=validator,
+        data=data,
+        imgsz=imgsz,
+        batch=batch,
+        split=split,
         save_txt=False,
         save_conf=False,
-        plots=True,  # Generate evaluation plots
+        plots=plots,  # Generate evaluation plots
         device='cpu'
     )
     
@@ -42,5 +60,151 @@ def evaluate_model(model_path='runs/train/lung_opacity_detection/weights/best.pt
     
     return metrics
 
+def box_iou(boxes_a, boxes_b):
+    """
+    Pairwise IoU of two (n, 4) / (m, 4) arrays of x1, y1, x2, y2 boxes
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    top_left = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    intersection = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+    area_a = (boxes_a[:, 2:] - boxes_a[:, :2]).prod(axis=1)
+    area_b = (boxes_b[:, 2:] - boxes_b[:, :2]).prod(axis=1)
+    return intersection / np.maximum(area_a[:, None] + area_b[None, :] - intersection, 1e-9)
+
+def count_matches(detections, gt_boxes, iou_threshold=0.5):
+    """
+    Ground-truth boxes found by the detections (greedy, highest confidence first)
+    """
+    if not detections or not len(gt_boxes):
+        return 0
+    detections = sorted(detections, key=lambda d: -d["confidence"])
+    iou = box_iou([d["bbox"] for d in detections], gt_boxes)
+    matched = np.zeros(len(gt_boxes), dtype=bool)
+    for row in iou:
+        row = np.where(matched, 0.0, row)
+        best = int(row.argmax())
+        if row[best] >= iou_threshold:
+            matched[best] = True
+    return int(matched.sum())
+
+def evaluate_cascade(model_path='runs/train/lung_opacity_detection/weights/best.pt', data='dataset.yaml',
+                     split='val', triage_imgsz=320, thresholds=(0.01, 0.02, 0.05, 0.1, 0.25), iou_threshold=0.5):
+    """
+    Measure per-stage recall and cost of the two-stage cascade (MedicalDetector cascade mode)
+    
+    Every image gets both the triage pass (once, at the lowest threshold, which covers
+    the whole sweep) and the full pass. For each triage threshold this reports the
+    escalation rate, how many positive images (with at least one labelled opacity)
+    the triage pass lets through, and the image and box recall of the cascade next to
+    running the full detector on everything. "lost" lists positives the full detector
+    finds but the cascade would screen out; it must be empty before enabling a threshold.
+    """
+    from inference import MedicalDetector, load_image
+    from pack_dataset import split_dirs, list_split_images, label_path, read_labels
+    
+    print(f"Evaluating cascade (triage at {triage_imgsz}px) on the {split} split...")
+    detector = MedicalDetector(model_path, cascade={"imgsz": triage_imgsz, "conf": min(thresholds)})
+    images = list_split_images(split_dirs(data, [split])[split])
+    
+    # Warm both passes up so the first image does not skew the cost figures
+    warm = load_image(images[0])
+    detector.triage([warm])
+    detector.detect_batch([warm], cascade=False)
+    
+    rows = []
+    for path in images:
+        array = load_image(path)
+        start = time.perf_counter()
+        score = detector.triage([array])[0]
+        triage_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        payload = detector.detect_batch([array], cascade=False)[0]
+        full_seconds = time.perf_counter() - start
+        
+        labels = read_labels(label_path(path))
+        height, width = array.shape[:2]
+        xywh = labels[:, 1:] * [width, height, width, height]
+        gt_boxes = np.concatenate([xywh[:, :2] - xywh[:, 2:] / 2, xywh[:, :2] + xywh[:, 2:] / 2], axis=1)
+        rows.append({
+            "image": path.name,
+            "score": score,
+            "gt": len(gt_boxes),
+            "matched": count_matches(payload["detections"], gt_boxes, iou_threshold),
+            "triage_seconds": triage_seconds,
+            "full_seconds": full_seconds
+        })
+    
+    positives = [r for r in rows if r["gt"]]
+    total_gt = sum(r["gt"] for r in rows)
+    triage_ms = 1000 * np.mean([r["triage_seconds"] for r in rows])
+    full_ms = 1000 * np.mean([r["full_seconds"] for r in rows])
+    full_found = [r for r in positives if r["matched"]]
+    full_image_recall = len(full_found) / max(len(positives), 1)
+    full_box_recall = sum(r["matched"] for r in rows) / max(total_gt, 1)
+    
+    print("\n=== CASCADE EVALUATION ===")
+    print(f"Images: {len(rows)} ({len(positives)} with opacities, {total_gt} boxes)")
+    print(f"Full pass only: image recall {full_image_recall:.4f}, box recall@{iou_threshold} {full_box_recall:.4f}, "
+          f"{full_ms:.1f} ms/image")
+    print(f"Triage pass: {triage_ms:.1f} ms/image")
+    print(f"\n{'threshold':>9} {'escalated':>9} {'triage_rec':>10} {'image_rec':>9} {'box_rec':>8} "
+          f"{'ms/image':>8} {'speedup':>7} {'lost':>4}")
+    
+    sweep = []
+    for threshold in sorted(thresholds):
+        escalated = [r["score"] >= threshold for r in rows]
+        escalation_rate = float(np.mean(escalated))
+        kept = [r for r, e in zip(rows, escalated) if e]
+        lost = [r["image"] for r, e in zip(rows, escalated) if not e and r["matched"]]
+        cascade_ms = triage_ms + escalation_rate * full_ms
+        result = {
+            "threshold": threshold,
+            "escalation_rate": escalation_rate,
+            "triage_image_recall": sum(1 for r in kept if r["gt"]) / max(len(positives), 1),
+            "image_recall": sum(1 for r in kept if r["gt"] and r["matched"]) / max(len(positives), 1),
+            "box_recall": sum(r["matched"] for r in kept) / max(total_gt, 1),
+            "ms_per_image": cascade_ms,
+            "speedup": full_ms / cascade_ms,
+            "lost": lost
+        }
+        sweep.append(result)
+        print(f"{threshold:>9.3f} {escalation_rate:>9.1%} {result['triage_image_recall']:>10.4f} "
+              f"{result['image_recall']:>9.4f} {result['box_recall']:>8.4f} {cascade_ms:>8.1f} "
+              f"{result['speedup']:>6.2f}x {len(lost):>4}")
+    
+    for result in sweep:
+        if result["lost"]:
+            print(f"Threshold {result['threshold']}: screens out detected positives {', '.join(result['lost'])}")
+    
+    return {
+        "images": len(rows),
+        "positives": len(positives),
+        "full_image_recall": full_image_recall,
+        "full_box_recall": full_box_recall,
+        "triage_ms": triage_ms,
+        "full_ms": full_ms,
+        "sweep": sweep
+    }
+
 if __name__ == "__main__":
-    evaluation_results = evaluate_model()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Evaluate the lung opacity detector")
+    parser.add_argument('--model', default='runs/train/lung_opacity_detection/weights/best.pt')
+    parser.add_argument('--split', default='val')
+    parser.add_argument('--packed', action='store_true', help="Read the dataset from memory-mapped shards")
+    parser.add_argument('--cascade', action='store_true', help="Measure per-stage recall and cost of the cascade")
+    parser.add_argument('--cascade-imgsz', type=int, default=320)
+    parser.add_argument('--cascade-thresholds', type=float, nargs='+', default=[0.01, 0.02, 0.05, 0.1, 0.25])
+    parser.add_argument('--incremental', action='store_true',
+                        help="Evaluate from cached per-image predictions (see incremental_eval.py)")
+    args = parser.parse_args()
+    
+    if args.incremental:
+        from incremental_eval import evaluate_incremental
+        evaluation_results = evaluate_incremental(args.model, split=args.split)
+    elif args.cascade:
+        evaluation_results = evaluate_cascade(args.model, split=args.split, triage_imgsz=args.cascade_imgsz,
+                                              thresholds=args.cascade_thresholds)
+    else:
+        evaluation_results = evaluate_model(args.model, split=args.split, packed=args.packed)
\ No newline at end of file
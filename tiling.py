@@ -0,0 +1,210 @@
+"""
+Tiled inference for full-resolution radiographs.
+
+Resizing a 2-4k film to 640 pixels loses small opacities. Instead, the image
+is cut into overlapping tiles at native resolution, plus (optionally) one
+downscaled whole-image pass for opacities larger than a tile. Each tile is an
+ordinary detector input, so tiles are batched together and can be spread
+over the replicas like separate requests. Latency then grows with the number
+of tiles per replica rather than with image area.
+
+Tile boxes are shifted back to image coordinates and overlapping boxes are
+merged with weighted box fusion (or NMS). Complete boxes are matched by IoU,
+so a small opacity nested inside a larger box (e.g. one from the whole-image
+pass) stays a detection of its own. A box cut off at a tile edge is compared
+along the cut by intersection over its own, shorter extent, and across it by
+IoU, so it still merges with the complete box from the neighbouring tile;
+such truncated boxes never set the merged coordinates while a complete box
+is available. The merged payload has the usual {"detections", "image_size"}
+format.
+"""
+import numpy as np
+
+DEFAULT_TILING_PARAMS = {"tile_size": 640, "overlap": 0.2, "global_pass": True, "merge": "wbf", "match_threshold": 0.5}
+
+# Boxes within this many pixels of a tile edge inside the image are treated as cut off by the tile
+EDGE_MARGIN = 2
+
+MERGE_METHODS = ('wbf', 'nms')
+
+
+def tile_grid(width, height, tile_size=640, overlap=0.2):
+    """
+    (x0, y0, x1, y1) tiles covering the image, the last row/column flush with the edge
+    """
+    if tile_size < 32:
+        raise ValueError("tile_size must be at least 32")
+    if not 0 <= overlap < 1:
+        raise ValueError("overlap must be in [0, 1)")
+
+    stride = max(1, int(tile_size * (1 - overlap)))
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        positions = list(range(0, length - tile_size, stride))
+        return positions + [length - tile_size]
+
+    return [
+        (x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height))
+        for y0 in starts(height) for x0 in starts(width)
+    ]
+
+
+def split_tiles(image, tile_size=640, overlap=0.2, global_pass=True):
+    """
+    Cut a decoded image into tiles (views, no copies)
+
+    Returns the tiles and their (x, y) offsets in the image. The whole image is
+    appended with offset (0, 0) when global_pass is set and there is more than one tile.
+    """
+    height, width = image.shape[:2]
+    grid = tile_grid(width, height, tile_size, overlap)
+    tiles = [image[y0:y1, x0:x1] for x0, y0, x1, y1 in grid]
+    offsets = [(x0, y0) for x0, y0, _, _ in grid]
+    if global_pass and len(grid) > 1:
+        tiles.append(image)
+        offsets.append((0, 0))
+    return tiles, offsets
+
+
+def _iou(box, boxes):
+    """
+    IoU between one box and an (n, 4) array
+    """
+    top_left = np.maximum(box[:2], boxes[:, :2])
+    bottom_right = np.minimum(box[2:], boxes[:, 2:])
+    intersection = np.clip(bottom_right - top_left, 0, None).prod(axis=1)
+    area = (box[2:] - box[:2]).prod()
+    areas = (boxes[:, 2:] - boxes[:, :2]).prod(axis=1)
+    return intersection / np.maximum(area + areas - intersection, 1e-9)
+
+
+def _cut_match(box, cut, boxes, cuts):
+    """
+    Per-axis agreement between one box and an (n, 4) array when either side may be cut off
+
+    Along an axis where either box is cut this is the intersection over the
+    shorter extent, otherwise the 1D IoU; the result is the smaller of the two axes.
+    """
+    scores = []
+    for axis in (0, 1):
+        low, high = axis, axis + 2
+        intersection = np.clip(np.minimum(box[high], boxes[:, high]) - np.maximum(box[low], boxes[:, low]), 0, None)
+        length, lengths = box[high] - box[low], boxes[:, high] - boxes[:, low]
+        axis_cut = cut[low] | cut[high] | cuts[:, low] | cuts[:, high]
+        union = np.where(axis_cut, np.minimum(length, lengths), length + lengths - intersection)
+        scores.append(intersection / np.maximum(union, 1e-9))
+    return np.minimum(*scores)
+
+
+def merge_boxes(boxes, scores, method='wbf', match_threshold=0.5, cut_edges=None):
+    """
+    Merge overlapping (n, 4) x1, y1, x2, y2 boxes, returning merged boxes and scores
+
+    'nms' keeps the highest scoring box of each group. 'wbf' replaces each group
+    by the score-weighted average of its boxes. Either way the group gets its
+    highest score: one tile's view of an opacity is not less certain for being
+    missing from the others.
+
+    cut_edges is an (n, 4) bool array of the sides (x1, y1, x2, y2) at which a
+    box was cut off by its tile. Complete boxes join a group at IoU >=
+    match_threshold, so a box nested in one more than twice its area is never
+    fused into it. Cut boxes are matched by _cut_match and only join groups;
+    they form a group of their own when no complete box matches them. A box
+    matching several groups joins the one it has the highest IoU with.
+    """
+    if method not in MERGE_METHODS:
+        raise ValueError(f"Unknown merge method '{method}', expected one of {MERGE_METHODS}")
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    cut_edges = (np.zeros((len(boxes), 4), dtype=bool) if cut_edges is None
+                 else np.asarray(cut_edges, dtype=bool).reshape(-1, 4))
+    if not len(boxes):
+        return boxes, scores
+    truncated = cut_edges.any(axis=1)
+
+    # Complete boxes first, each part by descending score
+    order = np.lexsort((-scores, truncated))
+    boxes, scores, truncated, cut_edges = boxes[order], scores[order], truncated[order], cut_edges[order]
+
+    # Each box joins the matching group whose representative it overlaps most, else starts one
+    representatives, group_cuts, groups = [], [], []
+    for i in range(len(boxes)):
+        if representatives:
+            iou = _iou(boxes[i], np.array(representatives))
+            cuts = np.array(group_cuts)
+            matches = np.where(truncated[i] | cuts.any(axis=1),
+                               _cut_match(boxes[i], cut_edges[i], np.array(representatives), cuts), iou)
+            candidates = np.flatnonzero(matches >= match_threshold)
+            if len(candidates):
+                best = int(candidates[iou[candidates].argmax()])
+                groups[best].append(i)
+                members = [j for j in groups[best] if truncated[j] == truncated[groups[best][0]]]
+                if method == 'wbf' and len(members) > 1:
+                    weights = scores[members]
+                    representatives[best] = (boxes[members] * weights[:, None]).sum(axis=0) / weights.sum()
+                continue
+        representatives.append(boxes[i].copy())
+        group_cuts.append(cut_edges[i].copy())
+        groups.append([i])
+
+    merged_scores = np.array([scores[group].max() for group in groups])
+    return np.array(representatives), merged_scores
+
+
+def merge_tile_payloads(payloads, offsets, width, height, method='wbf', match_threshold=0.5):
+    """
+    Shift per-tile detection payloads back to image coordinates and merge them into one payload
+    """
+    boxes, scores, labels, cut_edges = [], [], [], []
+    for payload, (x, y) in zip(payloads, offsets):
+        tile_width, tile_height = payload["image_size"]["width"], payload["image_size"]["height"]
+        for detection in payload["detections"]:
+            x1, y1, x2, y2 = detection["bbox"]
+            boxes.append([x1 + x, y1 + y, x2 + x, y2 + y])
+            scores.append(detection["confidence"])
+            labels.append(detection["label"])
+            # Sides touching a tile edge that is not also an image edge
+            cut_edges.append((
+                x > 0 and x1 <= EDGE_MARGIN, y > 0 and y1 <= EDGE_MARGIN,
+                x + tile_width < width and x2 >= tile_width - EDGE_MARGIN,
+                y + tile_height < height and y2 >= tile_height - EDGE_MARGIN
+            ))
+
+    detections = []
+    for label in sorted(set(labels)):
+        indices = [i for i, other in enumerate(labels) if other == label]
+        merged, merged_scores = merge_boxes([boxes[i] for i in indices], [scores[i] for i in indices],
+                                            method, match_threshold, [cut_edges[i] for i in indices])
+        for box, score in zip(merged, merged_scores):
+            box = np.clip(box, 0, [width, height, width, height])
+            detections.append({
+                "label": label,
+                "confidence": round(float(score), 4),
+                "bbox": [round(float(coord), 2) for coord in box]
+            })
+    detections.sort(key=lambda d: -d["confidence"])
+
+    return {"detections": detections, "image_size": {"width": width, "height": height}}
+
+
+def detect_tiled(image, run_tiles, tile_size=640, overlap=0.2, global_pass=True, merge='wbf',
+                 match_threshold=0.5, chunk_size=16):
+    """
+    Tiled detection payload for one decoded image
+
+    Args:
+        image: Decoded image array
+        run_tiles: Callable taking a list of tiles and returning one detection payload per tile
+                   (a detector's detect_batch, or a fan-out over a BatchScheduler)
+        chunk_size: Most tiles handed to run_tiles at once
+    """
+    height, width = image.shape[:2]
+    tiles, offsets = split_tiles(image, tile_size, overlap, global_pass)
+    payloads = []
+    for start in range(0, len(tiles), chunk_size):
+        payloads.extend(run_tiles(tiles[start:start + chunk_size]))
+    if len(tiles) == 1:
+        return payloads[0]
+    return merge_tile_payloads(payloads, offsets, width, height, merge, match_threshold)
@@ -1,26 +1,80 @@
 from ultralytics import YOLO
+import argparse
 import os
+from pathlib import Path
 
-def train_model():
+def adapt_to_grayscale(weights, output):
+    """
+    Save a copy of a 3-channel checkpoint that takes 1-channel (grayscale) input
+    
+    The first convolution's filters are summed over their input channels. A gray
+    image repeated into three identical channels produces exactly the same
+    activations, so the copy predicts what the original did on grayscale images
+    while reading a third of the input.
+    """
+    import torch
+    from copy import deepcopy
+    from ultralytics.nn.tasks import DetectionModel, load_checkpoint
+    
+    model, ckpt = load_checkpoint(weights)
+    if model.yaml.get('channels', 3) == 1:
+        print(f"{weights} already takes grayscale input")
+        return str(weights)
+    
+    gray = DetectionModel(deepcopy(model.yaml), ch=1, nc=len(model.names), verbose=False)
+    gray.load(model, verbose=False)  # copies every other tensor and sums the first conv's filters
+    gray.names, gray.args, gray.task = model.names, model.args, model.task
+    
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    torch.save({**ckpt, "model": gray.half(), "ema": None}, output)
+    print(f"Grayscale model saved to: {output}")
+    return output
+
+def train_model(packed=False, channels=3, epochs=30, imgsz=640, batch=8, device='cpu', data='dataset.yaml',
+                weights='yolov8n.pt', project='runs/train', name='lung_opacity_detection', callbacks=None,
+                **overrides):
     """
     Train YOLOv8 model for lung opacity detection
+    
+    With packed=True images and labels are read from the memory-mapped shards
+    built by pack_dataset.py (packed on first use, repacked when data changes).
+    With channels=1 the pretrained first convolution is adapted to grayscale
+    input and images are loaded as one channel throughout.
+    
+    overrides are passed on to Ultralytics (e.g. lr0, weight_decay, mosaic,
+    workers) and callbacks maps Ultralytics callback events to a function or a
+    list of functions; sweep.py uses both to run and early-stop trials.
     """
     print("Starting YOLOv8 model training...")
     
     # Load a model (pretrained)
-    model = YOLO('yolov8n.pt')  # Load a pretrained model
+    if channels == 1:
+        from pack_dataset import dataset_with_channels
+        weights = adapt_to_grayscale(weights, os.path.join(project, f"{Path(weights).stem}_1ch.pt"))
+        data = dataset_with_channels(data, channels)
+    model = YOLO(weights)  # Load a pretrained model
+    for event, functions in (callbacks or {}).items():
+        for function in functions if isinstance(functions, (list, tuple)) else [functions]:
+            model.add_callback(event, function)
+    
+    trainer = None
+    if packed:
+        from pack_dataset import PackedDetectionTrainer
+        trainer = PackedDetectionTrainer
     
     # Train the model
     results = model.train(
-        data='dataset.yaml',  # Path to dataset.yaml
-        epochs=30,            # Number of epochs
-        imgsz=640,            # Image size
-        batch=8,              # Batch size
+        trainer=trainer,
+        data=data,            # Path to dataset.yaml
+        epochs=epochs,        # Number of epochs
+        imgsz=imgsz,          # Image size
+        batch=batch,          # Batch size
         save=True,            # Save checkpoints
-        project='runs/train', # Save directory
-        name='lung_opacity_detection',  # Run name
+        project=project,      # Save directory
+        name=name,            # Run name
         exist_ok=True,        # Overwrite existing
-        device='cpu'          # Use CPU
+        device=device,        # CPU by default
+        **overrides
     )
     
     print("Training completed!")
@@ -29,4 +83,22 @@ def train_model():
     return model
 
 if __name__ == "__main__":
-    trained_model = train_model()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Train the lung opacity detector")
+    parser.add_argument('--packed', action='store_true', help="Read the dataset from memory-mapped shards")
+    parser.add_argument('--channels', type=int, default=3, choices=[1, 3],
+                        help="1 trains a grayscale model from the adapted pretrained weights")
+    parser.add_argument('--epochs', type=int, default=30)
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--batch', type=int, default=8)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--adapt', metavar='WEIGHTS', default=None,
+                        help="Instead of training, save a grayscale copy of a trained 3-channel model")
+    parser.add_argument('--output', default=None, help="Output path for --adapt (default: <weights>_1ch.pt)")
+    args = parser.parse_args()
+    
+    if args.adapt:
+        root, ext = os.path.splitext(args.adapt)
+        adapt_to_grayscale(args.adapt, args.output or f"{root}_1ch{ext}")
+    else:
+        trained_model = train_model(packed=args.packed, channels=args.channels, epochs=args.epochs, imgsz=args.imgsz,
+                                    batch=args.batch, device=args.device)
\ No newline at end of file